@@ -0,0 +1,187 @@
+"""End to end: kestep steps against the local mock LLM server, per scenario and company.
+
+    python benchmarks/bench_e2e.py [--scenarios tool_loop,images] [--companies openai,anthropic]
+                                   [--json results.json] [--compare baseline.json]
+
+Every scenario runs in a fresh python process (peak RSS is per scenario), the mock server in another.
+Reported per scenario: requests, throughput, p50/p99 request latency (from kestep's own request spans),
+peak RSS, kestep's CPU time per request (everything it does besides waiting for the server) and the part of
+it building and serializing request bodies.
+"""
+import argparse
+import json
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+COMPANIES = {
+    'openai': ('gpt-4o', '/v1/chat/completions'),
+    'xai': ('grok-2-1212', '/v1/chat/completions'),
+    'mistral': ('mistral-large-2407', '/v1/chat/completions'),
+    'anthropic': ('claude-3-5-haiku-20241022', '/v1/messages'),
+}
+
+# settings: see mock_server.py,  include_kb: size of an .include,  images: number of .image statements,
+# data_kb: size of the file the tool calls read
+SCENARIOS = {
+    'single': dict(steps=1, settings='-'),
+    'tool_loop': dict(steps=1, settings='turns=20,payload=400'),
+    'long_loop': dict(steps=1, settings='turns=60,payload=400', data_kb=64),     # a growing 4MB history
+    'fan_out': dict(steps=1, settings='turns=3,tools=8'),
+    'streaming': dict(steps=1, settings='turns=5,tps=5000,payload=4000', stream=True),
+    'large_include': dict(steps=1, settings='turns=2', include_kb=2048),
+    'images': dict(steps=1, settings='turns=1', images=4),
+    'concurrent': dict(steps=32, jobs=8, settings='turns=2,latency=0.05'),
+}
+
+
+def make_png(path: str, width: int, height: int) -> None:
+    """An RGB png of noise (incompressible, so its size is realistic), without any imaging library"""
+    raw = b''.join(b'\x00' + os.urandom(width * 3) for _ in range(height))
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    with open(path, 'wb') as file:
+        file.write(b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+                   + chunk(b'IDAT', zlib.compress(raw)) + chunk(b'IEND', b''))
+
+
+def write_steps(scenario: dict[str, any], model: str, url: str) -> list[str]:
+    with open('mock_data.txt', 'w') as file:
+        file.write("benchmark tool output line\n" * (scenario.get('data_kb', 5) * 1024 // 27))
+    lines = [f'.llm {json.dumps({"model": model, "url": url, "stream": scenario.get("stream", False)})}',
+             '.system', 'You are a benchmark, answer briefly.',
+             '.user', 'Read mock_data.txt and summarize it.']
+    if scenario.get('include_kb'):
+        with open('large.txt', 'w') as file:
+            file.write(("x" * 99 + "\n") * (scenario['include_kb'] * 1024 // 100))
+        lines.append('.include large.txt')
+    for i in range(scenario.get('images', 0)):
+        make_png(f'image{i}.png', 256, 256)
+        lines.append(f'.image image{i}.png')
+    lines.append('.exec')
+
+    os.makedirs('steps', exist_ok=True)
+    os.makedirs('logs', exist_ok=True)
+    files = []
+    for i in range(scenario['steps']):
+        files.append(os.path.join('steps', f'bench{i:03}.prompt'))
+        with open(files[-1], 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+    return files
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def drive(config_path: str) -> None:
+    """Child process: run one scenario in the current directory, write the measurements to config['out']"""
+    import resource
+    import keyring
+    from kestep.kestep_metrics import metrics
+    from kestep.kestep_runner import run_steps
+
+    with open(config_path) as file:
+        config = json.load(file)
+    keyring.get_password = lambda *args, **kwargs: 'benchmark'    # never touch the real keyring
+    metrics.enabled = True
+
+    files = write_steps(config['scenario'], config['model'], config['url'])
+    cpu, start = time.process_time(), time.perf_counter()
+    results = run_steps(files, jobs=config['scenario'].get('jobs', 1))
+    wall, cpu = time.perf_counter() - start, time.process_time() - cpu
+
+    latencies = [span.duration for span in metrics.spans if span.name == 'request']
+    prepare = [span.duration for span in metrics.spans if span.name in ('prepare', 'serialize')]
+    with open(config['out'], 'w') as file:
+        json.dump({'ok': sum(r.ok for r in results), 'steps': len(results), 'requests': len(latencies),
+                   'wall': wall, 'cpu': cpu, 'latencies': latencies, 'prepare': sum(prepare),
+                   'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}, file)
+
+
+def run_scenario(name: str, company: str, port: int) -> dict[str, any]:
+    model, path = COMPANIES[company]
+    scenario = SCENARIOS[name]
+    url = f"http://127.0.0.1:{port}/{company}/{scenario['settings']}{path}"
+    with tempfile.TemporaryDirectory() as cwd:
+        config = os.path.join(cwd, 'bench.json')
+        with open(config, 'w') as file:
+            json.dump({'scenario': scenario, 'model': model, 'url': url, 'out': os.path.join(cwd, 'out.json')}, file)
+        subprocess.run([sys.executable, os.path.abspath(__file__), '--drive', config], cwd=cwd,
+                       stdout=subprocess.DEVNULL, check=True)
+        with open(os.path.join(cwd, 'out.json')) as file:
+            raw = json.load(file)
+
+    requests = max(1, raw['requests'])
+    return {'scenario': name, 'company': company, 'ok': f"{raw['ok']}/{raw['steps']}", 'requests': raw['requests'],
+            'wall_s': round(raw['wall'], 3), 'req_per_s': round(raw['requests'] / raw['wall'], 1),
+            'p50_ms': round(percentile(raw['latencies'], 50) * 1000, 2),
+            'p99_ms': round(percentile(raw['latencies'], 99) * 1000, 2),
+            'peak_rss_mb': round(raw['peak_rss_kb'] / 1024, 1),
+            'cpu_ms_per_req': round(raw['cpu'] * 1000 / requests, 2),
+            'prep_ms_per_req': round(raw['prepare'] * 1000 / requests, 2)}
+
+
+COLUMNS = ['ok', 'requests', 'wall_s', 'req_per_s', 'p50_ms', 'p99_ms', 'peak_rss_mb', 'cpu_ms_per_req',
+           'prep_ms_per_req']
+
+
+def print_rows(rows: list[dict[str, any]], baseline: dict[tuple[str, str], dict[str, any]]) -> None:
+    print(f"{'scenario':<14}{'company':<10}" + ''.join(f"{c:>16}" for c in COLUMNS))
+    for row in rows:
+        line = f"{row['scenario']:<14}{row['company']:<10}"
+        old = baseline.get((row['scenario'], row['company']))
+        for column in COLUMNS:
+            cell = str(row[column])
+            if old and isinstance(row[column], float) and old.get(column):
+                cell += f" {(row[column] - old[column]) / old[column] * 100:+.0f}%"
+            line += f"{cell:>16}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='Comma separated scenario names')
+    parser.add_argument('--companies', default=','.join(COMPANIES), help='Comma separated mock companies')
+    parser.add_argument('--json', help='Write the results to this file')
+    parser.add_argument('--compare', help='Results file of an earlier run to compare with')
+    parser.add_argument('--drive', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.drive:
+        drive(args.drive)
+        return
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = {(row['scenario'], row['company']): row for row in json.load(file)['results']}
+
+    server = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'mock_server.py'), '--port', '0'],
+                              stdout=subprocess.PIPE, text=True)
+    try:
+        port = int(server.stdout.readline().rsplit(':', 1)[1])
+        rows = [run_scenario(name, company, port)
+                for name in args.scenarios.split(',') for company in args.companies.split(',')]
+    finally:
+        server.terminate()
+
+    print_rows(rows, baseline)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'python': sys.version.split()[0], 'time': time.time(), 'results': rows}, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""Parse (list and validate) a few hundred step files, cold and with the compiled step cache.
+
+    python benchmarks/bench_parse.py [--steps 300]
+"""
+import argparse
+import glob
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in the temporary working directory, so .kestep/steps.json is created there
+PARSE_ALL = """
+import glob, time
+from kestep.kestep import PromtpStep
+start = time.perf_counter()
+for step_file in sorted(glob.glob('steps/*.prompt')):
+    PromtpStep(step_file).parse_prompt()
+print(time.perf_counter() - start)
+"""
+
+
+def parse_all() -> float:
+    out = subprocess.run([sys.executable, '-c', PARSE_ALL], capture_output=True, text=True, check=True)
+    return float(out.stdout.strip())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--steps', type=int, default=300, help='Number of step files to generate')
+    args = parser.parse_args()
+
+    sources = sorted(glob.glob(os.path.join(REPO, 'steps', '*.prompt')))
+    with tempfile.TemporaryDirectory() as tmp:
+        os.makedirs(os.path.join(tmp, 'steps'))
+        for i in range(args.steps):
+            shutil.copy(sources[i % len(sources)], os.path.join(tmp, 'steps', f"step{i:04}.prompt"))
+        os.chdir(tmp)
+
+        cold = parse_all()      # parses every file and writes the cache
+        warm = parse_all()      # one stat() per file
+        for step_file in glob.glob('steps/*.prompt'):
+            os.utime(step_file)     # touched, but unchanged content
+        touched = parse_all()
+        warm_again = parse_all()
+
+    print(f"{args.steps} steps: cold {cold:.3f}s  warm {warm:.3f}s  "
+          f"touched {touched:.3f}s  warm {warm_again:.3f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Startup time of the kestep command line: median wall time per command and the slowest imports.
+
+    python benchmarks/bench_startup.py [--runs 9] [--baseline path/to/other/src]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+COMMANDS = [['-v'], ['-s'], ['-m'], ['-f']]
+
+
+def run_times(args: list[str], runs: int, env: dict[str, str], cwd: str) -> float:
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-m', 'kestep.main', *args], env=env, cwd=cwd,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def slowest_imports(env: dict[str, str], count: int = 10) -> list[tuple[int, str]]:
+    """Top-level-ish modules by cumulative import time (-X importtime), in microseconds"""
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import kestep.main'],
+                         env=env, capture_output=True, text=True, check=True)
+    rows = []
+    for line in out.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative), name.rstrip()))
+    return sorted(rows, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=9, help='Runs per command, the median is reported')
+    parser.add_argument('--baseline', help='src directory of another kestep tree to compare with')
+    args = parser.parse_args()
+
+    trees = {'current': dict(os.environ)}
+    if args.baseline:
+        trees['baseline'] = {**os.environ, 'PYTHONPATH': os.path.abspath(args.baseline)}
+
+    with tempfile.TemporaryDirectory() as cwd:     # kestep creates steps/ and logs/ where it runs
+        for name, env in trees.items():
+            for command in COMMANDS:
+                secs = run_times(command, args.runs, env, cwd)
+                print(f"{name:<9} kestep {' '.join(command):<4} {secs * 1000:7.1f} ms")
+
+    print("\nslowest imports of kestep.main (cumulative):")
+    for usecs, module in slowest_imports(trees['current']):
+        print(f"{usecs / 1000:8.1f} ms  {module}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+"""Local stand-in for the LLM APIs kestep talks to, for benchmarks.
+
+    python benchmarks/mock_server.py [--port 8765]
+
+The company and the behaviour are chosen per request by the url path, so one server serves every scenario:
+
+    http://127.0.0.1:8765/<company>/<settings>/v1/chat/completions     (openai, xai, mistral)
+    http://127.0.0.1:8765/anthropic/<settings>/v1/messages
+
+settings is a comma separated list of name=value, '-' for the defaults:
+    latency  seconds before the response starts            (0.0)
+    tps      output tokens per second, 0 for no delay       (0)
+    turns    model turns answering with tool calls          (0)
+    tools    tool calls per such turn (fan-out)             (1)
+    payload  characters of response text                    (200)
+    file     file the readfile tool calls read              (mock_data.txt)
+    fail     answer the request of this model turn once with a 400 error, for --resume (-1: never)
+Streaming requests ("stream": true) are answered with server sent events in the company's format.
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+DEFAULTS = {'latency': 0.0, 'tps': 0.0, 'turns': 0, 'tools': 1, 'payload': 200, 'file': 'mock_data.txt', 'fail': -1}
+CHUNK_TOKENS = 4    # tokens per streamed delta
+WORDS = "the quick brown fox jumps over the lazy dog while kestep waits for tokens "
+
+
+def parse_settings(text: str) -> dict[str, any]:
+    settings = dict(DEFAULTS)
+    for item in text.split(','):
+        if '=' in item:
+            name, value = item.split('=', 1)
+            settings[name] = type(DEFAULTS[name])(value) if name in DEFAULTS else value
+    return settings
+
+
+def response_text(payload: int) -> str:
+    return (WORDS * (payload // len(WORDS) + 1))[:payload]
+
+
+class MockLLM(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    requests = 0
+    failed: set[tuple[str, int]] = set()   # (path, turn) answered with the fail error already
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):     # kestep's connection prewarm
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        raw = self.rfile.read(int(self.headers['Content-Length']))
+        body = json.loads(raw)
+        with MockLLM.lock:
+            MockLLM.requests += 1
+
+        parts = self.path.strip('/').split('/')
+        company, settings = parts[0], parse_settings(parts[1] if len(parts) > 1 else '-')
+        turns_done = sum(msg.get('role') == 'assistant' for msg in body.get('messages', []))
+        calls = settings['tools'] if turns_done < settings['turns'] else 0
+        if turns_done == settings['fail']:
+            with MockLLM.lock:
+                fail = (self.path, turns_done) not in MockLLM.failed
+                MockLLM.failed.add((self.path, turns_done))
+            if fail:
+                body = json.dumps({"error": {"message": f"mock failure at turn {turns_done}"}}).encode()
+                self.send_response(400)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+        text = response_text(settings['payload'])
+        usage_in, usage_out = len(raw) // 4, max(1, len(text) // 4)
+
+        time.sleep(settings['latency'])
+        if company == 'anthropic':
+            if body.get('stream'):
+                self.stream_anthropic(text, calls, settings, usage_in, usage_out)
+            else:
+                self.pace(usage_out, settings)
+                self.reply(self.anthropic_message(text, calls, settings, usage_in, usage_out))
+        elif body.get('stream'):
+            self.stream_openai(text, calls, settings, usage_in, usage_out)
+        else:
+            self.pace(usage_out, settings)
+            self.reply(self.openai_completion(text, calls, settings, usage_in, usage_out))
+
+    @staticmethod
+    def pace(tokens: int, settings: dict[str, any]) -> None:
+        if settings['tps']:
+            time.sleep(tokens / settings['tps'])
+
+    @staticmethod
+    def tool_arguments(settings: dict[str, any]) -> dict[str, str]:
+        return {"filename": settings['file']}
+
+    def openai_completion(self, text, calls, settings, usage_in, usage_out) -> dict[str, any]:
+        message = {"role": "assistant", "content": text}
+        if calls:
+            message["tool_calls"] = [{"id": f"call_{i}", "type": "function",
+                                      "function": {"name": "readfile",
+                                                   "arguments": json.dumps(self.tool_arguments(settings))}}
+                                     for i in range(calls)]
+        return {"id": "mock", "object": "chat.completion",
+                "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if calls else "stop"}],
+                "usage": {"prompt_tokens": usage_in, "completion_tokens": usage_out}}
+
+    def anthropic_message(self, text, calls, settings, usage_in, usage_out) -> dict[str, any]:
+        content = [{"type": "text", "text": text}]
+        content += [{"type": "tool_use", "id": f"toolu_{i}", "name": "readfile", "input": self.tool_arguments(settings)}
+                    for i in range(calls)]
+        return {"id": "mock", "type": "message", "role": "assistant", "content": content,
+                "stop_reason": "tool_use" if calls else "end_turn",
+                "usage": {"input_tokens": usage_in, "output_tokens": usage_out}}
+
+    def reply(self, obj: dict[str, any]) -> None:
+        body = json.dumps(obj).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Streaming
+
+    def start_stream(self) -> None:
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+    def event(self, data: any, name: str = None) -> None:
+        text = (f"event: {name}\n" if name else '') + f"data: {data if isinstance(data, str) else json.dumps(data)}\n\n"
+        chunk = text.encode()
+        self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+
+    def end_stream(self) -> None:
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def deltas(self, text: str, settings: dict[str, any]):
+        step = CHUNK_TOKENS * 4
+        for i in range(0, len(text), step):
+            self.pace(CHUNK_TOKENS, settings)
+            yield text[i:i + step]
+
+    def stream_openai(self, text, calls, settings, usage_in, usage_out) -> None:
+        self.start_stream()
+        for delta in self.deltas(text, settings):
+            self.event({"choices": [{"index": 0, "delta": {"content": delta}}]})
+        for i in range(calls):
+            self.event({"choices": [{"index": 0, "delta": {"tool_calls": [{
+                "index": i, "id": f"call_{i}", "type": "function",
+                "function": {"name": "readfile", "arguments": json.dumps(self.tool_arguments(settings))}}]}}]})
+        self.event({"choices": [{"index": 0, "delta": {}, "finish_reason": "tool_calls" if calls else "stop"}]})
+        self.event({"choices": [], "usage": {"prompt_tokens": usage_in, "completion_tokens": usage_out}})
+        self.event('[DONE]')
+        self.end_stream()
+
+    def stream_anthropic(self, text, calls, settings, usage_in, usage_out) -> None:
+        self.start_stream()
+        self.event({"type": "message_start", "message": {"id": "mock", "type": "message", "role": "assistant",
+                                                         "content": [], "usage": {"input_tokens": usage_in,
+                                                                                  "output_tokens": 1}}},
+                   "message_start")
+        self.event({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}},
+                   "content_block_start")
+        for delta in self.deltas(text, settings):
+            self.event({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": delta}},
+                       "content_block_delta")
+        self.event({"type": "content_block_stop", "index": 0}, "content_block_stop")
+        for i in range(calls):
+            self.event({"type": "content_block_start", "index": i + 1,
+                        "content_block": {"type": "tool_use", "id": f"toolu_{i}", "name": "readfile", "input": {}}},
+                       "content_block_start")
+            self.event({"type": "content_block_delta", "index": i + 1,
+                        "delta": {"type": "input_json_delta", "partial_json": json.dumps(self.tool_arguments(settings))}},
+                       "content_block_delta")
+            self.event({"type": "content_block_stop", "index": i + 1}, "content_block_stop")
+        self.event({"type": "message_delta", "delta": {"stop_reason": "tool_use" if calls else "end_turn"},
+                    "usage": {"output_tokens": usage_out}}, "message_delta")
+        self.event({"type": "message_stop"}, "message_stop")
+        self.end_stream()
+
+
+def serve(port: int = 0) -> ThreadingHTTPServer:
+    """Start the server on a background thread, port 0 picks a free port (server.server_address[1])"""
+    server = ThreadingHTTPServer(('127.0.0.1', port), MockLLM)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), MockLLM)
+    server.daemon_threads = True
+    print(f"mock LLM server on http://127.0.0.1:{server.server_address[1]}", flush=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,43 +1,50 @@
-import base64
 import copy
 import glob
+import io
 import json
 import logging
-import mimetypes
 import os
 import sys
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from copy import deepcopy
-from time import sleep
 
-import keyring
-import requests
-from pygments.lexers import q
 from rich.console import Console
-from rich.logging import RichHandler
 from rich.table import Table
-from textual import content
 
-from kestep.kestep_api_config import api_config
-from kestep.kestep_functions import DefinedFunctions, readfile, DefinedToolsArray, AnthropicToolsArray
+from kestep.kestep_api_config import api_config, get_models_config
+from kestep.kestep_batch import batch_results
+from kestep.kestep_budget import ToolBudget
+from kestep.kestep_cache import response_cache
+from kestep.kestep_checkpoint import checkpoints, STEP_FIELDS, BUDGET_FIELDS
+from kestep.kestep_conversation import Conversation
+from kestep.kestep_functions import DefinedFunctions, readfile, DefinedToolsArray, AnthropicToolsArray, \
+    SerialFunctions, ToolFunctions
+from kestep.kestep_images import encode_images, image_limits
+from kestep.kestep_mapreduce import MAP_WORKERS, MIN_CHUNK_TOKENS, open_mapped, chunk_bytes, chunk_bounds, \
+    response_text
+from kestep.kestep_metrics import metrics
+from kestep.kestep_promptcache import add_breakpoints, input_usage, input_cost, CACHE_MIN_TOKENS
+from kestep.kestep_stepcache import step_cache
+from kestep.kestep_stream import make_stream
+from kestep.kestep_tokens import CONTEXT_POLICIES, trim_tool_results, text_tokens
 from kestep.kestep_util import TOP_LEFT, BOTTOM_LEFT, VERTICAL, HORIZONTAL, TOP_RIGHT, RIGHT_TRIANGLE, LEFT_TRIANGLE, \
     HORIZONTAL_LINE, BOTTOM_RIGHT, CIRCLE, CHAR_SEND_REQUEST
 from kestep.kestep_util import backup_file
 
-FORMAT = "%(message)s"
-logging.basicConfig(level="NOTSET", format=FORMAT, datefmt="[%X]", handlers=[RichHandler()])
-
 log = logging.getLogger(__file__)
 
-models_config: dict[str, any]
-json_path = os.path.join(os.path.dirname(__file__), 'kestep_models.json')
-with open(json_path, "r") as json_file:
-    models_config = json.load(json_file)
-
 console = Console()
 terminal_width = console.size.width
 stop_event = threading.Event()  # Event to signal when to stop the thread
+key_lock = threading.Lock()  # Serializes API key prompts
+max_tool_workers = 8  # Tool calls of one model turn running at the same time
+DEFAULT_MAX_OUTPUT = 4096  # Anthropic max_tokens for models of unknown output limit
+# Statements with effects besides messages, a step cannot run them before its batched first request
+BATCH_UNSAFE = ('.cmd', '.clear')
+# Counters of a .map part added to its step
+MAP_PART_FIELDS = ('toks_in', 'toks_out', 'cost_in', 'cost_out', 'toks_saved', 'written')
 
 # keywords = ['.#', '.assistant', '.cmd', '.clear', '.include', '.debug', '.exec', '.llm', '.system', '.user', ]
 
@@ -68,6 +75,10 @@ def print_step_code(step_files: list[str]) -> None:
 
 
 
+class ContextOverflow(Exception):
+    pass
+
+
 class PromptSyntaxError(Exception):
     pass
 
@@ -75,31 +86,51 @@ class PromptSyntaxError(Exception):
 class PromtpStep:
     """Class to hold Step execution state"""
 
-    def __init__(self, filename: str, debug: bool = False):
+    def __init__(self, filename: str, debug: bool = False, quiet: bool = False):
         self.filename = filename
         self.debug = debug
+        self.quiet = quiet  # Running alongside other steps: record, but do not write to the terminal
         self.ip: int = 0
         self.llm: dict[str, any] = {}
         self.vdict: dict[str, str] = {}
         self.statements: list[_PromptStatement] = []
         self.messages: list[dict[str, str]] = []
+        self.conversation = Conversation()  # request body and token estimate of self.messages, built incrementally
         self.header: dict[str, any] = {}
         self.data: str = ''
-        self.console = Console(record=True)  # Console for terminal
+        if quiet:
+            self.console = Console(record=True, file=io.StringIO(), width=terminal_width)
+        else:
+            self.console = Console(record=True)  # Console for terminal
         self.file_console = None  # Console for file, initialized in execute
+        self.trace_id = os.urandom(16).hex()  # groups the metrics spans of this step
+        self.span = None  # metrics span of the model turn in progress, parent of its tool calls
         self.model: dict[str, any] = None
         self.model_name:str = None
         self.company:str = None
         self.system_value: str = None
         self.toks_in = 0
         self.cost_in = 0
+        self.toks_cache_read = 0   # of toks_in, read from the provider's prompt cache
+        self.toks_cache_write = 0  # of toks_in, written to the provider's prompt cache
+        self.toks_saved = 0  # input tokens of tool output not sent, thanks to the tool budget
+        self.tool_budget: ToolBudget = None  # created by load_llm
+        self.cache_blocks: dict[int, dict] = {}  # id(content block) -> block, cache breakpoint candidates
         self.toks_out = 0
         self.cost_out = 0
         self.total = 0
+        self.stream_buffer = ''
+        self.journal = None  # ConversationJournal, opened by the first log_conversation()
+        self.journal_messages = True  # False for the parts of a .map, only their step's messages are logged
+        self.written: list[str] = []  # files written by writefile, kept with the step's fingerprint
+        self.checkpointing = True  # False for the parts of a .map, a .map is checkpointed once it completed
+        self.turn_response: dict[str, any] = None  # the model response whose tool calls are running
+        self.turn_messages = 0  # len(messages) before turn_response was added to them
+        self.tool_results: dict[str, any] = {}  # call id -> result, of turn_response's calls done so far
 
 
         if debug:
-            log.info(f'Instantiated PromptStep(filename="{filename}",debug="{debug}")')
+            log.info(f'Instantiated PromptStep(filename="{filename}",debug="{debug}",quiet="{quiet}")')
 
     def print(self, *args, **kwargs):
         """Print method to output to both console and file."""
@@ -174,11 +205,18 @@ class PromtpStep:
 
     def parse_prompt(self) -> bool:
         if self.debug: log.info(f'parse_prompt()')
-        lines: list[str]
 
-        # read .prompt file
-        with open(self.filename, 'r') as file:
-            lines = file.readlines()
+        # Unchanged .prompt files are not parsed again, their statements come from the step cache
+        with metrics.span('parse', self):
+            for keyword, value, msg_no, lno in step_cache.statements(self.filename, self.compile_prompt, syntax=keywords):
+                self.statements.append(make_statement(self, msg_no, keyword, value, lno))
+
+        return True
+
+    def compile_prompt(self, text: str) -> list[tuple[str, str, int, int]]:
+        """Parse the text of a .prompt file into (keyword, value, msg_no, source line) statement rows"""
+        lines: list[str] = text.splitlines(keepends=True)
+        rows: list[tuple[str, str, int, int]] = []
 
         # Delete trailing blank lines
         while lines[-1][0].strip() == '':
@@ -191,6 +229,7 @@ class PromtpStep:
         # Storage for multiline cmds: .system .user .assistant
         last_keyword = None
         last_value = ''
+        last_lno = 0
 
         for lno, line in enumerate(lines):
             try:
@@ -220,27 +259,26 @@ class PromtpStep:
                 # That completes the "last" statement
                 if last_value:
                     # Okay Lets add it to msg list
-                    self.statements.append(make_statement(self, len(self.statements), last_keyword, last_value[:-1]))
+                    if last_keyword not in StatementTypes:
+                        raise PromptSyntaxError(f"text outside of a .system, .user or .assistant statement")
+                    rows.append((last_keyword, last_value[:-1], len(rows), last_lno))
                     last_value = ''
 
                 # Does this represent the end of a Multi Line?
                 if keyword in ['.assistant', '.user', '.system']:
                     last_keyword = keyword
                     last_value = ''
+                    last_lno = lno
                     continue  # .user, .system, .assistant do not have info on line...
 
                 # and now for the single line dot keywords
-                self.statements.append(make_statement(self, len(self.statements), keyword, rest))
+                rows.append((keyword, rest, len(rows), lno))
 
             except Exception as e:
                 raise PromptSyntaxError(
                     f"{VERTICAL} [red]Error parsing file {self.filename}:{lno} error: {str(e)}.[/]\n\n")
 
-        # console.print(f'Generated statements:')
-        # for sno, stmt in enumerate(self.statements):
-        #     console.print(f"{sno}: {stmt}")
-
-        return True
+        return rows
 
     def print_exception(self) -> None:
         """Print exception information to both console and file outputs."""
@@ -254,6 +292,7 @@ class PromtpStep:
             raise PromptSyntaxError(f".llm syntax error: model not defined")
         self.model_name = parms['model']
 
+        models_config = get_models_config()
         if self.model_name not in models_config:
             raise PromptSyntaxError(f"kestep_models.json error: model {self.model_name} is not defined")
         self.model = models_config[self.model_name]
@@ -272,10 +311,34 @@ class PromtpStep:
         for k, v in parms.items():
             self.llm[k] = v
 
-
-
-    def execute(self) -> None:
+        if self.llm.get('context_policy', 'report') not in CONTEXT_POLICIES:
+            raise PromptSyntaxError(f".llm syntax: context_policy must be one of {CONTEXT_POLICIES}")
+        self.tool_budget = ToolBudget(self.llm)
+
+
+
+    def resume(self, state: dict[str, any]) -> int:
+        """Restore a checkpoint (kestep_checkpoint), returns the statement to continue at"""
+        for k in STEP_FIELDS:
+            setattr(self, k, state[k])
+        self.model = get_models_config()[self.model_name]
+        self.llm = state['llm']
+        self.tool_budget = ToolBudget(self.llm)
+        for k in BUDGET_FIELDS:
+            setattr(self.tool_budget, k, state['budget'].get(k, 0))
+        self.messages = state['messages']
+        for i, j in state['cache_blocks']:
+            self.mark_cache(self.messages[i]['content'][j])
+        self.turn_response = state['response']
+        self.tool_results = state['tool_results']
+        from kestep.kestep_http import prewarm
+        prewarm(self.llm['url'])
+        load_api_key(self)
+        return state['ip']
+
+    def execute(self, resume: bool = False) -> None:
         if self.debug: log.info(f'execute({self.filename} with {len(self.statements)} statements)')
+        state = checkpoints.load(self.filename) if resume else None
 
         base_name = os.path.splitext(os.path.basename(self.filename))[0]
         logfile_name = backup_file(f"logs/{base_name}.log", backup_dir='logs', extension='.log')
@@ -286,12 +349,26 @@ class PromtpStep:
                 f"[bold white]{TOP_LEFT}{HORIZONTAL * 2}[/][bold white]{os.path.basename(self.filename):{HORIZONTAL}<{terminal_width - 4}}{TOP_RIGHT}[/]"
             )
 
+            start = 0
+            if state:
+                start = self.resume(state)
+                pline = (f"resumed at statement {start}, {len(self.messages)} messages, "
+                         f"Tokens In={self.toks_in} Out={self.toks_out} Total=${self.total:06.4f} already spent")
+                self.print(f"[bold white]{VERTICAL}[/][bold yellow]{pline:<{terminal_width - 2}}[/][bold white]{VERTICAL}[/]")
+            elif resume:
+                self.print(f"[bold white]{VERTICAL}[/][bold yellow]{'no checkpoint to resume, starting over':<{terminal_width - 2}}[/][bold white]{VERTICAL}[/]")
+
             for stmt_no, stmt in enumerate(self.statements):
+                if stmt_no < start:
+                    continue
+                self.ip = stmt_no
                 if self.company == 'Anthropic' and stmt.keyword == '.system':
                     self.system_value = stmt.value
                     continue
                 try:
                     stmt.execute(self)
+                    if stmt.keyword in ('.exec', '.map'):
+                        checkpoints.save(self, stmt_no + 1)
                 except Exception as e:
                     self.print(f"{VERTICAL} [bold red]Error executing statement above : {str(e)}[/bold red]\n\n")
                     self.print(f"{BOTTOM_LEFT}{HORIZONTAL * (terminal_width - 2)}{VERTICAL}")
@@ -300,32 +377,63 @@ class PromtpStep:
                     sys.exit(9)
 
             self.print(f"{BOTTOM_LEFT}{HORIZONTAL * (terminal_width - 2)}{BOTTOM_RIGHT}")
+            if self.checkpointing:
+                checkpoints.remove(self.filename)
 
             self.file_console.file.close()  # Close file console at end
+            if self.journal:
+                self.journal.close()
             logfile_name_html = backup_file(f"logs/{base_name}.svg", backup_dir='logs', extension='.svg')
             self.console.save_svg(logfile_name_html)
-            print(f"Wrote {logfile_name_html} to disk")
-
+            if not self.quiet:
+                print(f"Wrote {logfile_name_html} to disk")
+
+
+    def estimate(self) -> list[int]:
+        """Dry run for --estimate: build the messages without calling LLMs, tools or the keyring.
+
+        Returns the estimated input tokens of every .exec, later ones lack the (unknown) responses before them.
+        """
+        estimates = []
+        for stmt in self.statements:
+            if self.company == 'Anthropic' and stmt.keyword == '.system':
+                self.system_value = stmt.value
+                continue
+            tokens = stmt.estimate(self)
+            if isinstance(tokens, list):    # a .map: one request per part
+                estimates.extend(tokens)
+            elif tokens is not None:
+                estimates.append(tokens)
+        return estimates
+
+    def prepare_batch(self) -> dict[str, any]:
+        """Dry run (as --estimate) the statements before the first .exec and return the data it would send
+        (None without .exec).
+
+        Used by --batch, the step is executed in full later, its first request answered by the batch.
+        Raises ValueError when a statement before the .exec has effects (.cmd, .clear): the dry run would
+        not build the same request, running them would run them twice.
+        """
+        for stmt in self.statements:
+            if self.company == 'Anthropic' and stmt.keyword == '.system':
+                self.system_value = stmt.value
+                continue
+            if stmt.keyword == '.map':
+                return None     # its requests depend on each other's files and answers, not a single batch
+            if stmt.keyword in BATCH_UNSAFE:
+                raise ValueError(f"{stmt.keyword} before the first .exec")
+            if stmt.keyword == '.exec':
+                self.llm.setdefault('API_KEY', '')     # the header is not part of the batch
+                self.correct_messages()
+                self.make_data()
+                self.check_context()
+                return self.data
+            stmt.estimate(self)
+        return None
 
     def correct_messages(self):
-        msgs = []
-
-        for msg in self.messages:
-            # convert all messages to objects with content arrays
-            if type(msg) == str:
-                msg = {"role": "user", "content": [{"type": "text", "text": msg}]}
-
-            # is there a previous message?
-            if msgs:
-                # Is last message same role as this one?
-                if msgs[-1]["role"] == msg["role"]:
-                    # copy contents to end of previous content array
-                    msgs[-1]["content"].extend(msg["content"])
-                    continue
-
-            msgs.append(msg)
-
-        self.messages = msgs
+        """Convert the messages added since the last request to content arrays and merge same role neighbours"""
+        self.conversation.correct(self.messages)
 
 
     def make_data(self) -> None:
@@ -338,8 +446,11 @@ class PromtpStep:
             case 'Anthropic':
                 self.header = {"Content-Type": "application/json", "anthropic-version": "2023-06-01", "x-api-key": f"{self.llm['API_KEY']}"}
                 self.data['system'] = self.system_value     # Anthropic wants system at data['system'] not in a msg
+                if self.llm.get('prompt_cache'):
+                    self.data['messages'], self.data['system'] = add_breakpoints(
+                        self.messages, self.system_value, self.cache_blocks, self.conversation.breakpoints)
                 self.data['tools'] =  AnthropicToolsArray   # Tools Array has 'input_schema' instead of 'parameters'
-                self.data['max_tokens'] = int(self.model['context'])  # output context size
+                self.data['max_tokens'] = self.max_output() or DEFAULT_MAX_OUTPUT   # required by Anthropic
 
             case 'XAI':
                 self.header = {"Content-Type": "application/json", "Authorization": f"Bearer {self.llm['API_KEY']}"}
@@ -358,6 +469,47 @@ class PromtpStep:
                 self.print(f"[bold red]Error {self.company} not defined[/bold red]")
                 exit(9)
 
+        if self.llm.get('max_tokens') and 'max_tokens' not in self.data:
+            self.data['max_tokens'] = int(self.llm['max_tokens'])
+
+        if self.llm.get('stream'):
+            self.data['stream'] = True
+            if 'stream_options' in self.llm:
+                self.data['stream_options'] = self.llm['stream_options']
+
+    def mark_cache(self, block: dict) -> None:
+        """Make block a prompt cache breakpoint candidate (used by providers with explicit caching)"""
+        self.cache_blocks[id(block)] = block
+
+    def max_output(self) -> int:
+        """Output tokens a response may have: .llm max_tokens, else the model's max_output (None if unknown)"""
+        return int(self.llm.get('max_tokens') or self.model.get('max_output') or 0) or None
+
+    def check_context(self) -> tuple[int, str]:
+        """Estimate the input tokens of step.data and apply the .llm context_policy when over the model's context
+        less the output tokens the request asks for (data['max_tokens']).
+
+        Returns the estimate and a note for the terminal ('' when within the context).
+        report: send as is,  trim: drop the oldest tool results,  refuse: raise ContextOverflow
+        """
+        context = int(self.model['context']) - int(self.data.get('max_tokens') or 0)
+        tokens = self.conversation.tokens(self.company, self.data)
+        if tokens <= context:
+            return tokens, ''
+
+        policy = self.llm.get('context_policy', 'report')
+        if policy == 'trim':
+            saved = trim_tool_results(self.company, self.messages, tokens - context)
+            if saved:
+                self.make_data()
+                tokens = self.conversation.tokens(self.company, self.data)
+                if tokens <= context:
+                    return tokens, f"trimmed {saved} tokens of old tool results, ~{tokens} of {context} tokens"
+        if policy == 'report':
+            return tokens, f"~{tokens} input tokens exceed the {context} token context of {self.model_name} " \
+                           f"left for input"
+        raise ContextOverflow(f"~{tokens} input tokens exceed the {context} token context left for input")
+
     def print_with_wrap(self, is_responce:bool, line:str)-> None:
         line_len = terminal_width - 14
         color = '[bold green]'
@@ -376,7 +528,58 @@ class PromtpStep:
         lead, trail = print_line.split(':', 1)
         self.print(f"{hdr}{lead}[/]:{trail}[bold white]{VERTICAL}[/]")
 
-    def do_conversation(self, response_obj: dict[str, any], header:str) -> bool:
+    def print_stream_text(self, delta: str) -> None:
+        """Render streamed text deltas, one print_with_wrap line per completed line"""
+        self.stream_buffer += delta
+        while '\n' in self.stream_buffer:
+            line, self.stream_buffer = self.stream_buffer.split('\n', 1)
+            self.print_with_wrap(is_responce=True, line=f"Response: {line}")
+
+    def flush_stream_text(self) -> None:
+        if self.stream_buffer:
+            self.print_with_wrap(is_responce=True, line=f"Response: {self.stream_buffer}")
+        self.stream_buffer = ''
+
+    def call_tool(self, name: str, args: dict[str, any], call_id: str = None) -> any:
+        if call_id is not None and call_id in self.tool_results:
+            return self.tool_results[call_id]     # done before the run was interrupted (--resume)
+        with metrics.span('tool', parent=self.span, tool=name):
+            result = ToolFunctions.get(name, DefinedFunctions[name])(**args)
+        if name == 'writefile':
+            self.written.append(args['filename'])
+        if call_id is not None:
+            self.tool_results[call_id] = result
+            checkpoints.save(self, self.ip)
+        return result
+
+    def call_functions(self, calls: list[tuple[str, dict[str, any]]], ids: list[str] = None) -> list[any]:
+        """Run the tool calls of one model turn, returning their results in call order.
+
+        Independent calls run concurrently on a worker pool.  SerialFunctions (e.g. askuser) run
+        on this thread once all calls before them have finished, and before any call after them starts.
+        With the call ids, every result is checkpointed and a call already done is not run again.
+        """
+        ids = ids or [None] * len(calls)
+        parallel = sum(name not in SerialFunctions for name, _ in calls)
+        if parallel < 2:
+            return [self.call_tool(name, args, call_id) for (name, args), call_id in zip(calls, ids)]
+
+        results: list[any] = [None] * len(calls)
+        pending = {}
+        with ThreadPoolExecutor(max_workers=min(parallel, max_tool_workers), thread_name_prefix='tool') as pool:
+            for i, (name, args) in enumerate(calls):
+                if name in SerialFunctions:
+                    for j, future in pending.items():
+                        results[j] = future.result()
+                    pending = {}
+                    results[i] = self.call_tool(name, args, ids[i])
+                else:
+                    pending[i] = pool.submit(self.call_tool, name, args, ids[i])
+            for j, future in pending.items():
+                results[j] = future.result()
+        return results
+
+    def do_conversation(self, response_obj: dict[str, any], header:str, streamed: bool = False) -> bool:
         continue_conversation = False
 
         # Todo: All LLms sends multiple msgs in a batch.  These need to be responded in a batch.
@@ -386,26 +589,26 @@ class PromtpStep:
                 is_function_call = (finish_reason == "tool_use")
                 self.messages.append({"role": response_obj["role"], "content":response_obj["content"]})
 
-                return_msgs = []
+                tool_uses = []
                 for msg in response_obj["content"]:
                     if msg['type'] == 'text':
-                        self.print_with_wrap(is_responce=True, line=f"Response: {msg['text']}")
-                    else:
+                        if not streamed:    # streamed text has already been rendered
+                            self.print_with_wrap(is_responce=True, line=f"Response: {msg['text']}")
+                    elif msg['type'] == 'tool_use':
                         continue_conversation = True
+                        tool_uses.append(msg)
+                        self.print_with_wrap(is_responce=True, line=f"Call {msg['name']}:{msg['id']}:({msg['input']})")
 
-                        function_name = msg['name']
-                        function_args = msg['input']
-                        function_id = msg["id"]
+                results = self.call_functions([(msg['name'], msg['input']) for msg in tool_uses],
+                                              [msg['id'] for msg in tool_uses])
 
-                        self.print_with_wrap(is_responce=True, line=f"Call {function_name}:{function_id}:({function_args})")
-                        ret = DefinedFunctions[function_name](**function_args)
-
-                        self.print_with_wrap(is_responce=False, line=f"Call returned: {ret} ")
-                        if function_name == 'readimage':
-                            return_msgs.append({"type": "tool_result", "tool_use_id": function_id, "content": ret})
-                        else:
-                            return_msgs.append({"type": "tool_result", "tool_use_id": function_id, "content": ret})
-                self.messages.append({"role":"user", "content": [{"type": "text", "text": return_msgs}]})
+                return_msgs = []
+                for msg, ret in zip(tool_uses, results):
+                    self.print_with_wrap(is_responce=False, line=f"Call returned: {ret} ")
+                    ret = self.tool_budget.admit(self.company, msg['name'], ret)
+                    return_msgs.append({"type": "tool_result", "tool_use_id": msg['id'], "content": ret})
+                if return_msgs:
+                    self.messages.append({"role": "user", "content": return_msgs})
 
 
             case 'OpenAI' | 'XAI' | 'MistralAI':
@@ -422,56 +625,62 @@ class PromtpStep:
 
                 for msg in resp_msgs:
 
-                    function_name: str = ''
-                    function_args: dict[str:any] = {}
-
                     self.messages.append(msg)
                     if is_function_call:
                         if 'tool_calls' in msg:
                             # Okay now for multiple tool calls
+                            calls = []
                             for tool_call in msg['tool_calls']:
-
                                 function_name = tool_call['function']['name']
                                 function_args = json.loads(tool_call['function']['arguments'])
+                                calls.append((function_name, function_args))
 
                                 self.print_with_wrap(is_responce=True,
                                                      line=f"Call {function_name}:({tool_call['function']['arguments']})")
 
-                                # print(f"It's a  Function Call!")
-                                # print(f"function_call:{function_call}")
-                                ret = DefinedFunctions[function_name](**function_args)
+                            results = self.call_functions(calls, [tool_call['id'] for tool_call in msg['tool_calls']])
+
+                            for tool_call, (function_name, _), ret in zip(msg['tool_calls'], calls, results):
                                 self.print_with_wrap(is_responce=False, line=f"Call returned: {ret}")
+                                ret = self.tool_budget.admit(self.company, function_name, ret)
                                 self.messages.append({
                                     "role": "tool",
                                     "name": function_name,
                                     "tool_call_id": tool_call['id'],
                                     "content": ret
                                 })
-                    else:
+                    elif not streamed:
                         self.print_with_wrap(is_responce=True, line=f"Response: {msg['content']}")
 
             case _:
                 raise PromptSyntaxError(f"Error Unknown company: {self.company}")
 
-
+        self.tool_budget.stub_old_results(self.company, self.messages)
         return continue_conversation
 
 
     def log_conversation(self):
-        base_name = os.path.splitext(os.path.basename(self.filename))[0]
-        logfile_name = backup_file(f"logs/{base_name}_messages.json", backup_dir='logs', extension='.json')
-        with open(logfile_name, 'w') as file:
-            json.dump(self.messages, file, indent=4)
+        """Append the new/changed messages to logs/<step>_messages.jsonl (rebuild with read_journal)"""
+        if not self.journal_messages:
+            return
+        if self.journal is None:
+            from kestep.kestep_journal import ConversationJournal
+            base_name = os.path.splitext(os.path.basename(self.filename))[0]
+            logfile_name = backup_file(f"logs/{base_name}_messages.jsonl", backup_dir='logs', extension='.jsonl')
+            self.journal = ConversationJournal(logfile_name)
+        self.journal.sync(self.messages)
+        self.journal.flush()
 
 
 
 class _PromptStatement:
 
-    def __init__(self, step: PromtpStep, msg_no: int, keyword: str, value: str):
+    def __init__(self, step: PromtpStep, msg_no: int, keyword: str, value: str, lno: int = 0):
         self.msg_no = msg_no
         self.keyword = keyword
         self.value = value
         self.step = step
+        self.lno = lno  # line number in the .prompt file
 
     def console_str(self) -> str:
         line_len = terminal_width - 14
@@ -497,8 +706,23 @@ class _PromptStatement:
     def execute(self, step: PromtpStep) -> None:
         step.print(self.console_str())
 
+    def estimate(self, step: PromtpStep) -> int:
+        """Dry run (kestep --estimate): statements only building messages execute, the others are skipped"""
+        return None
+
+    def files(self) -> tuple[list[str], list[str]]:
+        """Files (or globs) the statement reads and writes, for the step dependency graph (kestep_graph)"""
+        return [], []
+
+
+class _MessageStatement(_PromptStatement):
 
-class _Assistant(_PromptStatement):
+    def estimate(self, step: PromtpStep) -> int:
+        self.execute(step)
+        return None
+
+
+class _Assistant(_MessageStatement):
 
     def execute(self, step: PromtpStep) -> None:
         if step.debug:
@@ -553,22 +777,39 @@ class _Clear(_PromptStatement):
 
 class _Cmd(_PromptStatement):
 
-    def execute(self, step: PromtpStep) -> None:
-        """Execute a command that was defined in a prompt file (.prompt)"""
-
+    def call(self) -> tuple[str, dict[str, str]]:
+        """function name and arguments of the .cmd"""
         function_name, args = self.value.split('(', maxsplit=1)
         args = args[:-1]
         args_list = args.split(",")
         function_args = {}
 
-        if function_name == 'askuser':
+        for arg in args_list:
+            name, value = arg.split("=", maxsplit=1)
+            function_args[name] = value
+        return function_name, function_args
+
+    def files(self) -> tuple[list[str], list[str]]:
+        try:
+            function_name, function_args = self.call()
+        except ValueError:
+            return [], []
+        filename = function_args.get('filename', '').strip()
+        if function_name in ('readfile', 'readrange', 'searchfile', 'filestat') and filename:
+            return [filename], []
+        if function_name == 'writefile' and filename:
+            return [], [filename]
+        return [], []
+
+    def execute(self, step: PromtpStep) -> None:
+        """Execute a command that was defined in a prompt file (.prompt)"""
+
+        if self.value.split('(', maxsplit=1)[0] == 'askuser':
             step.print(self.console_str() + ': ', end='')
         else:
             step.print(self.console_str())
 
-        for arg in args_list:
-            name, value = arg.split("=", maxsplit=1)
-            function_args[name] = value
+        function_name, function_args = self.call()
 
         if function_name not in DefinedFunctions:
             step.print(
@@ -580,15 +821,47 @@ class _Cmd(_PromptStatement):
         except Exception as err:
             step.print(f"Error executing {function_name}({function_args})): {str(err)}")
             raise err
+        if function_name == 'writefile':
+            step.written.append(function_args['filename'])
 
         last_msg = step.messages[-1]
         last_msg['content'].append({"type": "text", "text": text})
 
 
+class _Cache(_MessageStatement):
+    # Make the last block added (by .user, .include, .cmd...) a prompt cache breakpoint
+
+    def execute(self, step: PromtpStep) -> None:
+        step.print(self.console_str())
+        if not step.messages or not isinstance(step.messages[-1]['content'], list) or not step.messages[-1]['content']:
+            raise PromptSyntaxError(".cache syntax: nothing to cache, .cache must follow the content to cache")
+        step.mark_cache(step.messages[-1]['content'][-1])
+
+
 class _Comment(_PromptStatement):
     pass
 
 
+class _Input(_PromptStatement):
+    # Declare a file (or glob) the step reads: steps writing it (.output) run before this one
+
+    def files(self) -> tuple[list[str], list[str]]:
+        return [self.value.strip()], []
+
+    def execute(self, step: PromtpStep) -> None:
+        step.print(self.console_str())
+        if not os.path.exists(self.value.strip()) and not glob.glob(self.value.strip()):
+            step.print(f"{VERTICAL} [white on red]Error: input {self.value.strip()} does not exist[/]")
+            sys.exit(9)
+
+
+class _Output(_PromptStatement):
+    # Declare a file the step writes (e.g. through writefile): steps reading it run after this one
+
+    def files(self) -> tuple[list[str], list[str]]:
+        return [], [self.value.strip()]
+
+
 class _Debug(_PromptStatement):
 
     def execute(self, step: PromtpStep) -> None:
@@ -627,12 +900,11 @@ class DotThread(threading.Thread):
 
     def run(self):
         self.is_running = True
-        self.stop_event.clear()
         self.count = 0
         while not self.stop_event.is_set():
             console.print('.', end='')
             self.count += 1
-            sleep(1)
+            self.stop_event.wait(1)     # wakes up immediately on stop()
         self.is_running = False
 
     def start(self):
@@ -640,8 +912,11 @@ class DotThread(threading.Thread):
             super(DotThread, self).start()
 
     def stop(self):
-        if self.is_running:
-            self.stop_event.set()
+        self.stop_event.set()
+
+    def join(self, timeout=None):
+        if self.ident is not None:  # never started, e.g. for quiet steps
+            super(DotThread, self).join(timeout)
 
 
 
@@ -655,83 +930,107 @@ class _Exec(_PromptStatement):
 
         continue_conversation: bool = True
         header = f"[bold white]{VERTICAL}[/]            "
+        turn = 0
         while continue_conversation:
             continue_conversation = False
-            step.make_data()
-            step.correct_messages()
-
-            if first_time:
+            turn += 1
+            if step.turn_response is not None:
+                # --resume: the response of this turn arrived before the run was interrupted, finish its tool calls
+                if not first_time:
+                    step.print(header, end='')
                 first_time = False
-                step.print(f"[bold blue underline]Requesting {step.company}::{step.model_name}", end='')
-            else:
-                step.print(f"{header}[bold blue underline]Requesting {step.company}::{step.model_name}", end='')
+                pline = f"resumed response, {len(step.tool_results)} tool calls already done"
+                step.print(f"[bold yellow]{pline:<{terminal_width - 14}}[/][bold white]{VERTICAL}[/]")
+                continue_conversation = self.respond(step, step.turn_response, header)
+                continue
+            step.span = metrics.begin('request', step, turn=turn)
+            with metrics.span('prepare', parent=step.span):
+                step.correct_messages()
+                step.make_data()
+            if not first_time:
+                step.print(header, end='')
+            first_time = False
 
-            # Create a thread to run the print_dot function in the background
-            stop_event.clear()  # Clear Signal to stop the thread
-            dot_thread = DotThread()
-            start_time = time.time()
-            elapsed_time = 0
             try:
-                dot_thread.start()  # Start the thread
-                # print(f"data={json.dumps(step.messages, indent=4)}")
-                response = requests.post(step.llm['url'], json=step.data, headers=step.header)
-            except Exception as err:
-                step.print(f"{VERTICAL} [white on red]Error during request: {str(err)}[/]\n\n")
-                step.print_exception()
-                sys.exit(9)
-
-            finally:
-                elapsed_time = time.time() - start_time
-                dot_thread.stop()# Signal the thread to stop
-                dot_thread.join()   # Wait for the thread to finish
-
-            # if the response.status is not 200 then the contents are more or less undefined.
-            if response.status_code != 200:
-                step.print(
-                    f"[bold red]Error calling {step.llm['company']}::{step.llm['model']} API: {response.status_code} {response.reason}[/bold red]")
-                step.print(f"url: {step.llm['url']}")
-                step.print("header: ", step.header)
-                # step.print("data: ", step.data)
-                d = deepcopy(step.data)
-                for msg in d['messages']:
-                    for c in msg['content']:
-                        if c['type'] == 'image':
-                            c['source']['data'] = "..."
-                step.print("data: ", json.dumps(d, indent=4))
-
-                if step.llm['response_text_is_json']:
-                    err = json.loads(response.text)
-                    step.print(f"[bold red]{err}[/bold red]")
-                else:
-                    step.print(f"[bold blue]Response from {step.llm['company']} API:[/bold blue]")
-                    step.print(response.text)
+                estimated_tokens, context_note = step.check_context()
+            except ContextOverflow as e:
+                step.print(f"[white on red]Refused {step.model_name}: {str(e)}[/]")
+                step.log_conversation()
+                exit(9)
+            step.toks_saved += step.tool_budget.removed
 
-                exit(1)
+            step.print(f"[bold blue underline]Requesting {step.company}::{step.model_name}", end='')
 
-            try:
-                response_obj = json.loads(response.text)
-            except KeyError as err:
-                step.print(f"[bold red]Json Error from {step.llm['company']} API:[/bold red]")
-                step.print(response.text)
-                exit(1)
+            self.elapsed_time = 0
+            self.ttft = None
+            self.dot_count = 0
+            self.timer = None
+            self.scheduler = None
+            self.retries = []
 
+            start_time = time.time()
+            response_obj = response_cache.get(step.llm['url'], step.data)
+            cached = response_obj is not None
+            batched = False
+            if not cached:
+                response_obj = batch_results.take(step.llm['url'], step.data)
+                batched = response_obj is not None
+            if cached or batched:
+                self.elapsed_time = time.time() - start_time
+            else:
+                response_obj = self.request(step, estimated_tokens)
+            if not cached:
+                response_cache.put(step.llm['url'], step.data, response_obj)
 
             try:
                 # Got a good response from LLM
                 usage = response_obj['usage']
+                uncached, cache_read, cache_write = input_usage(step.llm, usage)
+                toks_in = uncached + cache_read + cache_write
                 toks_out = usage[step.llm['usage_keys'][1]]
-                step.toks_in += usage[step.llm['usage_keys'][0]]
-                step.cost_in += step.toks_in * step.model['input']
+                step.toks_in += toks_in
+                step.toks_cache_read += cache_read
+                step.toks_cache_write += cache_write
+                price = step.llm.get('batch_price', 1.0) if batched else 1.0    # batches are discounted
+                step.cost_in += input_cost(step.llm, step.model, uncached, cache_read, cache_write) * price
                 step.toks_out += toks_out
-                step.cost_out += step.toks_out * step.model['output']
-                step.total += step.cost_in + step.cost_out
-
-                pline = f" {elapsed_time:.2f} secs output tokens {toks_out} at {toks_out / elapsed_time:.2f} tps"
-                used_bytes = 13 + 11 + len(step.company) + 2 + len(step.model_name) + dot_thread.count + 1
-                no_bytes_remaining = terminal_width - used_bytes
-                step.print(f"{pline:<{no_bytes_remaining}}[bold white]{VERTICAL}[/]")
-
-                continue_conversation = step.do_conversation(response_obj, header)
+                step.cost_out += toks_out * step.model['output'] * price
+                step.total = step.cost_in + step.cost_out
+                if self.scheduler:
+                    self.scheduler.settle(estimated_tokens, toks_in + toks_out)
+
+                elapsed_time = self.elapsed_time
+                if cached:
+                    pline = f" cached in {elapsed_time * 1000:.1f} msecs output tokens {toks_out}"
+                elif batched:
+                    pline = f" from batch, output tokens {toks_out}"
+                else:
+                    pline = f" {elapsed_time:.2f} secs output tokens {toks_out} at {toks_out / elapsed_time:.2f} tps"
+                if self.ttft is not None:
+                    # The "Requesting" line was closed at the first token, report on a line of our own
+                    pline = f"{pline[1:]} ttft {self.ttft:.2f} secs"
+                    step.print(f"{header}{pline:<{terminal_width - 14}}[bold white]{VERTICAL}[/]")
+                else:
+                    used_bytes = 13 + 11 + len(step.company) + 2 + len(step.model_name) + self.dot_count + 1
+                    no_bytes_remaining = terminal_width - used_bytes
+                    step.print(f"{pline:<{no_bytes_remaining}}[bold white]{VERTICAL}[/]")
+
+                if self.retries:
+                    pline = f"retried {len(self.retries)}x: {', '.join(self.retries)}"
+                    step.print(f"{header}[bold yellow]{pline:<{terminal_width - 14}}[/][bold white]{VERTICAL}[/]")
+                if context_note:
+                    step.print(f"{header}[bold yellow]{context_note:<{terminal_width - 14}}[/][bold white]{VERTICAL}[/]")
+                if step.debug:
+                    pline = f"estimated input tokens {estimated_tokens}, actual {toks_in}"
+                    step.print(f"{header}{pline:<{terminal_width - 14}}[bold white]{VERTICAL}[/]")
+                if step.debug and self.timer:
+                    step.print(f"{header}{str(self.timer):<{terminal_width - 14}}[bold white]{VERTICAL}[/]")
+
+                continue_conversation = self.respond(step, response_obj, header, streamed=self.ttft is not None)
+                metrics.end(step.span, toks_in=toks_in, toks_out=toks_out, estimated_tokens=estimated_tokens,
+                            cached=cached, batched=batched, retries=len(self.retries),
+                            **({'ttft': self.ttft} if self.ttft is not None else {}))
+                step.span = None
 
             except Exception as e:
                 step.print(f"[white on red]error while handling response:[/]")
@@ -745,111 +1044,408 @@ class _Exec(_PromptStatement):
 
         pline = f"Tokens In={step.toks_in}(${step.cost_in:06.4f}), Out={step.toks_out}(${step.cost_out:06.4f}) Total=${step.total:06.4f}"
         step.print(f"{header}{pline:<{terminal_width - 14}}[bold white]{VERTICAL}[/]")
-
+        if step.toks_cache_read or step.toks_cache_write:
+            uncached = step.toks_in - step.toks_cache_read - step.toks_cache_write
+            pline = f"Prompt cache: read={step.toks_cache_read}, write={step.toks_cache_write}, uncached={uncached}"
+            step.print(f"{header}{pline:<{terminal_width - 14}}[bold white]{VERTICAL}[/]")
+        if step.toks_saved:
+            budget = step.tool_budget
+            pline = (f"Tool results: truncated={budget.truncated}, stubbed={budget.stubbed}, "
+                     f"saved ~{step.toks_saved} input tokens")
+            step.print(f"{header}{pline:<{terminal_width - 14}}[bold white]{VERTICAL}[/]")
+
+    @staticmethod
+    def respond(step: PromtpStep, response_obj: dict[str, any], header: str, streamed: bool = False) -> bool:
+        """Add the response to the messages and run its tool calls.
+
+        Checkpointed once the response arrived and after every tool result (call_tool): resuming after the last
+        result repeats nothing, so there is no checkpoint at the end of the turn.
+        """
+        step.turn_response = response_obj
+        step.turn_messages = len(step.messages)
+        checkpoints.save(step, step.ip)
+        continue_conversation = step.do_conversation(response_obj, header, streamed=streamed)
         step.log_conversation()
+        step.turn_response = None
+        step.tool_results = {}
+        return continue_conversation
 
-class _Include(_PromptStatement):
+    def estimate(self, step: PromtpStep) -> int:
+        step.llm.setdefault('API_KEY', '')
+        step.correct_messages()
+        step.make_data()
+        return step.conversation.tokens(step.company, step.data)
+
+    def request(self, step: PromtpStep, estimated_tokens: int = 0) -> dict[str, any]:
+        """Send step.data to the LLM and return the (reassembled, when streaming) response object.
+
+        Requests are paced by the company's scheduler and retried (rate limits, overload, transport errors).
+        """
+        import httpx    # httpx is only loaded when a step sends requests
+        from kestep.kestep_http import get_client, request_timeout, PhaseTimer
+        from kestep.kestep_scheduler import get_scheduler, RetryPolicy
+
+        # Create a thread to run the print_dot function in the background
+        stop_event.clear()  # Clear Signal to stop the thread
+        dot_thread = DotThread()
+        start_time = time.time()
+        self.scheduler = get_scheduler(step.llm)
+        policy = RetryPolicy(step.llm)
+        self.retries = []
+        streaming = bool(step.data.get('stream'))
+        response_obj = None
+
+        def first_token() -> None:
+            # First streamed token: stop the dots and close the "Requesting" line
+            self.ttft = time.time() - start_time
+            dot_thread.stop()
+            dot_thread.join()
+            used = 13 + 11 + len(step.company) + 2 + len(step.model_name) + dot_thread.count + 1
+            step.print(f"{f' first token {self.ttft:.2f} secs':<{terminal_width - used}}[bold white]{VERTICAL}[/]")
+
+        try:
+            if not step.quiet:
+                dot_thread.start()  # Start the thread
+            # print(f"data={json.dumps(step.messages, indent=4)}")
+            client = get_client(step.llm['url'])
+            with metrics.span('serialize', parent=step.span) as span:
+                body = step.conversation.body(step.data)
+                if span:
+                    span.attrs['bytes'] = len(body)
+            attempt = 0
+            while True:
+                self.scheduler.acquire(estimated_tokens)
+                start_time = time.time()    # elapsed time and ttft are those of the last attempt
+                self.timer = PhaseTimer()
+                try:
+                    with client.stream('POST', step.llm['url'], content=body, headers=step.header,
+                                       timeout=request_timeout(step.llm), extensions={'trace': self.timer}) as response:
+                        self.scheduler.observe(response.headers)
+                        if streaming and response.status_code == 200:
+                            stream = make_stream(step.llm['stream_format'], on_text=step.print_stream_text,
+                                                 on_first_token=first_token)
+                            response_obj = stream.consume(response.iter_lines())
+                            step.flush_stream_text()
+                        else:
+                            response.read()
+                except httpx.TransportError as err:
+                    # Only retried while nothing was received, a broken stream was already (partly) printed
+                    if self.ttft is not None:
+                        raise
+                    self.scheduler.settle(estimated_tokens, 0)     # the attempt used no tokens
+                    if attempt >= policy.max_retries:
+                        raise
+                    delay = self.scheduler.retry_delay(attempt, policy)
+                    self.retries.append(f"{type(err).__name__} +{delay:.1f}s")
+                    attempt += 1
+                    continue
+
+                if response.status_code != 200:
+                    self.scheduler.settle(estimated_tokens, 0)     # refused, the tokens were not used
+                if response.status_code in policy.status and attempt < policy.max_retries:
+                    delay = self.scheduler.retry_delay(attempt, policy, response.headers)
+                    self.retries.append(f"{response.status_code} +{delay:.1f}s")
+                    attempt += 1
+                    continue
+                break
+
+        except Exception as err:
+            step.print(f"{VERTICAL} [white on red]Error during request: {str(err)}[/]\n\n")
+            step.print_exception()
+            sys.exit(9)
+
+        finally:
+            self.elapsed_time = time.time() - start_time
+            dot_thread.stop()# Signal the thread to stop
+            dot_thread.join()   # Wait for the thread to finish
+            self.dot_count = dot_thread.count
+            for phase, started, duration in self.timer.intervals if metrics.enabled and self.timer else []:
+                metrics.record(phase, started, duration, parent=step.span, http_version=self.timer.http_version or '')
+
+        # if the response.status is not 200 then the contents are more or less undefined.
+        if response.status_code != 200:
+            step.print(
+                f"[bold red]Error calling {step.llm['company']}::{step.llm['model']} API: {response.status_code} {response.reason_phrase}[/bold red]")
+            step.print(f"url: {step.llm['url']}")
+            step.print("header: ", step.header)
+            # step.print("data: ", step.data)
+            d = deepcopy(step.data)
+            for msg in d['messages']:
+                for c in msg['content'] if isinstance(msg.get('content'), list) else []:
+                    if c.get('type') == 'image':
+                        c['source']['data'] = "..."
+            step.print("data: ", json.dumps(d, indent=4))
+
+            if step.llm['response_text_is_json']:
+                err = json.loads(response.text)
+                step.print(f"[bold red]{err}[/bold red]")
+            else:
+                step.print(f"[bold blue]Response from {step.llm['company']} API:[/bold blue]")
+                step.print(response.text)
+
+            exit(1)
+
+        if response_obj is None:
+            try:
+                with metrics.span('decode', parent=step.span):
+                    response_obj = json.loads(response.content)
+            except ValueError as err:
+                step.print(f"[bold red]Json Error from {step.llm['company']} API:[/bold red]")
+                step.print(response.text)
+                exit(1)
+
+        return response_obj
+
+class _Include(_MessageStatement):
     # Read a file and add its content to last_msg
 
+    def files(self) -> tuple[list[str], list[str]]:
+        return [self.value.strip()], []
+
     def execute(self, step: PromtpStep) -> None:
         step.print(self.console_str())
         lines = readfile(filename=self.value)
         last_msg = step.messages[-1]
 
-        last_text = last_msg['content']
-        last_msg['content'].append({"type":"text","text": lines})
+        block = {"type": "text", "text": lines}
+        last_msg['content'].append(block)
+        if text_tokens(step.company, len(lines)) >= CACHE_MIN_TOKENS:
+            step.mark_cache(block)
+
 
+class _Image(_MessageStatement):
+    # Add an image, or all images matching a glob, as a user message: downscaled to the company's limits,
+    # recompressed and base64 encoded in parallel, the encoded result cached in .kestep/images
 
-class _Image(_PromptStatement):
-    # Read an Image file and add its content to last_msg
+    def files(self) -> tuple[list[str], list[str]]:
+        return [self.value.strip()], []
 
     def execute(self, step: PromtpStep) -> None:
         step.print(self.console_str())
-        filename = self.value
-        """ Read a binary file from local disk and encode it as base64."""
+        header = f"[bold white]{VERTICAL}[/]            "
+        paths = [self.value] if os.path.exists(self.value) else sorted(glob.glob(self.value))
         try:
-            with open(filename, 'rb') as file:
-                file_contents = base64.b64encode(file.read()).decode()
-            media_type, _ = mimetypes.guess_type(filename)
-
+            if not paths:
+                raise FileNotFoundError(f"No such file: '{self.value}'")
+            images = encode_images(paths, image_limits(step.llm))
         except Exception as err:
             console.print(f"Error accessing file: {str(err)}\n\n")
             console.print_exception()
             sys.exit(9)
 
-
-        if self.step.company == 'Anthropic':
-            sub_message = {
-                "type": "image",
-                "source":{
-                    "type": "base64",
-                    "media_type": media_type,
-                    "data": f"{file_contents}"
+        content = []
+        for image in images:
+            if self.step.company == 'Anthropic':
+                content.append({
+                    "type": "image",
+                    "source": {
+                        "type": "base64",
+                        "media_type": image.media_type,
+                        "data": image.data
                     }
-                }
-        # elif self.step.company == 'XAI':
-        else:
-            sub_message = {
-                "type": "image_url",
-                "image_url": {
-                    "detail": "high",
-                    "url": f"data:image/{media_type};base64,{file_contents}"
-                }
-            }
+                })
+            else:
+                content.append({
+                    "type": "image_url",
+                    "image_url": {
+                        "detail": "high",
+                        "url": f"data:{image.media_type};base64,{image.data}"
+                    }
+                })
+            if len(images) > 1 or image.sent_bytes != image.original_bytes:
+                pline = f"{os.path.basename(image.path)}: {image.original_bytes} -> {image.sent_bytes} bytes"
+                step.print(f"{header}{pline + (' (cached)' if image.cached else ''):<{terminal_width - 14}}"
+                           f"[bold white]{VERTICAL}[/]")
 
-        step.messages.append({"role": "user", "content": [sub_message]})
+        step.messages.append({"role": "user", "content": content})
+        step.mark_cache(content[-1])
 
 
 class _Llm(_PromptStatement):
 
-    def execute(self, step: PromtpStep) -> None:
-        step.print(self.console_str())
+    def parameters(self, step: PromtpStep) -> dict[str, any]:
+        if step.llm:
+            raise (PromptSyntaxError(f".llm syntax: only one .lls statement allowed in step {step.filename
+            }"))
+
+        if self.value[0] != '{':
+            self.value = "{" + self.value + "}"
+
         try:
-            if step.llm:
-                raise (PromptSyntaxError(f".llm syntax: only one .lls statement allowed in step {step.filename
-                }"))
+            parms = json.loads(self.value)
+        except Exception as e:
+            step.print(f"{VERTICAL} [white on red]Error parsing .llm parameters: {str(e)}[/]\n\n")
+            step.print_exception()
+            sys.exit(9)
 
-            if self.value[0] != '{':
-                self.value = "{" + self.value + "}"
+        if not isinstance(parms, dict):
+            raise (PromptSyntaxError(
+                f".llm syntax: parameters expected dict, but got {type(parms).__name__}: {self.value}"))
 
-            try:
-                parms = json.loads(self.value)
-            except Exception as e:
-                step.print(f"{VERTICAL} [white on red]Error parsing .llm parameters: {str(e)}[/]\n\n")
-                step.print_exception()
-                sys.exit(9)
+        if 'model' not in parms:
+            raise (PromptSyntaxError(f".llm syntax:  'model' parameter is required but missing {self.value}"))
 
-            if not isinstance(parms, dict):
-                raise (PromptSyntaxError(
-                    f".llm syntax: parameters expected dict, but got {type(parms).__name__}: {self.value}"))
+        return parms
 
-            if 'model' not in parms:
-                raise (PromptSyntaxError(f".llm syntax:  'model' parameter is required but missing {self.value}"))
+    def estimate(self, step: PromtpStep) -> int:
+        step.load_llm(self.parameters(step))    # no key, no connection
+        return None
 
-            step.load_llm(parms)
+    def execute(self, step: PromtpStep) -> None:
+        step.print(self.console_str())
+        try:
+            step.load_llm(self.parameters(step))
+            from kestep.kestep_http import prewarm
+            prewarm(step.llm['url'])    # open the connection while we fetch the key and build the messages
 
         except Exception as err:
             step.print_exception()
             sys.exit(9)
 
         # Now we that we have loaded the LLM,  we will load the API_KEY
-        try:
+        load_api_key(step)
+
+
+def load_api_key(step: PromtpStep) -> None:
+    """step.llm['API_KEY'] from the keyring, asking the user when it has none"""
+    import keyring
+    try:
+        api_key = keyring.get_password('kestep', username=step.llm['api_key'])
+    except keyring.errors.PasswordDeleteError:
+        step.print(f"[bold red]Error accessing keyring ('kestep', username={step.llm['api_key']})[/bold red]")
+        api_key = None
+
+    if api_key is None:
+        with key_lock:  # Steps running in parallel must not prompt at the same time
             api_key = keyring.get_password('kestep', username=step.llm['api_key'])
-        except keyring.errors.PasswordDeleteError:
-            step.print(f"[bold red]Error accessing keyring ('kestep', username={step.llm['api_key']})[/bold red]")
-            api_key = None
-
-        if api_key is None:
-            api_key = console.input(f"Please enter your {step.llm['company']} API key: ")
-            keyring.set_password("kestep", username=step.llm['api_key'], password=api_key)
-        if not api_key:
-            step.print("[bold red]API key cannot be empty.[/bold red]")
-            sys.exit(1)
+            if api_key is None:
+                api_key = console.input(f"Please enter your {step.llm['company']} API key: ")
+                keyring.set_password("kestep", username=step.llm['api_key'], password=api_key)
+    if not api_key:
+        step.print("[bold red]API key cannot be empty.[/bold red]")
+        sys.exit(1)
+
+    step.llm['API_KEY'] = api_key
+
+
+class _Map(_PromptStatement):
+    # Run the instructions (the last .user) against each chunk of a file, then collect the answers for a reduce:
+    #   .map big.log
+    #   .map {"file": "big.log", "chunk_tokens": 20000, "jobs": 4, "reduce": "Merge the answers below"}
+    # The instructions are replaced by a user message holding the answers (after the reduce text), so the
+    # next .user/.exec merges the results.
+
+    def files(self) -> tuple[list[str], list[str]]:
+        value = self.value.strip()
+        try:
+            return [json.loads(value)['file'] if value.startswith('{') else value], []
+        except (ValueError, KeyError, TypeError):
+            return [], []
+
+    def parameters(self, step: PromtpStep) -> dict[str, any]:
+        value = self.value.strip()
+        if value.startswith('{'):
+            try:
+                parms = json.loads(value)
+            except ValueError as e:
+                raise PromptSyntaxError(f".map syntax: {str(e)}: {value}")
+        else:
+            parms = {'file': value}
+        if not isinstance(parms, dict) or not parms.get('file'):
+            raise PromptSyntaxError(f".map syntax: a file to map is required: {value}")
+        if not step.llm:
+            raise PromptSyntaxError(".map syntax: .llm must come before .map")
+        step.correct_messages()
+        if not step.messages or step.messages[-1]['role'] != 'user':
+            raise PromptSyntaxError(".map syntax: .map must follow the instructions (.user) to run on each part")
+        return parms
+
+    def chunk_tokens(self, step: PromtpStep, parms: dict[str, any]) -> int:
+        """.map chunk_tokens, else half of the context left by the instructions (the rest is for the answer)"""
+        if 'chunk_tokens' in parms:
+            return int(parms['chunk_tokens'])
+        instructions = step.conversation.tokens(step.company, {'messages': step.messages})
+        return max(MIN_CHUNK_TOKENS, (int(step.model['context']) - instructions) // 2)
+
+    def part_messages(self, step: PromtpStep, text: str, part: int, parts: int, filename: str) -> list[dict]:
+        """The step's messages with the part appended to the instructions, sharing nothing that changes"""
+        messages = [{**msg, 'content': list(msg['content'])} for msg in step.messages]
+        messages[-1]['content'].append({"type": "text", "text": f"Part {part} of {parts} of {filename}:\n{text}"})
+        return messages
+
+    def map_part(self, step: PromtpStep, data, bounds: tuple[int, int], part: int, parts: int,
+                 filename: str) -> dict[str, any]:
+        """Request one part as a quiet step of its own, returns its answer and token counts (not the step,
+        whose messages hold the part)"""
+        child = PromtpStep(f"{step.filename}#{part}", quiet=True)
+        for attr in ('llm', 'model', 'model_name', 'company', 'system_value', 'vdict', 'trace_id'):
+            setattr(child, attr, getattr(step, attr))
+        child.journal_messages = False
+        child.checkpointing = False
+        child.tool_budget = ToolBudget(step.llm)
+        start, end = bounds
+        child.messages = self.part_messages(step, data[start:end].decode('utf-8', errors='replace'), part, parts,
+                                            filename)
+        try:
+            _Exec(child, self.msg_no, '.exec', '', self.lno).execute(child)
+        except SystemExit:
+            step.print(child.console.export_text())
+            raise
+        return {'answer': response_text(child.messages), **{k: getattr(child, k) for k in MAP_PART_FIELDS}}
+
+    @staticmethod
+    def collect(running: dict, results: list[dict[str, any]], return_when: str) -> None:
+        """Wait for running parts, moving the finished ones' results to results (raising their errors)"""
+        done, _ = wait(running, return_when=return_when)
+        for future in done:
+            results[running.pop(future)] = future.result()
+
+    def execute(self, step: PromtpStep) -> None:
+        step.print(self.console_str())
+        parms = self.parameters(step)
+        filename = parms['file']
+        header = f"[bold white]{VERTICAL}[/]            "
+
+        with open_mapped(filename) as data:
+            bounds = list(chunk_bounds(data, chunk_bytes(step.company, self.chunk_tokens(step, parms))))
+            jobs = max(1, int(parms.get('jobs', MAP_WORKERS)))
+            results: list[dict[str, any]] = [{}] * len(bounds)
+            # at most jobs parts submitted at a time, each one's chunk dropped as soon as it is answered
+            with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='map') as pool:
+                running = {}
+                for part, item in enumerate(bounds):
+                    if len(running) >= jobs:
+                        self.collect(running, results, FIRST_COMPLETED)
+                    future = pool.submit(self.map_part, step, data, item, part + 1, len(bounds), filename)
+                    running[future] = part
+                while running:
+                    self.collect(running, results, FIRST_COMPLETED)
+
+        blocks = [{"type": "text", "text": parms['reduce']}] if parms.get('reduce') else []
+        for part, ((start, end), result) in enumerate(zip(bounds, results), start=1):
+            for attr in MAP_PART_FIELDS:
+                setattr(step, attr, getattr(step, attr) + result[attr])
+            pline = f"part {part}/{len(bounds)} bytes {start}-{end}: tokens in={result['toks_in']}, " \
+                    f"out={result['toks_out']}"
+            step.print(f"{header}{pline:<{terminal_width - 14}}[bold white]{VERTICAL}[/]")
+            blocks.append({"type": "text", "text": f"Answer for part {part} of {len(bounds)} of {filename}:\n"
+                                                   f"{result['answer']}"})
+        step.total = step.cost_in + step.cost_out
+        step.messages[-1] = {"role": "user", "content": blocks}
+        step.log_conversation()
 
-        step.llm['API_KEY'] = api_key
+    def estimate(self, step: PromtpStep) -> list[int]:
+        """Input tokens of the part requests (their answers are unknown, the reduce gets none)"""
+        parms = self.parameters(step)
+        instructions = step.conversation.tokens(step.company, {'messages': step.messages})
+        with open_mapped(parms['file']) as data:
+            bounds = list(chunk_bounds(data, chunk_bytes(step.company, self.chunk_tokens(step, parms))))
+        tokens = [instructions + text_tokens(step.company, end - start) for start, end in bounds]
+        step.messages[-1] = {"role": "user", "content": []}
+        return tokens
 
 
-class _System(_PromptStatement):
+class _System(_MessageStatement):
 
     def execute(self, step: PromtpStep) -> None:
         step.print(self.console_str())
@@ -857,7 +1453,7 @@ class _System(_PromptStatement):
         # step.messages.append({'role': 'system', 'content': self.value})
 
 
-class _User(_PromptStatement):
+class _User(_MessageStatement):
 
     def execute(self, step: PromtpStep) -> None:
         step.print(self.console_str())
@@ -872,19 +1468,23 @@ class _User(_PromptStatement):
 StatementTypes: dict[str, type(_PromptStatement)] = {
     '.#': _Comment,
     '.assistant': _Assistant,
+    '.cache': _Cache,
     '.clear': _Clear,
     '.cmd': _Cmd,
     '.debug': _Debug,
     '.exec': _Exec,
     '.image': _Image,
     '.include': _Include,
+    '.input': _Input,
     '.system': _System,
     '.user': _User,
     '.llm': _Llm,
+    '.map': _Map,
+    '.output': _Output,
 }
 
 keywords = StatementTypes.keys()
 
-def make_statement(step: PromtpStep, msg_no: int, keyword: str, value: str) -> _PromptStatement:
+def make_statement(step: PromtpStep, msg_no: int, keyword: str, value: str, lno: int = 0) -> _PromptStatement:
     my_class = StatementTypes[keyword]
-    return my_class(step, msg_no, keyword, value)
+    return my_class(step, msg_no, keyword, value, lno)
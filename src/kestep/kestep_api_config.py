@@ -1,3 +1,15 @@
+import json
+import os
+
+# Optional settings, per company here or per step on the .llm line:
+#   rpm, tpm                     requests/tokens per minute to pace requests to (kestep_scheduler)
+#   max_retries, backoff_base, backoff_max
+#   connect_timeout, read_timeout (seconds)
+#   max_tokens: output tokens of a response (Anthropic default: the model's max_output), kept free of input
+#       by the context_policy check
+#   image_max_side, image_max_short_side, image_max_pixels: .image downscaling targets (kestep_images),
+#       about where the provider downscales anyway, so sending more only costs upload time
+#   tool_result_tokens, tool_step_tokens, tool_result_window: caps of tool results (kestep_budget)
 api_config = {
     "OpenAI": {
         "company": "OpenAI",
@@ -11,6 +23,14 @@ api_config = {
         "system_role": "system",
         "messages_keys": ["choices",0,"message"],
         "messages_multiple": False,
+        "stream_format": "openai",
+        "stream_options": {"include_usage": True},
+        "cache_read_keys": ["prompt_tokens_details", "cached_tokens"],  # automatic prompt caching
+        "cached_in_input": True,
+        "cache_read_price": 0.5,
+        "batch_price": 0.5,
+        "image_max_side": 2048,     # "detail": "high" fits 2048x2048, then 768 on the short side
+        "image_max_short_side": 768,
     },
     "XAI": {
         "company": "XAI",
@@ -25,6 +45,8 @@ api_config = {
         "system_role": "user",
         "messages_keys": ["choices", 0, "message"],
         "messages_multiple": False,
+        "stream_format": "openai",
+        "image_max_side": 2048,
     },
     "MistralAI": {
         "company": "MistralAI",
@@ -38,6 +60,8 @@ api_config = {
         "system_role": "system",
         "messages_keys": ["choices", 0, "message"],
         "messages_multiple": False,
+        "stream_format": "openai",
+        "image_max_side": 1540,
     },
     "Anthropic": {
         "company": "Anthropic",
@@ -51,6 +75,29 @@ api_config = {
         "system_role": "system",
         # "messages_keys": ["content"],
         # "messages_multiple": True,
+        "stream_format": "anthropic",
+        "prompt_cache": True,   # place cache_control breakpoints, .llm "prompt_cache": false to turn off
+        "cache_read_keys": ["cache_read_input_tokens"],
+        "cache_write_keys": ["cache_creation_input_tokens"],
+        "cached_in_input": False,
+        "cache_read_price": 0.1,
+        "cache_write_price": 1.25,
+        "batch_price": 0.5,
+        "image_max_side": 1568,
+        "image_max_pixels": 1150000,
     }
 }
 
+
+
+_models_config: dict[str, any] = None
+
+
+def get_models_config() -> dict[str, any]:
+    """The model catalog (kestep_models.json), loaded on first use"""
+    global _models_config
+    if _models_config is None:
+        json_path = os.path.join(os.path.dirname(__file__), 'kestep_models.json')
+        with open(json_path, "r") as json_file:
+            _models_config = json.load(json_file)
+    return _models_config
@@ -0,0 +1,277 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from rich.console import Console
+
+from kestep.kestep_cache import request_key, TRANSPORT_FIELDS
+from kestep.kestep_util import KESTEP_DIR
+
+console = Console()
+
+BATCH_DIR = os.path.join(KESTEP_DIR, 'batches')
+
+POLL_INTERVAL = 10.0        # seconds, growing by half every poll
+MAX_POLL_INTERVAL = 300.0
+
+
+class BatchResults:
+    """Responses of finished batches, waiting in directory/<request key>.json for their step to run.
+
+    A step's .exec takes (and removes) the response of its request instead of sending it.
+    """
+
+    def __init__(self, directory: str = os.path.join(BATCH_DIR, 'results')):
+        self.directory = directory
+        self.enabled = False
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def has(self, key: str) -> bool:
+        return os.path.exists(self.path(key))
+
+    def put(self, key: str, response_obj: dict[str, any]) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{self.path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(response_obj, file)
+        os.replace(tmp_path, self.path(key))
+
+    def take(self, url: str, data: dict[str, any]) -> Optional[dict[str, any]]:
+        if not self.enabled:
+            return None
+        path = self.path(request_key(url, data))
+        try:
+            with open(path, 'r') as file:
+                response_obj = json.load(file)
+            os.remove(path)
+        except (OSError, ValueError):
+            return None
+        return response_obj
+
+
+# The process wide store, enabled by --batch
+batch_results = BatchResults()
+
+
+class PreparedRequest:
+    """The first request of a step, as its .exec would send it"""
+
+    def __init__(self, filename: str, company: str, url: str, api_key: str, data: dict[str, any]):
+        self.filename = filename
+        self.company = company
+        self.url = url
+        self.api_key = api_key      # keyring username of the key, never the key itself
+        self.body = {k: v for k, v in data.items() if k not in TRANSPORT_FIELDS}   # batches do not stream
+        self.key = request_key(url, data)
+
+
+def prepare_step(step_file: str) -> Optional[PreparedRequest]:
+    """Run a step up to its first .exec, None if it has no request a batch can carry"""
+    from kestep.kestep import PromtpStep
+
+    step = PromtpStep(step_file, quiet=True)
+    try:
+        step.parse_prompt()
+        data = step.prepare_batch()
+    except (SystemExit, Exception) as e:
+        console.print(f"{os.path.basename(step_file)}: [bold yellow]not batched, {str(e) or 'error'}[/]")
+        return None
+    if data is None or step.company not in BATCH_APIS:
+        return None
+    return PreparedRequest(step_file, step.company, step.llm['url'], step.llm['api_key'], data)
+
+
+def api_header(company: str, api_key: str) -> dict[str, str]:
+    import keyring
+    key = keyring.get_password('kestep', username=api_key)
+    if company == 'Anthropic':
+        return {"anthropic-version": "2023-06-01", "x-api-key": f"{key}"}
+    return {"Authorization": f"Bearer {key}"}
+
+
+class OpenAIBatches:
+    """/v1/files + /v1/batches, the requests travel as an uploaded JSONL file"""
+
+    @staticmethod
+    def root(url: str) -> str:
+        return url[:url.index('/v1/') + 3]
+
+    def submit(self, client, url: str, header: dict, requests: dict[str, dict]) -> str:
+        endpoint = url[url.index('/v1/'):]
+        lines = ''.join(json.dumps({"custom_id": custom_id, "method": "POST", "url": endpoint, "body": body}) + '\n'
+                        for custom_id, body in requests.items())
+        response = client.post(f"{self.root(url)}/files", headers=header, data={"purpose": "batch"},
+                               files={"file": ("kestep_batch.jsonl", lines.encode('utf-8'), "application/jsonl")})
+        response.raise_for_status()
+        response = client.post(f"{self.root(url)}/batches", headers=header,
+                               json={"input_file_id": response.json()['id'], "endpoint": endpoint,
+                                     "completion_window": "24h"})
+        response.raise_for_status()
+        return response.json()['id']
+
+    def status(self, client, url: str, header: dict, batch_id: str) -> tuple[bool, str, dict]:
+        response = client.get(f"{self.root(url)}/batches/{batch_id}", headers=header)
+        response.raise_for_status()
+        info = response.json()
+        counts = info.get('request_counts') or {}
+        status = f"{info['status']} {counts.get('completed', 0)}/{counts.get('total', '?')}"
+        return info['status'] in ('completed', 'failed', 'expired', 'cancelled'), status, info
+
+    def results(self, client, url: str, header: dict, info: dict):
+        if not info.get('output_file_id'):
+            return
+        response = client.get(f"{self.root(url)}/files/{info['output_file_id']}/content", headers=header)
+        response.raise_for_status()
+        for line in response.text.splitlines():
+            if line.strip():
+                result = json.loads(line)
+                reply = result.get('response') or {}
+                if reply.get('status_code') == 200:
+                    yield result['custom_id'], reply['body']
+
+
+class AnthropicBatches:
+    """Message Batches: /v1/messages/batches"""
+
+    def submit(self, client, url: str, header: dict, requests: dict[str, dict]) -> str:
+        response = client.post(f"{url}/batches", headers=header,
+                               json={"requests": [{"custom_id": custom_id, "params": body}
+                                                  for custom_id, body in requests.items()]})
+        response.raise_for_status()
+        return response.json()['id']
+
+    def status(self, client, url: str, header: dict, batch_id: str) -> tuple[bool, str, dict]:
+        response = client.get(f"{url}/batches/{batch_id}", headers=header)
+        response.raise_for_status()
+        info = response.json()
+        counts = info.get('request_counts') or {}
+        status = f"{info['processing_status']} {counts.get('succeeded', 0)} succeeded, {counts.get('processing', 0)} processing"
+        return info['processing_status'] == 'ended', status, info
+
+    def results(self, client, url: str, header: dict, info: dict):
+        response = client.get(info['results_url'], headers=header)
+        response.raise_for_status()
+        for line in response.text.splitlines():
+            if line.strip():
+                result = json.loads(line)
+                if result['result']['type'] == 'succeeded':
+                    yield result['custom_id'], result['result']['message']
+
+
+BATCH_APIS = {'OpenAI': OpenAIBatches(), 'Anthropic': AnthropicBatches()}
+
+
+class BatchJob:
+    """A submitted batch, persisted in BATCH_DIR/<id>.json until its results are collected"""
+
+    def __init__(self, state: dict[str, any], directory: str = BATCH_DIR):
+        self.state = state
+        self.directory = directory
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.directory, f"{self.state['id']}.json")
+
+    def save(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        with open(f"{self.path}.tmp", 'w') as file:
+            json.dump(self.state, file, indent=4)
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def remove(self) -> None:
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def load_jobs(directory: str = BATCH_DIR) -> list[BatchJob]:
+    jobs = []
+    if os.path.isdir(directory):
+        for entry in sorted(os.scandir(directory), key=lambda e: e.name):
+            if entry.is_file() and entry.name.endswith('.json'):
+                with open(entry.path, 'r') as file:
+                    jobs.append(BatchJob(json.load(file), directory))
+    return jobs
+
+
+def submit_batches(step_files: list[str], jobs: int = None, directory: str = BATCH_DIR) -> list[BatchJob]:
+    """Prepare the steps and submit the first requests not already answered or in a pending batch.
+
+    Returns all pending batches, the ones found in directory (an interrupted run) included.
+    """
+    from kestep.kestep_http import get_client
+
+    pending = load_jobs(directory)
+    submitted = {custom_id for job in pending for custom_id in job.state['requests']}
+
+    with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='prepare') as executor:
+        prepared = [p for p in executor.map(prepare_step, step_files) if p is not None]
+
+    groups: dict[tuple[str, str, str], dict[str, PreparedRequest]] = {}
+    for p in prepared:
+        if p.key in submitted or batch_results.has(p.key):
+            continue
+        groups.setdefault((p.company, p.url, p.api_key), {})[p.key] = p    # identical requests go once
+
+    for (company, url, api_key), requests in groups.items():
+        header = api_header(company, api_key)
+        batch_id = BATCH_APIS[company].submit(get_client(url), url, header,
+                                              {key: p.body for key, p in requests.items()})
+        job = BatchJob({"id": batch_id, "company": company, "url": url, "api_key": api_key,
+                        "submitted": time.time(), "status": "submitted",
+                        "requests": {key: p.filename for key, p in requests.items()}}, directory)
+        job.save()
+        pending.append(job)
+        console.print(f"Batch {batch_id} ({company}): submitted {len(requests)} requests")
+
+    return pending
+
+
+def wait_for_batches(pending: list[BatchJob], poll_interval: float = POLL_INTERVAL,
+                     max_poll_interval: float = MAX_POLL_INTERVAL) -> int:
+    """Poll the batches with growing intervals, storing the results as they end.  Returns the responses stored."""
+    from kestep.kestep_http import get_client
+
+    stored = 0
+    interval = poll_interval
+    pending = list(pending)
+    while pending:
+        for job in list(pending):
+            state = job.state
+            api, url = BATCH_APIS[state['company']], state['url']
+            header = api_header(state['company'], state['api_key'])
+            done, status, info = api.status(get_client(url), url, header, state['id'])
+            if status != state['status']:
+                console.print(f"Batch {state['id']} ({state['company']}): {status}")
+                state['status'] = status
+                job.save()
+            if done:
+                for custom_id, response_obj in api.results(get_client(url), url, header, info):
+                    if custom_id in state['requests']:
+                        batch_results.put(custom_id, response_obj)
+                        stored += 1
+                job.remove()
+                pending.remove(job)
+        if pending:
+            time.sleep(interval)
+            interval = min(max_poll_interval, interval * 1.5)
+    return stored
+
+
+def run_batches(step_files: list[str], jobs: int = None) -> None:
+    """--batch: the first request of every step goes through the provider's batch API.
+
+    Interrupting kestep while waiting is safe, running the same command again resumes polling.
+    The steps are then executed as usual, their first .exec answered from the batch results.
+    """
+    batch_results.enabled = True
+    pending = submit_batches(step_files, jobs)
+    if pending:
+        stored = wait_for_batches(pending)
+        console.print(f"Batch results: {stored} responses")
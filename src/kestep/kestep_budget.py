@@ -0,0 +1,107 @@
+from kestep.kestep_tokens import CHARS_PER_TOKEN, DEFAULT_CHARS_PER_TOKEN, MESSAGE_TOKENS, is_tool_result, \
+    message_tokens, text_tokens
+
+STEP_FLOOR_TOKENS = 256     # still admitted of a result once the step budget is spent
+STUB_MIN_TOKENS = 200       # old results smaller than this are kept, a stub would not save much
+
+
+def truncated_text(company: str, text: str, tokens: int) -> str:
+    """Head and tail of text fitting in about tokens, with a marker saying how much was elided"""
+    chars = int(tokens * CHARS_PER_TOKEN.get(company, DEFAULT_CHARS_PER_TOKEN))
+    head, tail = text[:chars // 2], text[len(text) - chars // 2:]
+    elided = text_tokens(company, len(text) - len(head) - len(tail))
+    return (f"{head}\n[... kestep: {elided} tokens of tool output elided, use readrange or searchfile "
+            f"for the rest ...]\n{tail}")
+
+
+def stub_text(tokens: int) -> str:
+    return f"[kestep: {tokens} tokens of tool output removed after use, call the tool again if needed]"
+
+
+class ToolBudget:
+    """Post-processing of the tool results of a step before they enter its messages.
+
+    .llm settings, all off unless set:
+      tool_result_tokens  cap of one result, an int or {"<tool name>": tokens, "*": default}
+      tool_step_tokens    cap of all the results of the step, later results get the rest (at least 256 tokens)
+      tool_result_window  keep the results of the last n tool turns, earlier ones the model has answered
+                          become short stubs (this rewrites history: the prompt cache is read up to the stub)
+
+    Results over their cap keep their head and tail.  removed is the tokens currently kept out of the history,
+    which every later request does not send.
+    """
+
+    def __init__(self, llm: dict[str, any]):
+        limits = llm.get('tool_result_tokens')
+        self.limits = limits if isinstance(limits, dict) else {'*': limits}
+        self.step_tokens = llm.get('tool_step_tokens')
+        self.window = llm.get('tool_result_window')
+        self.used = 0       # tokens of the results admitted
+        self.removed = 0
+        self.truncated = 0
+        self.stubbed = 0
+
+    def limit(self, name: str) -> int:
+        limit = self.limits.get(name, self.limits.get('*'))
+        if self.step_tokens is not None:
+            left = max(STEP_FLOOR_TOKENS, int(self.step_tokens) - self.used)
+            limit = left if limit is None else min(int(limit), left)
+        return limit
+
+    def admit(self, company: str, name: str, result: any) -> any:
+        """The result as it goes into the messages"""
+        if not isinstance(result, str):
+            return result
+        tokens = text_tokens(company, len(result))
+        limit = self.limit(name)
+        if limit is not None and tokens > int(limit):
+            result = truncated_text(company, result, int(limit))
+            self.removed += max(0, tokens - text_tokens(company, len(result)))
+            self.truncated += 1
+        self.used += text_tokens(company, len(result))
+        return result
+
+    def stub_old_results(self, company: str, messages: list[dict]) -> int:
+        """Apply tool_result_window, returns the tokens removed.  Messages are replaced, not modified."""
+        if self.window is None:
+            return 0
+        turns = []      # indexes of the messages of each tool turn
+        for idx, msg in enumerate(messages):
+            if isinstance(msg, dict) and is_tool_result(company, msg):
+                if turns and turns[-1][-1] == idx - 1:
+                    turns[-1].append(idx)
+                else:
+                    turns.append([idx])
+        answered = max((idx for idx, msg in enumerate(messages) if msg.get('role') == 'assistant'), default=-1)
+        old = turns[:max(0, len(turns) - int(self.window))]
+
+        saved = 0
+        for idx in (idx for turn in old for idx in turn if idx < answered):
+            msg = messages[idx]
+            if company == 'Anthropic':
+                blocks, changed = [], False
+                for block in msg['content']:
+                    if block.get('type') == 'tool_result':
+                        block, tokens = self.stub(company, block)
+                        saved += tokens
+                        changed = changed or bool(tokens)
+                    blocks.append(block)
+                if changed:
+                    messages[idx] = {**msg, 'content': blocks}
+            else:
+                messages[idx], tokens = self.stub(company, msg)
+                saved += tokens
+        self.removed += saved
+        return saved
+
+    def stub(self, company: str, item: dict) -> tuple[dict, int]:
+        """item (a tool message or tool_result block) with its content stubbed, and the tokens saved"""
+        content = item.get('content')
+        if isinstance(content, str) and content.startswith('[kestep:'):
+            return item, 0
+        tokens = message_tokens(company, content) - MESSAGE_TOKENS
+        if tokens < STUB_MIN_TOKENS:
+            return item, 0
+        note = stub_text(tokens)
+        self.stubbed += 1
+        return {**item, 'content': note}, tokens - text_tokens(company, len(note))
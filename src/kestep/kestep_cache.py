@@ -0,0 +1,147 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Optional
+
+from kestep.kestep_util import KESTEP_DIR
+
+CACHE_MODES = ['read', 'write', 'off']
+
+# Request fields that change how the response is delivered, not what it contains
+TRANSPORT_FIELDS = ['stream', 'stream_options']
+
+
+def request_key(url: str, data: dict[str, any]) -> str:
+    """Stable hash of a request: the canonical json of step.data plus the endpoint.
+
+    Headers (and with them the API key) are never part of step.data, so never part of the key.
+    """
+    canonical = {k: v for k, v in data.items() if k not in TRANSPORT_FIELDS}
+    blob = json.dumps([url, canonical], sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """Content addressed on-disk cache of LLM responses.
+
+    mode 'read':  serve cached responses, record the misses
+    mode 'write': always call the LLM, (re)record every response
+    mode 'off':   no cache
+
+    Entries live in directory/<2 hex>/<sha256>.json, reading an entry bumps its mtime so
+    eviction (oldest mtime first) is LRU. Eviction runs when an entry is written.
+    """
+
+    def __init__(self, directory: str = os.path.join(KESTEP_DIR, 'responses'), mode: str = 'off',
+                 max_bytes: int = 256 * 1024 * 1024, max_age: float = 30 * 24 * 3600):
+        self.directory = directory
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.index: dict[str, tuple[float, int]] = None     # path -> (mtime, size), loaded on first write
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != 'off'
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def get(self, url: str, data: dict[str, any]) -> Optional[dict[str, any]]:
+        if self.mode != 'read':
+            return None
+
+        path = self.path(request_key(url, data))
+        try:
+            with open(path, 'rb') as file:
+                response_obj = json.loads(file.read())
+        except (OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+
+        now = time.time()
+        if now - os.path.getmtime(path) > self.max_age:
+            with self.lock:
+                self.misses += 1
+            return None
+
+        os.utime(path, (now, now))
+        with self.lock:
+            self.hits += 1
+            if self.index is not None and path in self.index:
+                self.index[path] = (now, self.index[path][1])
+        return response_obj
+
+    def put(self, url: str, data: dict[str, any], response_obj: dict[str, any]) -> None:
+        if not self.enabled:
+            return
+
+        path = self.path(request_key(url, data))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        blob = json.dumps(response_obj, separators=(',', ':')).encode('utf-8')
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as file:
+            file.write(blob)
+        os.replace(tmp_path, path)  # atomic, readers see the old or the new entry
+
+        with self.lock:
+            self.load_index()
+            self.index[path] = (time.time(), len(blob))
+            self.evict()
+
+    def load_index(self) -> None:
+        if self.index is not None:
+            return
+        self.index = {}
+        if not os.path.isdir(self.directory):
+            return
+        for sub in os.scandir(self.directory):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith('.json'):
+                    st = entry.stat()
+                    self.index[entry.path] = (st.st_mtime, st.st_size)
+
+    def evict(self) -> None:
+        """Remove expired entries, then least recently used ones until under max_bytes"""
+        now = time.time()
+        expired = [path for path, (mtime, _) in self.index.items() if now - mtime > self.max_age]
+        total = sum(size for _, size in self.index.values())
+        if not expired and total <= self.max_bytes:
+            return
+
+        for path in expired:
+            total -= self.index[path][1]
+            self.remove(path)
+
+        for path, (_, size) in sorted(self.index.items(), key=lambda item: item[1][0]):
+            if total <= self.max_bytes:
+                break
+            total -= size
+            self.remove(path)
+
+    def remove(self, path: str) -> None:
+        self.index.pop(path, None)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def summary(self) -> str:
+        return f"Response cache ({self.mode}): {self.hits} hits, {self.misses} misses"
+
+
+# The process wide cache, configured from the command line (--cache)
+response_cache = ResponseCache()
+
+
+def configure_cache(mode: str) -> ResponseCache:
+    response_cache.mode = mode
+    return response_cache
@@ -0,0 +1,96 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Optional
+
+from kestep.kestep_conversation import dumps
+from kestep.kestep_util import KESTEP_DIR
+
+CHECKPOINT_DIR = os.path.join(KESTEP_DIR, 'checkpoints')
+CHECKPOINT_VERSION = 1
+
+# PromtpStep and ToolBudget attributes carried over to the resumed run
+STEP_FIELDS = ('model_name', 'company', 'system_value', 'vdict', 'written', 'toks_in', 'cost_in', 'toks_out',
+               'cost_out', 'total', 'toks_cache_read', 'toks_cache_write', 'toks_saved')
+BUDGET_FIELDS = ('used', 'removed', 'truncated', 'stubbed')
+
+
+def file_sha(filename: str) -> str:
+    with open(filename, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+class Checkpoints:
+    """Resumable state of running steps, one directory/<step>-<sha of its path>.json each.
+
+    A checkpoint is written after every model response (before its tool calls run), after every tool result
+    and after every .exec/.map, and removed once the step completes.  It holds the statement in progress (ip),
+    the messages, the .llm without its key, the token and cost counters and, within a model turn, the response
+    and the tool results so far: kestep -e step --resume repeats no request and no finished tool call.
+    """
+
+    def __init__(self, directory: str = CHECKPOINT_DIR):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.prompt_shas: dict[str, str] = {}
+
+    def path(self, step_file: str) -> str:
+        key = hashlib.sha256(os.path.abspath(step_file).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.directory, f"{os.path.splitext(os.path.basename(step_file))[0]}-{key}.json")
+
+    def prompt_sha(self, step_file: str) -> str:
+        if step_file not in self.prompt_shas:
+            self.prompt_shas[step_file] = file_sha(step_file)
+        return self.prompt_shas[step_file]
+
+    def save(self, step, ip: int) -> None:
+        """Checkpoint step, to resume at statement ip (with step.turn_response still to handle, if any)"""
+        if not step.checkpointing:
+            return
+        # within a turn, the messages before its response: resuming adds the response again
+        messages = step.messages if step.turn_response is None else step.messages[:step.turn_messages]
+        with self.lock:
+            state = {
+                "version": CHECKPOINT_VERSION,
+                "prompt_sha": self.prompt_sha(step.filename),
+                "ip": ip,
+                "llm": {k: v for k, v in step.llm.items() if k != 'API_KEY'},
+                "budget": {k: getattr(step.tool_budget, k) for k in BUDGET_FIELDS} if step.tool_budget else {},
+                "cache_blocks": [[i, j] for i, msg in enumerate(messages)
+                                 if isinstance(msg.get('content'), list)
+                                 for j, block in enumerate(msg['content']) if id(block) in step.cache_blocks],
+                "response": step.turn_response,
+                "tool_results": dict(step.tool_results),
+                **{k: getattr(step, k) for k in STEP_FIELDS},
+            }
+            body = dumps(state)
+            # the messages, by far the largest part, from the json the requests were built of
+            body = body[:-1] + b',"messages":' + step.conversation.messages_json(messages) + b'}'
+            os.makedirs(self.directory, exist_ok=True)
+            path = self.path(step.filename)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as file:
+                file.write(body)
+            os.replace(tmp_path, path)
+
+    def load(self, step_file: str) -> Optional[dict[str, any]]:
+        """The checkpoint of step_file, None when there is none or the .prompt changed since"""
+        try:
+            with open(self.path(step_file), 'r', encoding='utf-8') as file:
+                state = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if state.get('version') != CHECKPOINT_VERSION or state.get('prompt_sha') != file_sha(step_file):
+            return None
+        return state
+
+    def remove(self, step_file: str) -> None:
+        try:
+            os.remove(self.path(step_file))
+        except OSError:
+            pass
+
+
+# The process wide checkpoints
+checkpoints = Checkpoints()
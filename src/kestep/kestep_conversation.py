@@ -0,0 +1,149 @@
+import json
+from typing import Optional
+
+from kestep.kestep_tokens import message_tokens, tools_tokens
+
+
+def dumps(obj: any) -> bytes:
+    """The request encoding: compact utf-8 json"""
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class Fragment:
+    """A message as sent: its json and estimated tokens, computed once and kept while the message is unchanged.
+
+    Messages are only ever replaced or have blocks appended to their content array, never edited in place
+    (the same rule the conversation journal relies on), so identity plus content length detects a change.
+    """
+
+    __slots__ = ('message', 'content', 'length', 'json', 'tokens')
+
+    def __init__(self, message: dict):
+        self.message = message      # holds the message, so its id() is not reused while cached
+        self.content = message.get('content')
+        self.length = len(self.content) if isinstance(self.content, list) else -1
+        self.json: Optional[bytes] = None
+        self.tokens: Optional[int] = None
+
+    def matches(self, message: dict) -> bool:
+        content = message.get('content')
+        return (message is self.message and content is self.content
+                and (len(content) if isinstance(content, list) else -1) == self.length)
+
+
+class Conversation:
+    """Incremental request building for one step.
+
+    correct() brings only the messages added since the last turn into canonical form, tokens() and body()
+    measure and serialize only the messages that are new or changed: the other messages' json fragments are
+    reused, so the cost of a turn does not grow with the length of the conversation.
+
+    The messages stay plain dicts in step.messages, shared with the journal, the tools and the caches.
+    """
+
+    def __init__(self):
+        self.fragments: dict[int, Fragment] = {}    # id(message) -> Fragment
+        self.values: dict[int, tuple[any, bytes]] = {}  # id(tools array...) -> (value, json)
+        self.breakpoints: dict[tuple[int, int], tuple] = {}  # add_breakpoints() copies, reused between turns
+        self.corrected_list: Optional[list] = None
+        self.corrected = 0      # leading messages of corrected_list already in canonical form
+
+    def correct(self, messages: list) -> None:
+        """In place: every message an object with a content array, consecutive same role messages merged.
+
+        Tool results and plain string contents stay separate.  Messages corrected before are not walked again,
+        the last of them may still take the content of the next one.
+        """
+        if messages is not self.corrected_list or self.corrected > len(messages):
+            self.corrected_list, self.corrected = messages, 0
+
+        out = self.corrected
+        for idx in range(self.corrected, len(messages)):
+            msg = messages[idx]
+            # convert all messages to objects with content arrays
+            if type(msg) == str:
+                msg = {"role": "user", "content": [{"type": "text", "text": msg}]}
+
+            # Is the previous message of the same role as this one?
+            if out > 0:
+                prev = messages[out - 1]
+                if (prev["role"] == msg["role"] and isinstance(prev["content"], list)
+                        and isinstance(msg["content"], list)):
+                    # copy contents to end of previous content array
+                    prev["content"].extend(msg["content"])
+                    continue
+            messages[out] = msg
+            out += 1
+
+        del messages[out:]
+        self.corrected = out
+
+    def fragment(self, message: dict) -> Fragment:
+        fragment = self.fragments.get(id(message))
+        if fragment is None or not fragment.matches(message):
+            fragment = self.fragments[id(message)] = Fragment(message)
+        return fragment
+
+    def forget(self, messages: list[dict]) -> None:
+        """Drop the fragments of messages no longer sent (replaced, merged, trimmed or breakpoint copies)"""
+        if len(self.fragments) > 2 * len(messages) + 8:
+            keep = {id(msg) for msg in messages}
+            self.fragments = {key: f for key, f in self.fragments.items() if key in keep}
+
+    def tokens(self, company: str, data: dict[str, any]) -> int:
+        """estimate_tokens(company, data), with the messages measured once"""
+        tokens = 0
+        for msg in data.get('messages', []):
+            fragment = self.fragment(msg)
+            if fragment.tokens is None:
+                fragment.tokens = message_tokens(company, msg)
+            tokens += fragment.tokens
+        if data.get('system'):
+            tokens += message_tokens(company, data['system'])
+        if data.get('tools'):
+            tokens += tools_tokens(company, data['tools'])
+        return tokens
+
+    def value_json(self, value: any) -> bytes:
+        """json of a value sent unchanged with every request (the tools array)"""
+        cached = self.values.get(id(value))
+        if cached is None or cached[0] is not value:
+            cached = self.values[id(value)] = (value, dumps(value))
+        return cached[1]
+
+    def messages_parts(self, messages: list[dict], parts: list[bytes]) -> None:
+        parts.append(b'[')
+        for idx, msg in enumerate(messages):
+            fragment = self.fragment(msg)
+            if fragment.json is None:
+                fragment.json = dumps(msg)
+            if idx:
+                parts.append(b',')
+            parts.append(fragment.json)
+        parts.append(b']')
+
+    def messages_json(self, messages: list[dict]) -> bytes:
+        """dumps(messages) from the cached fragments"""
+        parts = []
+        self.messages_parts(messages, parts)
+        return b''.join(parts)
+
+    def body(self, data: dict[str, any]) -> bytes:
+        """dumps(data), the messages array joined from the cached fragments of its messages.
+
+        The parts are joined once: every intermediate copy of a long conversation costs as much as the join.
+        """
+        parts = [b'{']
+        for key, value in data.items():
+            if len(parts) > 1:
+                parts.append(b',')
+            parts.append(dumps(key) + b':')
+            if key == 'messages':
+                self.messages_parts(value, parts)
+                self.forget(value)
+            elif key == 'tools':
+                parts.append(self.value_json(value))
+            else:
+                parts.append(dumps(value))
+        parts.append(b'}')
+        return b''.join(parts)
@@ -0,0 +1,101 @@
+import os
+import signal
+import subprocess
+import threading
+import time
+
+EXEC_TIMEOUT = 120.0        # seconds of wall clock before the command (and its children) is killed
+EXEC_OUTPUT_BYTES = 16384   # kept of each of stdout and stderr, about 4000 tokens: the head and the tail
+KILL_GRACE = 2.0            # seconds between SIGTERM and SIGKILL
+
+
+class OutputBudget:
+    """Keeps the first and the last limit/2 bytes of a stream, counting the bytes dropped in between"""
+
+    __slots__ = ('limit', 'head', 'tail', 'total')
+
+    def __init__(self, limit: int = EXEC_OUTPUT_BYTES):
+        self.limit = limit
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+
+    def add(self, chunk: bytes) -> None:
+        self.total += len(chunk)
+        room = self.limit // 2 - len(self.head)
+        if room > 0:
+            self.head += chunk[:room]
+            chunk = chunk[room:]
+        if chunk:
+            self.tail += chunk
+            if len(self.tail) > self.limit - self.limit // 2:
+                del self.tail[:len(self.tail) - (self.limit - self.limit // 2)]
+
+    @property
+    def elided(self) -> int:
+        return self.total - len(self.head) - len(self.tail)
+
+    def text(self) -> str:
+        head = self.head.decode('utf-8', errors='replace')
+        if not self.elided:
+            return head + self.tail.decode('utf-8', errors='replace')
+        return (f"{head}\n[... {self.elided} bytes elided ...]\n"
+                f"{self.tail.decode('utf-8', errors='replace')}")
+
+
+def _drain(stream, budget: OutputBudget) -> None:
+    while True:
+        chunk = os.read(stream.fileno(), 65536)
+        if not chunk:
+            break
+        budget.add(chunk)
+
+
+def _kill(process: subprocess.Popen) -> None:
+    """Terminate the command's process group (the shell and everything it started)"""
+    for sig, grace in ((signal.SIGTERM, KILL_GRACE), (signal.SIGKILL, None)):
+        try:
+            os.killpg(process.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            return
+        try:
+            process.wait(grace)
+            return
+        except subprocess.TimeoutExpired:
+            continue
+
+
+def run_command(cmd: str, timeout: float = EXEC_TIMEOUT, limit: int = EXEC_OUTPUT_BYTES) -> dict[str, any]:
+    """Run cmd with /bin/sh, reading stdout and stderr as they come into bounded buffers.
+
+    Returns the exit status (negative: killed by that signal), duration, whether it timed out, the kept
+    output and how much of it was elided.
+    """
+    start = time.time()
+    process = subprocess.Popen(['/bin/sh', '-c', cmd], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, start_new_session=True)
+    budgets = {'stdout': OutputBudget(limit), 'stderr': OutputBudget(limit)}
+    readers = {name: threading.Thread(target=_drain, args=(getattr(process, name), budget), daemon=True,
+                                      name=f"execcmd {name}") for name, budget in budgets.items()}
+    for reader in readers.values():
+        reader.start()
+
+    timed_out = False
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        timed_out = True
+        _kill(process)
+    for name, reader in readers.items():
+        reader.join(KILL_GRACE)
+        if not reader.is_alive():   # else a daemon that left the process group holds the pipe open
+            getattr(process, name).close()
+
+    result = {"exit_status": process.returncode, "duration": round(time.time() - start, 3), "timed_out": timed_out}
+    for name, budget in budgets.items():
+        result[name] = budget.text()
+    for name, budget in budgets.items():
+        if budget.elided:
+            result[f"{name}_bytes"] = budget.total
+            result[f"{name}_elided_bytes"] = budget.elided
+    return result
@@ -0,0 +1,145 @@
+import json
+import mmap
+import os
+import re
+import time
+from contextlib import contextmanager
+
+BLOCK = 1 << 20             # bytes scanned at a time when counting lines
+MAX_READ_LINES = 2000       # a ranged read returns at most this many lines...
+MAX_READ_BYTES = 65536      # ...or bytes
+MAX_MATCHES = 50
+MAX_LINE = 500              # characters of a line shown by searchfile
+
+
+@contextmanager
+def mapped(filename: str):
+    """The file memory mapped read-only, b'' for an empty file (which cannot be mapped)"""
+    with open(filename, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            yield b''
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield data
+
+
+def count_lines(data, end: int = None) -> int:
+    """Lines in data[:end], a last line without newline included"""
+    end = len(data) if end is None else end
+    lines = sum(data[pos:min(pos + BLOCK, end)].count(b'\n') for pos in range(0, end, BLOCK))
+    if end and data[end - 1:end] != b'\n':
+        lines += 1
+    return lines
+
+
+def line_offset(data, line: int) -> int:
+    """Byte offset of line (1 based), len(data) when the file is shorter"""
+    remaining, pos = line - 1, 0
+    while remaining > 0 and pos < len(data):
+        block = data[pos:pos + BLOCK]
+        newlines = block.count(b'\n')
+        if newlines < remaining:
+            remaining -= newlines
+            pos += len(block)
+            continue
+        for _ in range(remaining):
+            pos = data.find(b'\n', pos) + 1
+        remaining = 0
+    return min(pos, len(data))
+
+
+def decode(raw: bytes) -> str:
+    return raw.decode('utf-8', errors='replace')
+
+
+def readrange(filename: str, offset: int = 1, limit: int = 200, unit: str = 'lines') -> str:
+    """Part of a file: limit lines from line offset (1 based, 0 is 1, negative counts from the end), numbered,
+    or with unit 'bytes' limit bytes from byte offset."""
+    try:
+        offset, limit = int(offset), int(limit)
+        with mapped(filename) as data:
+            if unit == 'bytes':
+                limit = min(limit, MAX_READ_BYTES)
+                start = max(0, offset if offset >= 0 else len(data) + offset)
+                end = min(len(data), start + limit)
+                return f"[{filename}: bytes {start}-{end} of {len(data)}]\n{decode(data[start:end])}"
+
+            limit = min(limit, MAX_READ_LINES)
+            total = count_lines(data)
+            first = max(1, total + offset + 1 if offset < 0 else offset)     # 0: the first line, as 1
+            start = line_offset(data, first)
+            lines = []
+            pos = start
+            while len(lines) < limit and pos < len(data) and pos - start < MAX_READ_BYTES:
+                end = data.find(b'\n', pos)
+                end = len(data) if end < 0 else end + 1
+                lines.append(f"{first + len(lines):>6}\t{decode(data[pos:end]).rstrip(chr(10))}")
+                pos = end
+            last = first + len(lines) - 1
+            return f"[{filename}: lines {first}-{last} of {total}]\n" + '\n'.join(lines)
+    except Exception as err:
+        return f"Error: {str(err)}"
+
+
+def filestat(filename: str) -> str:
+    """Size, lines and modification time of a file, as json"""
+    try:
+        st = os.stat(filename)
+        info = {"filename": filename, "bytes": st.st_size,
+                "modified": time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(st.st_mtime))}
+        if os.path.isdir(filename):
+            info["type"] = "directory"
+            info["entries"] = len(os.listdir(filename))
+        else:
+            with mapped(filename) as data:
+                info["type"] = "binary" if b'\0' in data[:8192] else "text"
+                if info["type"] == "text":
+                    info["lines"] = count_lines(data)
+        return json.dumps(info)
+    except Exception as err:
+        return f"Error: {str(err)}"
+
+
+def searchfile(filename: str, pattern: str, context: int = 2, max_matches: int = MAX_MATCHES) -> str:
+    """Lines matching a regular expression, numbered, with context lines around them (grep -n -C)"""
+    try:
+        regex = re.compile(pattern.encode('utf-8'), re.MULTILINE)
+        context, max_matches = max(0, int(context)), min(int(max_matches), MAX_MATCHES)
+        shown: dict[int, str] = {}      # line number: text, of the matches and their context
+        matched: set[int] = set()
+        with mapped(filename) as data:
+            line_no, counted_to = 1, 0  # line number of byte counted_to
+            pos = 0
+            while len(matched) < max_matches and pos < len(data):
+                found = regex.search(data, pos)
+                if not found:
+                    break
+                start = data.rfind(b'\n', 0, found.start()) + 1
+                line_no += count_lines(data[counted_to:start]) if start > counted_to else 0
+                counted_to = start
+                matched.add(line_no)
+
+                line, cur = line_no, start
+                while line > max(1, line_no - context):
+                    cur = data.rfind(b'\n', 0, cur - 1) + 1
+                    line -= 1
+                while line <= line_no + context and cur < len(data):
+                    end = data.find(b'\n', cur)
+                    end = len(data) if end < 0 else end
+                    if line not in shown:
+                        shown[line] = decode(data[cur:end])[:MAX_LINE]
+                    line, cur = line + 1, end + 1
+
+                end = data.find(b'\n', found.start())
+                pos = len(data) if end < 0 else end + 1     # the next match is on a later line
+        if not matched:
+            return f"[{filename}: no match for {pattern}]"
+        out = []
+        for line in sorted(shown):
+            if out and line - 1 not in shown:
+                out.append('--')
+            out.append(f"{line}{':' if line in matched else '-'}{shown[line]}")
+        more = f", stopped at {max_matches}" if len(matched) >= max_matches else ''
+        return f"[{filename}: {len(matched)} matching lines{more}]\n" + '\n'.join(out)
+    except Exception as err:
+        return f"Error: {str(err)}"
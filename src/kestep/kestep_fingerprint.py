@@ -0,0 +1,138 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+import threading
+from typing import Optional
+
+from kestep.kestep_graph import StepNode
+from kestep.kestep_util import KESTEP_DIR
+
+# Bump when what goes into a fingerprint changes
+FINGERPRINT_VERSION = 1
+
+
+class FingerprintStore:
+    """Fingerprints of the last successful run of each step, and the files it wrote.
+
+    A fingerprint covers the .prompt file, the content of every file it reads (.include, .image, .input...),
+    its resolved .llm parameters and model entry.  The files a step wrote are kept, by content hash, in
+    directory/outputs so an up to date step's outputs can be restored without running it.  File hashes are
+    remembered with the file's (mtime, size): checking an unchanged step costs a stat() per file.
+    """
+
+    def __init__(self, directory: str = KESTEP_DIR):
+        self.path = os.path.join(directory, 'fingerprints.json')
+        self.outputs_dir = os.path.join(directory, 'outputs')
+        self.entries: dict[str, dict] = None    # abspath of step -> {"fingerprint": sha, "outputs": {path: sha}}
+        self.hashes: dict[str, list] = None     # abspath of file -> [mtime_ns, size, sha256]
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def load(self) -> None:
+        if self.entries is not None:
+            return
+        self.entries, self.hashes = {}, {}
+        try:
+            with open(self.path, 'r') as file:
+                index = json.load(file)
+            if index.get('version') == FINGERPRINT_VERSION:
+                self.entries, self.hashes = index['steps'], index['files']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def save(self) -> None:
+        """Write the index when it changed (call holding the lock)"""
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump({"version": FINGERPRINT_VERSION, "steps": self.entries, "files": self.hashes}, file)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    def file_hash(self, path: str) -> Optional[str]:
+        """sha256 of the file's content, None when it is not a file"""
+        key = os.path.abspath(path)
+        try:
+            st = os.stat(key)
+        except OSError:
+            return None
+        if not os.path.isfile(key):
+            return None
+        with self.lock:
+            self.load()
+            known = self.hashes.get(key)
+        if known and known[0] == st.st_mtime_ns and known[1] == st.st_size:
+            return known[2]
+        sha = hashlib.sha256()
+        with open(key, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                sha.update(block)
+        with self.lock:
+            self.hashes[key] = [st.st_mtime_ns, st.st_size, sha.hexdigest()]
+            self.dirty = True
+        return sha.hexdigest()
+
+    def fingerprint(self, node: StepNode) -> Optional[str]:
+        """The step's fingerprint now, None when it cannot be taken (invalid step or .llm)"""
+        if node.error or node.settings is None:
+            return None
+        sha = hashlib.sha256(f"{FINGERPRINT_VERSION}\n{self.file_hash(node.filename)}\n{node.settings}\n".encode())
+        for pattern in node.inputs:
+            for path in sorted(glob.glob(pattern)) or [pattern]:
+                sha.update(f"{path}\0{self.file_hash(path)}\n".encode())
+        return sha.hexdigest()
+
+    def blob(self, sha: str) -> str:
+        return os.path.join(self.outputs_dir, sha)
+
+    def check(self, node: StepNode, fingerprint: str, restore: bool = False, dry_run: bool = False) -> str:
+        """'up to date' or 'restored' (its changed or missing outputs copied back), '' when the step must run.
+
+        With dry_run, nothing is restored: 'restored' tells the outputs would be.
+        """
+        with self.lock:
+            self.load()
+            entry = self.entries.get(os.path.abspath(node.filename))
+        if not fingerprint or not entry or entry['fingerprint'] != fingerprint:
+            return ''
+        changed = [path for path, sha in entry['outputs'].items() if self.file_hash(path) != sha]
+        if not changed:
+            return 'up to date'
+        if not restore or not all(os.path.exists(self.blob(entry['outputs'][path])) for path in changed):
+            return ''
+        if dry_run:
+            return 'restored'
+        for path in changed:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.copyfile(self.blob(entry['outputs'][path]), path)
+        return 'restored'
+
+    def store(self, node: StepNode, fingerprint: str, outputs: list[str]) -> None:
+        """Record a successful run: its fingerprint (taken before it ran) and a copy of the files it wrote"""
+        if not fingerprint:
+            return
+        written = {}
+        for path in dict.fromkeys(os.path.normpath(path) for path in outputs):
+            sha = self.file_hash(path)
+            if sha is None:
+                continue
+            written[path] = sha
+            if not os.path.exists(self.blob(sha)):
+                os.makedirs(self.outputs_dir, exist_ok=True)
+                tmp_path = f"{self.blob(sha)}.{os.getpid()}.{threading.get_ident()}.tmp"
+                shutil.copyfile(path, tmp_path)
+                os.replace(tmp_path, self.blob(sha))
+        with self.lock:
+            self.load()
+            self.entries[os.path.abspath(node.filename)] = {"fingerprint": fingerprint, "outputs": written}
+            self.dirty = True
+            self.save()
+
+
+# The process wide fingerprint store
+fingerprints = FingerprintStore()
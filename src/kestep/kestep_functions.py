@@ -1,5 +1,5 @@
+import json
 import platform
-import subprocess
 import sys
 from copy import deepcopy
 
@@ -7,28 +7,15 @@ from rich.console import Console
 from rich.prompt import Prompt
 from rich.theme import Theme
 
+from kestep.kestep_files import readrange, filestat, searchfile
 from kestep.kestep_util import backup_file
 
 console = Console()
 
-def get_webpage_content(url: str) -> str:
-    # Command to fetch the content and convert it to text
-    command = f"wget2 --content-on-error -O - {url} | html2text"
-
-    # Create a subprocess
-    process = subprocess.run(
-        command,
-        shell=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
-
-    if process.returncode != 0:
-        # If there was an error, raise an exception with the error message
-        raise Exception(f"Error fetching URL: {process.stderr.decode()}")
-
-    # Return the output as a string
-    return process.stdout.decode()
+def get_webpage_content(url: str, main_content: bool = False) -> str:
+    """Fetch a page (pooled connections, on-disk HTTP cache) and convert HTML to text, all in-process"""
+    from kestep.kestep_web import get_page_text
+    return get_page_text(url, main_content)
 
 
 def readfile(filename: str) -> str:
@@ -58,10 +45,10 @@ def askuser(question: str) -> str:
     return answer
 
 
-def wwwget(url: str) -> str:
+def wwwget(url: str, main_content: bool = False) -> str:
 
     try:
-        page_contents = get_webpage_content(url)
+        page_contents = get_webpage_content(url, main_content)
     except Exception as err:
         console.print(f"Error while retrieving url for AI... ", err)
         result = {'role': "function",
@@ -83,18 +70,33 @@ def writefile(filename: str, content: str) -> str:
     return f"Content written to file '{new_filename}'"
 
 
-def execcmd(cmd: str) -> str:
-    """Execute shell command and return output."""
-    import subprocess
+def run_cmd(cmd: str, timeout: float = None) -> dict[str, any]:
+    from kestep.kestep_exec import run_command, EXEC_TIMEOUT
     if cmd[0] in ['"', "'"]:
         cmd = cmd[1:-1]
+    return run_command(cmd, timeout=float(timeout or EXEC_TIMEOUT))
+
+
+def execcmd(cmd: str, timeout: float = None) -> str:
+    """Execute shell command and return its output (stderr when it failed), for .cmd in prompts."""
     try:
-        result = subprocess.run(['/bin/sh', '-c', cmd], capture_output=True, text=True, encoding='utf-8', check=True)
-        return result.stdout
-    except subprocess.CalledProcessError as e:
-        return f"stderr: {e.stderr}"
+        result = run_cmd(cmd, timeout)
     except Exception as e:
         return f"Error: {str(e)}"
+    if result['timed_out']:
+        return f"Error: killed after {result['duration']}s\nstdout: {result['stdout']}\nstderr: {result['stderr']}"
+    if result['exit_status'] != 0:
+        return f"stderr: {result['stderr']}"
+    return result['stdout']
+
+
+def execcmd_json(cmd: str, timeout: float = None) -> str:
+    """Execute shell command, return its exit status, duration and (head and tail of the) output as json."""
+    try:
+        result = run_cmd(cmd, timeout)
+    except Exception as e:
+        return f"Error: {str(e)}"
+    return json.dumps(result, ensure_ascii=False)
 
 
 os_descriptor = platform.platform()
@@ -103,7 +105,8 @@ DefinedToolsArray = [
     {'type': 'function',
      'function':{
          "name": "readfile",
-         "description": "Read the contents of a named file",
+         "description": "Read the whole contents of a named file; for large files prefer filestat, searchfile "
+                        "and readrange",
          "parameters": {
             "type": "object",
             "properties": {
@@ -113,6 +116,53 @@ DefinedToolsArray = [
              "additionalProperties": False
          },
     }},
+    {'type': 'function',
+     'function':{
+         "name": "readrange",
+         "description": "Read part of a named file: numbered lines from a line offset, or bytes from a byte offset",
+         "parameters": {
+            "type": "object",
+            "properties": {
+                "filename": {"type": "string", "description": "The name of the file to read",},
+                "offset": {"type": "integer",
+                           "description": "First line (1 based, 0 is 1, negative counts from the end) or byte (default 1)",},
+                "limit": {"type": "integer", "description": "Number of lines or bytes to read (default 200)",},
+                "unit": {"type": "string", "enum": ["lines", "bytes"], "description": "Default lines",},
+            },
+            "required": ["filename"],
+             "additionalProperties": False
+         },
+    }},
+    {'type': 'function',
+     'function':{
+         "name": "filestat",
+         "description": "Size in bytes and lines, type and modification time of a named file",
+         "parameters": {
+            "type": "object",
+            "properties": {
+                "filename": {"type": "string", "description": "The name of the file",},
+            },
+            "required": ["filename"],
+             "additionalProperties": False
+         },
+    }},
+    {'type': 'function',
+     'function':{
+         "name": "searchfile",
+         "description": "Search a named file for a regular expression, returns the numbered matching lines "
+                        "with context lines around them",
+         "parameters": {
+            "type": "object",
+            "properties": {
+                "filename": {"type": "string", "description": "The name of the file to search",},
+                "pattern": {"type": "string", "description": "Python regular expression",},
+                "context": {"type": "integer", "description": "Lines shown before and after a match (default 2)",},
+                "max_matches": {"type": "integer", "description": "Matching lines returned at most (default 50)",},
+            },
+            "required": ["filename", "pattern"],
+             "additionalProperties": False
+         },
+    }},
     {'type': 'function',
      'function':{   "name": "wwwget",
         "description": "Read a webpage url and return the contents",
@@ -120,6 +170,8 @@ DefinedToolsArray = [
             "type": "object",
             "properties": {
                 "url": {"type": "string","description": "The url of the web page to read",},
+                "main_content": {"type": "boolean",
+                                 "description": "Only the main content, without navigation, headers and footers",},
             },
             "required": ["url"],
             "additionalProperties": False
@@ -148,6 +200,8 @@ DefinedToolsArray = [
             "properties": {
                 "cmd": {"type": "string","description": "command to be executed",
                 },
+                "timeout": {"type": "number",
+                            "description": "Seconds before the command is killed (default 120)",},
             },
             "required": ["cmd"],
             "additionalProperties": False
@@ -176,11 +230,26 @@ for tool in DefinedToolsArray:
         "input_schema": tool['function']['parameters'],
     })
 
+# Functions that are never run concurrently with other calls of the same model turn
+SerialFunctions = {
+    "askuser",      # Interacts with the user on the terminal
+    "execcmd",      # Commands may depend on each other's side effects
+    "writefile",    # Calls before it read the file as it was, calls after it as written
+}
+
 DefinedFunctions = {
     "readfile":     readfile,
+    "readrange":    readrange,
+    "filestat":     filestat,
+    "searchfile":   searchfile,
     "wwwget":       wwwget,
     "writefile":    writefile,
     "execcmd":      execcmd,
     "askuser":      askuser,
 }
 
+# The functions of model tool calls that differ from .cmd's: the model gets the exit status of a command
+ToolFunctions = {
+    "execcmd":      execcmd_json,
+}
+
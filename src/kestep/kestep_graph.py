@@ -0,0 +1,153 @@
+import fnmatch
+import json
+import os
+import threading
+
+from kestep.kestep_util import KESTEP_DIR
+
+DEFAULT_EXEC_SECONDS = 10.0     # planned duration of an .exec of a step that never ran
+
+
+class DependencyCycle(Exception):
+    pass
+
+
+class StepNode:
+    """A step file in the dependency graph: the files it reads and writes, the steps writing its inputs"""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.inputs: list[str] = []
+        self.outputs: list[str] = []
+        self.deps: list[str] = []       # step files to run before this one
+        self.execs = 0                  # requests (.exec, .map) of the step
+        self.settings: str = None       # resolved .llm parameters and model entry (json), None when invalid
+        self.error = ''
+
+
+def step_node(step_file: str) -> StepNode:
+    """Inputs and outputs of a step, declared (.input/.output) or inferred (.include, .image, .map, .cmd)"""
+    from kestep.kestep import PromtpStep
+
+    node = StepNode(step_file)
+    step = PromtpStep(step_file, quiet=True)
+    try:
+        step.parse_prompt()
+    except (SystemExit, Exception) as e:
+        node.error = str(e) or 'error'
+        return node
+    for statement in step.statements:
+        inputs, outputs = statement.files()
+        node.inputs += [os.path.normpath(path) for path in inputs if path and path not in node.inputs]
+        node.outputs += [os.path.normpath(path) for path in outputs if path and path not in node.outputs]
+        node.execs += statement.keyword in ('.exec', '.map')
+        if statement.keyword == '.llm' and not step.llm:
+            try:
+                statement.estimate(step)    # resolves the parameters, no key, no connection
+                node.settings = json.dumps({'llm': step.llm, 'model': step.model}, sort_keys=True, default=str)
+            except (SystemExit, Exception):
+                node.settings = None
+    return node
+
+
+def produces(output: str, wanted: str) -> bool:
+    return output == wanted or fnmatch.fnmatchcase(output, wanted)
+
+
+def build_graph(step_files: list[str]) -> dict[str, StepNode]:
+    """Nodes of step_files, in step_files order, each depending on the steps producing one of its inputs.
+
+    Only the given steps are considered: an input nobody here writes must exist already.
+    """
+    nodes = {step_file: step_node(step_file) for step_file in step_files}
+    for node in nodes.values():
+        for other in nodes.values():
+            if other is not node and any(produces(output, wanted) for output in other.outputs
+                                         for wanted in node.inputs):
+                node.deps.append(other.filename)
+    return nodes
+
+
+def topological_order(nodes: dict[str, StepNode]) -> list[str]:
+    """Steps in an order running every step after its dependencies, otherwise keeping the nodes order"""
+    done: set[str] = set()
+    order = []
+    while len(order) < len(nodes):
+        ready = [f for f, node in nodes.items() if f not in done and all(dep in done for dep in node.deps)]
+        if not ready:
+            cycle = [os.path.basename(f) for f in nodes if f not in done]
+            raise DependencyCycle(f"steps depend on each other's outputs: {', '.join(cycle)}")
+        order.append(ready[0])
+        done.add(ready[0])
+    return order
+
+
+class StepTimings:
+    """Wall time of the last run of each step, in one small json file, for --plan"""
+
+    def __init__(self, path: str = os.path.join(KESTEP_DIR, 'timings.json')):
+        self.path = path
+        self.entries: dict[str, float] = None   # abspath -> seconds
+        self.lock = threading.Lock()
+
+    def load(self) -> None:
+        if self.entries is not None:
+            return
+        try:
+            with open(self.path, 'r') as file:
+                self.entries = json.load(file)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get(self, step_file: str) -> float:
+        with self.lock:
+            self.load()
+            return self.entries.get(os.path.abspath(step_file))
+
+    def record(self, durations: dict[str, float]) -> None:
+        with self.lock:
+            self.load()
+            self.entries.update({os.path.abspath(f): round(secs, 3) for f, secs in durations.items()})
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as file:
+                json.dump(self.entries, file)
+            os.replace(tmp_path, self.path)
+
+
+# The process wide step timings
+step_timings = StepTimings()
+
+
+def planned_seconds(node: StepNode) -> tuple[float, bool]:
+    """Duration of the last run of the step, else a guess from its requests; and whether it was measured"""
+    seconds = step_timings.get(node.filename)
+    if seconds is not None:
+        return seconds, True
+    return max(1, node.execs) * DEFAULT_EXEC_SECONDS, False
+
+
+class Plan:
+    """Earliest start and finish of each step with unlimited jobs, and the critical path"""
+
+    def __init__(self, nodes: dict[str, StepNode]):
+        self.nodes = nodes
+        self.order = topological_order(nodes)
+        self.seconds: dict[str, float] = {}
+        self.measured: dict[str, bool] = {}
+        self.start: dict[str, float] = {}
+        self.finish: dict[str, float] = {}
+        for f in self.order:
+            self.seconds[f], self.measured[f] = planned_seconds(nodes[f])
+            self.start[f] = max((self.finish[dep] for dep in nodes[f].deps), default=0.0)
+            self.finish[f] = self.start[f] + self.seconds[f]
+
+        self.critical_path: list[str] = []
+        step = max(self.order, key=lambda f: self.finish[f], default=None)
+        while step is not None:
+            self.critical_path.insert(0, step)
+            step = max(nodes[step].deps, key=lambda f: self.finish[f], default=None)
+
+    @property
+    def makespan(self) -> float:
+        return max(self.finish.values(), default=0.0)
@@ -0,0 +1,124 @@
+import atexit
+import threading
+import time
+from urllib.parse import urlsplit
+
+import httpx
+
+try:
+    import h2  # noqa: F401  (httpx only speaks HTTP/2 when the h2 package is installed)
+    HTTP2_AVAILABLE = True
+except ImportError:     # pip install kestep[http2]
+    HTTP2_AVAILABLE = False
+
+# One pooled keep-alive client per provider (scheme://host:port), shared by all steps and statements
+_clients: dict[str, httpx.Client] = {}
+_clients_lock = threading.Lock()
+
+DEFAULT_TIMEOUT = httpx.Timeout(600.0, connect=30.0)
+DEFAULT_LIMITS = httpx.Limits(max_connections=32, max_keepalive_connections=8, keepalive_expiry=120.0)
+
+
+def request_timeout(llm: dict[str, any]) -> httpx.Timeout:
+    """Timeouts of one request, .llm "connect_timeout" and "read_timeout" (seconds) override the defaults"""
+    if 'connect_timeout' not in llm and 'read_timeout' not in llm:
+        return DEFAULT_TIMEOUT
+    return httpx.Timeout(float(llm.get('read_timeout', DEFAULT_TIMEOUT.read)),
+                         connect=float(llm.get('connect_timeout', DEFAULT_TIMEOUT.connect)))
+
+
+def base_url(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def get_client(url: str) -> httpx.Client:
+    """Return the shared client for the provider serving url, creating it on first use."""
+    key = base_url(url)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = httpx.Client(
+                http2=HTTP2_AVAILABLE and key.startswith('https'),  # negotiated by ALPN, falls back to HTTP/1.1
+                timeout=DEFAULT_TIMEOUT,
+                limits=DEFAULT_LIMITS,
+            )
+            _clients[key] = client
+    return client
+
+
+def prewarm(url: str) -> threading.Thread:
+    """Open (DNS, TCP, TLS) a pooled connection to the provider in the background.
+
+    The HEAD request result does not matter, the connection it leaves in the pool does.
+    """
+
+    def warm():
+        try:
+            get_client(url).head(base_url(url), timeout=10.0)
+        except httpx.HTTPError:
+            pass    # The real request will report any connection problems
+
+    thread = threading.Thread(target=warm, name=f"prewarm {base_url(url)}", daemon=True)
+    thread.start()
+    return thread
+
+
+@atexit.register
+def close_clients() -> None:
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+
+class PhaseTimer:
+    """httpx/httpcore trace hook collecting per-phase timings of a single request.
+
+    connect (DNS + TCP) and tls are only present when a new connection was opened,
+    a reused keep-alive connection skips them.
+    """
+
+    # trace event prefix -> phase name
+    PHASES = {
+        'connection.connect_tcp': 'connect',
+        'connection.start_tls': 'tls',
+        'http11.send_request_headers': 'send',
+        'http2.send_request_headers': 'send',
+        'http11.send_request_body': 'send',
+        'http2.send_request_body': 'send',
+        'http11.receive_response_headers': 'wait',
+        'http2.receive_response_headers': 'wait',
+        'http11.receive_response_body': 'receive',
+        'http2.receive_response_body': 'receive',
+    }
+
+    def __init__(self):
+        self.start = time.time()
+        self.phases: dict[str, float] = {}
+        self.started: dict[str, float] = {}
+        self.ttfb: float = None
+        self.http_version: str = None
+        self.intervals: list[tuple[str, float, float]] = []    # (phase, start time, duration)
+
+    def __call__(self, event_name: str, info: dict) -> None:
+        prefix, _, state = event_name.rpartition('.')
+        phase = self.PHASES.get(prefix)
+        if phase is None:
+            return
+        now = time.time()
+        if state == 'started':
+            self.started[prefix] = now
+        elif state in ('complete', 'failed') and prefix in self.started:
+            started = self.started.pop(prefix)
+            self.phases[phase] = self.phases.get(phase, 0.0) + now - started
+            self.intervals.append((phase, started, now - started))
+            if phase == 'wait' and self.ttfb is None:
+                self.ttfb = now - self.start
+                self.http_version = prefix.split('.')[0]
+
+    def __str__(self) -> str:
+        short = {'connect': 'conn', 'tls': 'tls', 'send': 'send', 'wait': 'wait', 'receive': 'recv'}
+        phases = ' '.join(f"{short[name]} {self.phases.get(name, 0.0):.2f}" for name in short)
+        ttfb = f"{self.ttfb:.2f}" if self.ttfb is not None else '-'
+        return f"{self.http_version or ''} {phases} ttfb {ttfb}".strip()
@@ -0,0 +1,157 @@
+import base64
+import hashlib
+import io
+import json
+import math
+import mimetypes
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from kestep.kestep_util import KESTEP_DIR
+
+IMAGE_DIR = os.path.join(KESTEP_DIR, 'images')
+PIPELINE_VERSION = 2        # part of the cache key, bump when preprocess() changes its output
+IMAGE_LIMIT_KEYS = ['image_max_side', 'image_max_short_side', 'image_max_pixels']
+QUALITY = 85                # JPEG and WEBP recompression
+IMAGE_WORKERS = 4
+METADATA_KEYS = ('exif', 'xmp', 'XML:com.adobe.xmp', 'comment', 'gps')    # Image.info entries dropped on saving
+
+
+class EncodedImage:
+    """An image as sent: media type and base64 data, with the sizes before and after preprocessing"""
+
+    __slots__ = ('path', 'media_type', 'data', 'original_bytes', 'sent_bytes', 'cached')
+
+    def __init__(self, path: str, media_type: str, data: str, original_bytes: int, sent_bytes: int,
+                 cached: bool = False):
+        self.path = path
+        self.media_type = media_type
+        self.data = data
+        self.original_bytes = original_bytes
+        self.sent_bytes = sent_bytes
+        self.cached = cached
+
+
+def image_limits(llm: dict[str, any]) -> dict[str, int]:
+    """The preprocessing targets of llm's company (api_config, overridable on the .llm line)"""
+    return {key: llm[key] for key in IMAGE_LIMIT_KEYS if llm.get(key)}
+
+
+def target_size(width: int, height: int, limits: dict[str, int]) -> tuple[int, int]:
+    """Largest size within the limits keeping the aspect ratio, images are never enlarged"""
+    scale = 1.0
+    if limits.get('image_max_side'):
+        scale = min(scale, limits['image_max_side'] / max(width, height))
+    if limits.get('image_max_short_side'):
+        scale = min(scale, limits['image_max_short_side'] / min(width, height))
+    if limits.get('image_max_pixels'):
+        scale = min(scale, math.sqrt(limits['image_max_pixels'] / (width * height)))
+    if scale >= 1.0:
+        return width, height
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def preprocess(raw: bytes, media_type: str, limits: dict[str, int]) -> tuple[bytes, str]:
+    """Downscale to the limits, recompress and drop the metadata (EXIF, text chunks).
+
+    Needs Pillow (pip install kestep[images]), without it (or for images it cannot read, or animations)
+    the original is sent, metadata included.
+    An image within the limits and without metadata keeps its original bytes when recompressing does not
+    make it smaller.
+    """
+    try:
+        from PIL import Image
+    except ImportError:     # pip install kestep[images]
+        return raw, media_type
+
+    try:
+        with Image.open(io.BytesIO(raw)) as image:
+            if getattr(image, 'is_animated', False):
+                return raw, media_type
+            metadata = bool(image.getexif()) or bool(getattr(image, 'text', None)) or \
+                any(key in image.info for key in METADATA_KEYS)
+            size = target_size(image.width, image.height, limits)
+            resized = size != image.size
+            if resized:
+                if image.mode in ('1', 'P'):    # palette images would be resized with nearest neighbour
+                    image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+                image = image.resize(size, Image.Resampling.LANCZOS)
+
+            out = io.BytesIO()
+            if image.format in ('JPEG', 'WEBP') or (resized and media_type in ('image/jpeg', 'image/webp')):
+                fmt = 'WEBP' if media_type == 'image/webp' else 'JPEG'
+                if fmt == 'JPEG' and image.mode not in ('RGB', 'L'):
+                    image = image.convert('RGB')
+                image.save(out, fmt, quality=QUALITY, optimize=True)
+                new_type = f"image/{fmt.lower()}"
+            else:   # PNG, GIF, BMP, TIFF...: lossless, diagrams and screenshots stay sharp
+                image.save(out, 'PNG', optimize=True)
+                new_type = 'image/png'
+    except (OSError, ValueError):
+        return raw, media_type
+
+    if not resized and not metadata and out.tell() >= len(raw):
+        return raw, media_type
+    return out.getvalue(), new_type
+
+
+class ImageCache:
+    """Encoded images in directory/<key>.json, the key hashing the image's content and the preprocessing targets"""
+
+    def __init__(self, directory: str = IMAGE_DIR):
+        self.directory = directory
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    @staticmethod
+    def key(raw: bytes, limits: dict[str, int]) -> str:
+        blob = f"{hashlib.sha256(raw).hexdigest()}:{json.dumps(limits, sort_keys=True)}:{PIPELINE_VERSION}"
+        return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[tuple[str, str]]:
+        try:
+            with open(self.path(key), 'r') as file:
+                entry = json.load(file)
+            return entry['media_type'], entry['data']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def put(self, key: str, media_type: str, data: str) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{self.path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump({"media_type": media_type, "data": data}, file)
+        os.replace(tmp_path, self.path(key))
+
+
+# The process wide cache of encoded images
+image_cache = ImageCache()
+
+
+def encode_image(path: str, limits: dict[str, int]) -> EncodedImage:
+    """Preprocessed, base64 encoded image, from the cache when this image was encoded for these limits before"""
+    with open(path, 'rb') as file:
+        raw = file.read()
+    key = image_cache.key(raw, limits)
+    cached = image_cache.get(key)
+    if cached:
+        media_type, data = cached
+        sent_bytes = len(data) * 3 // 4 - data[-2:].count('=')
+        return EncodedImage(path, media_type, data, len(raw), sent_bytes, cached=True)
+
+    media_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    sent, media_type = preprocess(raw, media_type, limits)
+    data = base64.b64encode(sent).decode()
+    image_cache.put(key, media_type, data)
+    return EncodedImage(path, media_type, data, len(raw), len(sent))
+
+
+def encode_images(paths: list[str], limits: dict[str, int], jobs: int = IMAGE_WORKERS) -> list[EncodedImage]:
+    """encode_image() of every path, in parallel (Pillow and hashlib release the GIL), in the order given"""
+    if len(paths) == 1:
+        return [encode_image(paths[0], limits)]
+    with ThreadPoolExecutor(max_workers=min(jobs, len(paths)), thread_name_prefix='image') as pool:
+        return list(pool.map(lambda path: encode_image(path, limits), paths))
@@ -0,0 +1,89 @@
+import json
+import sys
+
+
+def _signature(msg: dict) -> tuple:
+    """Cheap change detector for a journaled message (content is only ever appended to or replaced).
+
+    Holds the message and its content, so their identity cannot pass to new objects while journaled.
+    """
+    content = msg.get('content') if isinstance(msg, dict) else msg
+    return msg, content, len(content) if isinstance(content, list) else None
+
+
+def _unchanged(msg: dict, signature: tuple) -> bool:
+    journaled, content, length = signature
+    now = msg.get('content') if isinstance(msg, dict) else msg
+    return msg is journaled and now is content and (len(now) if isinstance(now, list) else None) == length
+
+
+class ConversationJournal:
+    """Append-only JSONL log of a step's messages.
+
+    sync() appends one record per new message, so logging costs are proportional to new data.
+    A journaled message that was since replaced or had content appended to it (correct_messages
+    merges) is written again, from there on.  Records:
+
+        {"op": "set", "i": n, "msg": {...}}     message n (n == current length appends)
+        {"op": "len", "n": n}                   the conversation shrank to n messages
+
+    Records are buffered and written by flush(), at the end of each model turn.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.file = None
+        self.signatures: list[tuple] = []     # (message, content, length) of the messages as journaled
+
+    def sync(self, messages: list[dict]) -> None:
+        """Journal what changed since the last sync: usually just the messages appended since"""
+        start = 0
+        for start, signature in enumerate(self.signatures):
+            if start >= len(messages) or not _unchanged(messages[start], signature):
+                break
+        else:
+            start = len(self.signatures)
+
+        if self.file is None:
+            self.file = open(self.filename, 'a', encoding='utf-8')
+
+        if len(messages) < len(self.signatures):
+            self.file.write(json.dumps({"op": "len", "n": start}) + '\n')
+        for i in range(start, len(messages)):
+            self.file.write(json.dumps({"op": "set", "i": i, "msg": messages[i]}) + '\n')
+
+        self.signatures[start:] = [_signature(msg) for msg in messages[start:]]
+
+    def flush(self) -> None:
+        if self.file:
+            self.file.flush()
+
+    def close(self) -> None:
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+def read_journal(filename: str) -> list[dict]:
+    """Rebuild the conversation from a journal, a torn last line (crash during a write) is ignored"""
+    messages = []
+    with open(filename, 'r', encoding='utf-8') as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if record['op'] == 'set':
+                if record['i'] == len(messages):
+                    messages.append(record['msg'])
+                else:
+                    messages[record['i']] = record['msg']
+            elif record['op'] == 'len':
+                del messages[record['n']:]
+    return messages
+
+
+if __name__ == "__main__":
+    # Print the rebuilt conversation:  python -m kestep.kestep_journal logs/<step>_messages.jsonl
+    json.dump(read_journal(sys.argv[1]), sys.stdout, indent=4)
+    print()
@@ -0,0 +1,53 @@
+import mmap
+import os
+from typing import Iterator
+
+from kestep.kestep_tokens import CHARS_PER_TOKEN, DEFAULT_CHARS_PER_TOKEN
+
+MAP_WORKERS = 4             # parts of a .map requested at the same time, unless .map says "jobs"
+MIN_CHUNK_TOKENS = 256
+
+
+def open_mapped(path: str) -> mmap.mmap:
+    """Map a file read-only: parts are decoded when their request is built, the file is never read whole"""
+    if os.path.getsize(path) == 0:
+        raise ValueError(f"{path} is empty, nothing to map")
+    with open(path, 'rb') as file:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def chunk_bytes(company: str, tokens: int) -> int:
+    """Bytes of a chunk of about tokens tokens (a byte is at most a character, so never more tokens)"""
+    return max(1, int(tokens * CHARS_PER_TOKEN.get(company, DEFAULT_CHARS_PER_TOKEN)))
+
+
+def chunk_bounds(data: mmap.mmap | bytes, size: int) -> Iterator[tuple[int, int]]:
+    """(start, end) of consecutive chunks of at most size bytes covering data.
+
+    A chunk ends after its last newline, unless that would make it less than half the size
+    (long lines), and never inside a utf-8 character.
+    """
+    length = len(data)
+    start = 0
+    while start < length:
+        end = min(length, start + size)
+        if end < length:
+            newline = data.rfind(b'\n', start, end)
+            if newline >= start + size // 2:
+                end = newline + 1
+            else:
+                while end > start + 1 and data[end] & 0xC0 == 0x80:    # utf-8 continuation byte
+                    end -= 1
+        yield start, end
+        start = end
+
+
+def response_text(messages: list[dict]) -> str:
+    """Text of the last assistant message (OpenAI content string or Anthropic text blocks)"""
+    for msg in reversed(messages):
+        if msg.get('role') == 'assistant':
+            content = msg.get('content')
+            if isinstance(content, list):
+                return ''.join(block.get('text', '') for block in content if block.get('type') == 'text')
+            return content or ''
+    return ''
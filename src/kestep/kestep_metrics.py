@@ -0,0 +1,175 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Optional
+
+from kestep.kestep_util import KESTEP_DIR
+
+METRICS_DIR = os.path.join(KESTEP_DIR, 'metrics')
+
+
+class Span:
+    """One timed phase of a step: parse, prepare, serialize, connect, tls, send, wait, receive, decode, tool..."""
+
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'start', 'duration', 'attrs')
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attrs: dict[str, any],
+                 start: float = None, duration: float = 0.0):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.start = time.time() if start is None else start
+        self.duration = duration
+        self.attrs = attrs
+
+    def to_dict(self) -> dict[str, any]:
+        return {'name': self.name, 'trace_id': self.trace_id, 'span_id': self.span_id, 'parent_id': self.parent_id,
+                'start': round(self.start, 6), 'duration': round(self.duration, 6), **self.attrs}
+
+
+def step_attrs(step) -> dict[str, any]:
+    return {'step': os.path.basename(step.filename), 'company': step.company or '', 'model': step.model_name or ''}
+
+
+class Metrics:
+    """Collects spans while steps run, exported when kestep ends (JSONL, Prometheus textfile, OTLP/HTTP).
+
+    Disabled (the default) span() costs one attribute test and returns a shared no-op context.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.spans: list[Span] = []
+        self.lock = threading.Lock()
+
+    def add(self, span: Span) -> None:
+        with self.lock:
+            self.spans.append(span)
+
+    def span(self, name: str, step=None, parent: Span = None, **attrs):
+        """Context manager timing its block, yields the Span (None when disabled) to add attributes to"""
+        if not self.enabled:
+            return nullcontext()
+        return self._span(name, step, parent, attrs)
+
+    @contextmanager
+    def _span(self, name: str, step, parent: Optional[Span], attrs: dict[str, any]):
+        span = self.begin(name, step, parent, **attrs)
+        try:
+            yield span
+        except BaseException:
+            span.attrs['error'] = True
+            raise
+        finally:
+            self.end(span)
+
+    def begin(self, name: str, step=None, parent: Span = None, **attrs) -> Optional[Span]:
+        """Start a span that end() completes, for phases not fitting a with block"""
+        if not self.enabled:
+            return None
+        if step is not None:
+            attrs = {**step_attrs(step), **attrs}
+        elif parent is not None:
+            attrs = {**{k: v for k, v in parent.attrs.items() if k in ('step', 'company', 'model', 'turn')}, **attrs}
+        trace_id = parent.trace_id if parent else step.trace_id if step is not None else os.urandom(16).hex()
+        span = Span(name, trace_id, parent.span_id if parent else None, attrs)
+        span.duration = time.perf_counter()     # start reference until end()
+        return span
+
+    def end(self, span: Optional[Span], **attrs) -> None:
+        if span is not None:
+            span.duration = time.perf_counter() - span.duration
+            span.attrs.update(attrs)
+            self.add(span)
+
+    def record(self, name: str, start: float, duration: float, parent: Span = None, **attrs) -> None:
+        """Add a span measured elsewhere (e.g. by the http PhaseTimer)"""
+        if self.enabled and parent is not None:
+            inherited = {k: v for k, v in parent.attrs.items() if k in ('step', 'company', 'model', 'turn')}
+            self.add(Span(name, parent.trace_id, parent.span_id, {**inherited, **attrs}, start, duration))
+
+    # Exports
+
+    def write_jsonl(self, path: str) -> None:
+        """Append the spans, one json object per line"""
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'a') as file:
+            file.write(''.join(json.dumps(span.to_dict()) + '\n' for span in self.spans))
+
+    def prometheus_text(self) -> str:
+        durations: dict[tuple, list[float]] = {}
+        tokens: dict[tuple, int] = {}
+        for span in self.spans:
+            labels = (span.name, span.attrs.get('company', ''), span.attrs.get('model', ''))
+            entry = durations.setdefault(labels, [0.0, 0, 0.0])
+            entry[0] += span.duration
+            entry[1] += 1
+            entry[2] = max(entry[2], span.duration)
+            if span.name == 'request':
+                for direction in ('in', 'out'):
+                    key = (direction, labels[1], labels[2])
+                    tokens[key] = tokens.get(key, 0) + span.attrs.get(f'toks_{direction}', 0)
+
+        def label_str(**labels) -> str:
+            return ','.join(f'{k}="{str(v).replace(chr(34), "")}"' for k, v in labels.items())
+
+        lines = ['# HELP kestep_span_seconds Time spent in each phase of the steps of the last kestep run',
+                 '# TYPE kestep_span_seconds summary']
+        for (name, company, model), (total, count, _) in sorted(durations.items()):
+            labels = label_str(span=name, company=company, model=model)
+            lines.append(f'kestep_span_seconds_sum{{{labels}}} {total:.6f}')
+            lines.append(f'kestep_span_seconds_count{{{labels}}} {count}')
+        lines += ['# HELP kestep_span_seconds_max Longest span of each phase',
+                  '# TYPE kestep_span_seconds_max gauge']
+        for (name, company, model), (_, _, longest) in sorted(durations.items()):
+            lines.append(f'kestep_span_seconds_max{{{label_str(span=name, company=company, model=model)}}} {longest:.6f}')
+        lines += ['# HELP kestep_tokens_total Tokens sent (in) and received (out)',
+                  '# TYPE kestep_tokens_total counter']
+        for (direction, company, model), count in sorted(tokens.items()):
+            lines.append(f'kestep_tokens_total{{{label_str(direction=direction, company=company, model=model)}}} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str) -> None:
+        """node_exporter textfile collector format, replaced atomically"""
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(f"{path}.{os.getpid()}.tmp", 'w') as file:
+            file.write(self.prometheus_text())
+        os.replace(f"{path}.{os.getpid()}.tmp", path)
+
+    def otlp_payload(self) -> dict[str, any]:
+        def value(v: any) -> dict[str, any]:
+            if isinstance(v, bool):
+                return {'boolValue': v}
+            if isinstance(v, int):
+                return {'intValue': str(v)}
+            if isinstance(v, float):
+                return {'doubleValue': v}
+            return {'stringValue': str(v)}
+
+        spans = [{
+            'traceId': span.trace_id,
+            'spanId': span.span_id,
+            **({'parentSpanId': span.parent_id} if span.parent_id else {}),
+            'name': span.name,
+            'kind': 1,
+            'startTimeUnixNano': str(int(span.start * 1e9)),
+            'endTimeUnixNano': str(int((span.start + span.duration) * 1e9)),
+            'attributes': [{'key': k, 'value': value(v)} for k, v in span.attrs.items()],
+        } for span in self.spans]
+        return {'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': 'kestep'}}]},
+            'scopeSpans': [{'scope': {'name': 'kestep'}, 'spans': spans}],
+        }]}
+
+    def send_otlp(self, endpoint: str) -> None:
+        """OTLP/HTTP with JSON encoding to a collector (e.g. http://localhost:4318), no OpenTelemetry SDK needed"""
+        from kestep.kestep_http import get_client
+        url = f"{endpoint.rstrip('/')}/v1/traces"
+        get_client(url).post(url, json=self.otlp_payload(), timeout=10.0).raise_for_status()
+
+
+# The process wide collector, enabled by --metrics / --otlp
+metrics = Metrics()
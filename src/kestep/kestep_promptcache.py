@@ -0,0 +1,87 @@
+CACHE_CONTROL = {"type": "ephemeral"}
+MAX_BREAKPOINTS = 4         # Anthropic rejects requests with more cache_control blocks
+CACHE_MIN_TOKENS = 1024     # Shorter prefixes are not cached, so smaller .include blocks are not marked
+
+
+def with_breakpoint(block: any) -> dict:
+    if isinstance(block, str):
+        block = {"type": "text", "text": block}
+    return {**block, "cache_control": CACHE_CONTROL}
+
+
+def add_breakpoints(messages: list[dict], system: str, marked: dict[int, dict],
+                    copies: dict[tuple[int, int], tuple] = None) -> tuple[list[dict], any]:
+    """Anthropic prompt caching: return (messages, system) for a request, with cache_control breakpoints.
+
+    Breakpoints go on the system prompt, on the last of the marked blocks (.cache, large .include/.image)
+    and on the last block of the conversation, so the next turn of a tool loop reads everything before it
+    from the cache.  Only the messages carrying a breakpoint are copied, step.messages stays as it is.
+    Given a copies dict (kept by the caller between turns), an unchanged message gets the same copy again,
+    so its serialized form can be reused.
+    """
+    if system:
+        system = [with_breakpoint(system)]
+    if not messages:
+        return messages, system
+
+    available = MAX_BREAKPOINTS - (1 if system else 0) - 1     # one for the conversation tail
+    last_msg = len(messages) - 1
+    positions = []
+    if marked:
+        for msg_idx, msg in enumerate(messages):
+            content = msg.get('content')
+            if isinstance(content, list):
+                positions.extend((msg_idx, block_idx) for block_idx, block in enumerate(content)
+                                 if id(block) in marked and marked[id(block)] is block)
+    positions = positions[-available:] if available > 0 else []
+    tail_content = messages[last_msg].get('content')
+    tail = (last_msg, len(tail_content) - 1 if isinstance(tail_content, list) else -1)
+    if tail not in positions:
+        positions.append(tail)
+
+    messages = list(messages)
+    used = {}
+    for msg_idx, block_idx in positions:
+        msg = messages[msg_idx]
+        content = msg['content']
+        length = len(content) if isinstance(content, list) else -1
+        previous = copies.get((id(msg), block_idx)) if copies is not None else None
+        if previous and previous[0] is msg and previous[1] is content and previous[2] == length:
+            messages[msg_idx] = previous[3]
+        else:
+            if isinstance(content, str):
+                content = [with_breakpoint(content)]
+            elif content:
+                content = list(content)
+                content[block_idx] = with_breakpoint(content[block_idx])
+            messages[msg_idx] = {**msg, 'content': content}
+        used[(id(msg), block_idx)] = (msg, msg['content'], length, messages[msg_idx])
+    if copies is not None:
+        copies.clear()
+        copies.update(used)
+    return messages, system
+
+
+def nested(obj: dict[str, any], keys: list[str]) -> any:
+    for key in keys:
+        if not isinstance(obj, dict):
+            return None
+        obj = obj.get(key)
+    return obj
+
+
+def input_usage(llm: dict[str, any], usage: dict[str, any]) -> tuple[int, int, int]:
+    """Split the reported input tokens into (uncached, read from cache, written to cache)"""
+    toks_in = usage.get(llm['usage_keys'][0]) or 0
+    cache_read = nested(usage, llm['cache_read_keys']) if 'cache_read_keys' in llm else 0
+    cache_write = nested(usage, llm['cache_write_keys']) if 'cache_write_keys' in llm else 0
+    cache_read, cache_write = cache_read or 0, cache_write or 0
+    if llm.get('cached_in_input'):     # OpenAI counts cached tokens in prompt_tokens as well
+        toks_in -= cache_read + cache_write
+    return toks_in, cache_read, cache_write
+
+
+def input_cost(llm: dict[str, any], model: dict[str, any], toks_in: int, cache_read: int, cache_write: int) -> float:
+    price = model['input']
+    return (toks_in + cache_read * llm.get('cache_read_price', 1.0)
+            + cache_write * llm.get('cache_write_price', 1.0)) * price
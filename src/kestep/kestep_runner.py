@@ -0,0 +1,274 @@
+import glob
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from rich.console import Console
+from rich.table import Table
+
+from kestep.kestep import PromtpStep
+from kestep.kestep_fingerprint import fingerprints
+from kestep.kestep_graph import build_graph, topological_order, produces, step_timings, Plan
+from kestep.kestep_metrics import metrics
+
+console = Console()
+
+
+class StepResult:
+    """Outcome of executing one step file"""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.exit_code: int = 0
+        self.error: str = ''
+        self.wall_time: float = 0.0
+        self.toks_in: int = 0
+        self.toks_out: int = 0
+        self.cost: float = 0.0
+        self.outputs: list[str] = []    # files written by the step
+        self.up_to_date = ''            # 'up to date' or 'restored' when the step was not run
+
+    @property
+    def ok(self) -> bool:
+        return self.exit_code == 0
+
+
+def run_step(step_file: str, debug: bool = False, quiet: bool = False, resume: bool = False) -> StepResult:
+    """Parse and execute a single step, turning sys.exit() and exceptions into a failed StepResult.
+
+    resume: continue from the step's checkpoint (kestep_checkpoint) when it has one.
+    """
+    result = StepResult(step_file)
+    start_time = time.time()
+    step = PromtpStep(step_file, debug, quiet=quiet)
+    span = metrics.begin('step', step)
+    try:
+        step.parse_prompt()
+        step.execute(resume=resume)
+    except SystemExit as e:
+        if e.code:
+            result.exit_code = e.code if isinstance(e.code, int) else 1
+            result.error = f"exit({e.code})"
+    except Exception as e:
+        result.exit_code = 9
+        result.error = str(e)
+    finally:
+        result.wall_time = time.time() - start_time
+        result.toks_in = step.toks_in
+        result.toks_out = step.toks_out
+        result.cost = step.total
+        result.outputs = step.written
+        metrics.end(span, company=step.company or '', model=step.model_name or '', exit_code=result.exit_code,
+                    toks_in=step.toks_in, toks_out=step.toks_out, cost=step.total)
+    return result
+
+
+def skipped_step(step_file: str, failed: list[str]) -> StepResult:
+    result = StepResult(step_file)
+    result.exit_code = 9
+    result.error = f"skipped, {', '.join(os.path.basename(f) for f in failed)} failed"
+    return result
+
+
+def run_steps(step_files: list[str], debug: bool = False, jobs: int = 1, force: bool = False,
+              restore: bool = False, resume: bool = False) -> list[StepResult]:
+    """Execute step files, up to jobs of them at the same time.
+
+    A step reading a file another step writes (kestep_graph) starts once that step has finished, and is
+    skipped when it failed.  Steps unchanged since their last successful run (kestep_fingerprint) are not run
+    unless force, restore copies back their outputs when these changed.  resume continues steps from their
+    checkpoints.  With more than one job the steps
+    only write to their own log/svg files, the terminal just gets a line per finished step.
+    Results are returned in step_files order.
+    """
+    nodes = build_graph(step_files)
+    order = topological_order(nodes)
+    results: dict[str, StepResult] = {}
+
+    def run_if_changed(step_file: str, quiet: bool = False) -> StepResult:
+        fingerprint = fingerprints.fingerprint(nodes[step_file])   # of the inputs as they are now
+        state = '' if force else fingerprints.check(nodes[step_file], fingerprint, restore)
+        if state:
+            result = StepResult(step_file)
+            result.up_to_date = state
+            return result
+        result = run_step(step_file, debug, quiet, resume)
+        if result.ok:
+            fingerprints.store(nodes[step_file], fingerprint, nodes[step_file].outputs + result.outputs)
+        return result
+
+    def ready(step_file: str) -> bool:
+        return step_file not in results and all(dep in results for dep in nodes[step_file].deps)
+
+    def failed_deps(step_file: str) -> list[str]:
+        return [dep for dep in nodes[step_file].deps if not results[dep].ok]
+
+    if jobs <= 1:
+        for step_file in order:
+            failed = failed_deps(step_file)
+            results[step_file] = skipped_step(step_file, failed) if failed else run_if_changed(step_file)
+            if results[step_file].up_to_date:
+                console.print(f"{os.path.basename(step_file)}: [bold green]{results[step_file].up_to_date}[/]")
+    else:
+        with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='step') as executor:
+            running = {}
+            while True:
+                for step_file in order:     # dependents start as soon as their inputs are written
+                    if step_file in running.values() or not ready(step_file):
+                        continue
+                    failed = failed_deps(step_file)
+                    if failed:
+                        results[step_file] = skipped_step(step_file, failed)
+                        console.print(f"{os.path.basename(step_file)}: [bold red]{results[step_file].error}[/]")
+                    else:
+                        running[executor.submit(run_if_changed, step_file, True)] = step_file
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    results[running.pop(future)] = result
+                    if result.up_to_date:
+                        console.print(f"{os.path.basename(result.filename)}: [bold green]{result.up_to_date}[/]")
+                        continue
+                    status = "[bold green]done[/]" if result.ok else f"[bold red]failed {result.error}[/]"
+                    console.print(f"{os.path.basename(result.filename)}: {status} in {result.wall_time:.2f} secs")
+
+    step_timings.record({r.filename: r.wall_time for r in results.values() if r.ok and not r.up_to_date})
+    with fingerprints.lock:
+        fingerprints.save()     # file hashes learned while checking
+    return [results[step_file] for step_file in step_files]
+
+
+def print_plan(step_files: list[str]) -> Plan:
+    """The dependency graph of step_files, when each step could start and the critical path"""
+    nodes = build_graph(step_files)
+    plan = Plan(nodes)
+
+    table = Table(title="Plan")
+    table.add_column("Step", style="cyan", no_wrap=True)
+    table.add_column("After", style="magenta", overflow="fold")
+    table.add_column("Inputs", style="green", overflow="fold")
+    table.add_column("Outputs", style="green", overflow="fold")
+    table.add_column("Secs", justify="right")
+    table.add_column("Start", style="magenta", justify="right")
+    table.add_column("Finish", style="magenta", justify="right")
+
+    outputs = [output for node in nodes.values() for output in node.outputs]
+    for f in plan.order:
+        node = nodes[f]
+        name = f"[bold]{os.path.basename(f)}[/]" if f in plan.critical_path else os.path.basename(f)
+        if node.error:
+            name = f"{name} [bold red]{node.error}[/]"
+        inputs = [path if glob.glob(path) or any(produces(output, path) for output in outputs)
+                  else f"[bold red]{path} (missing)[/]" for path in node.inputs]
+        secs = f"{plan.seconds[f]:.1f}" if plan.measured[f] else f"~{plan.seconds[f]:.0f}"
+        table.add_row(name, ', '.join(os.path.basename(dep) for dep in node.deps), ', '.join(inputs),
+                      ', '.join(node.outputs), secs, f"{plan.start[f]:.1f}", f"{plan.finish[f]:.1f}")
+
+    console.print(table)
+    path = ' -> '.join(os.path.basename(f) for f in plan.critical_path)
+    console.print(f"Critical path: [bold]{path}[/] {plan.makespan:.1f} secs "
+                  f"(all steps one after another: {sum(plan.seconds.values()):.1f} secs, "
+                  f"~ marks steps that never ran)")
+    return plan
+
+
+class StepEstimate:
+    """Dry run estimate of one step file's input tokens and cost"""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.model_name: str = ''
+        self.requests: list[int] = []     # estimated input tokens of each .exec
+        self.context: int = 0
+        self.cost: float = 0.0
+        self.error: str = ''
+
+    @property
+    def toks_in(self) -> int:
+        return sum(self.requests)
+
+    @property
+    def over(self) -> bool:
+        return any(tokens > self.context for tokens in self.requests)
+
+
+def estimate_step(step_file: str) -> StepEstimate:
+    estimate = StepEstimate(step_file)
+    step = PromtpStep(step_file, quiet=True)
+    try:
+        step.parse_prompt()
+        estimate.requests = step.estimate()
+        if step.model:
+            estimate.model_name = step.model_name
+            # the context left for input, the output the requests ask for kept free
+            estimate.context = int(step.model['context']) - int(step.data and step.data.get('max_tokens') or 0)
+            estimate.cost = estimate.toks_in * step.model['input']
+    except SystemExit as e:
+        estimate.error = f"exit({e.code})"
+    except Exception as e:
+        estimate.error = str(e)
+    return estimate
+
+
+def estimate_steps(step_files: list[str], jobs: int = None) -> list[StepEstimate]:
+    """Estimate step files in parallel, no network access.  Results are returned in step_files order."""
+    with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='estimate') as executor:
+        return list(executor.map(estimate_step, step_files))
+
+
+def print_estimate_summary(estimates: list[StepEstimate]) -> None:
+    table = Table(title="Estimated Input (before responses)")
+    table.add_column("Step", style="cyan", no_wrap=True)
+    table.add_column("Model", style="green", overflow="fold")
+    table.add_column("Requests", style="magenta", justify="right")
+    table.add_column("Tokens In", style="green", justify="right")
+    table.add_column("Largest", justify="right")
+    table.add_column("Context", style="magenta", justify="right")
+    table.add_column("Cost $", style="green", justify="right")
+
+    for e in estimates:
+        if e.error:
+            table.add_row(os.path.basename(e.filename), f"[bold red]{e.error}[/]", "", "", "", "", "")
+            continue
+        largest = max(e.requests, default=0)
+        largest = f"[bold red]{largest}[/]" if e.over else str(largest)
+        table.add_row(os.path.basename(e.filename), e.model_name, str(len(e.requests)), str(e.toks_in),
+                      largest, str(e.context), f"{e.cost:06.4f}")
+
+    table.add_section()
+    table.add_row("Total", "", str(sum(len(e.requests) for e in estimates)), str(sum(e.toks_in for e in estimates)),
+                  "", "", f"{sum(e.cost for e in estimates):06.4f}")
+
+    console.print(table)
+
+
+def print_run_summary(results: list[StepResult], wall_time: float) -> None:
+    table = Table(title="Run Summary")
+    table.add_column("Step", style="cyan", no_wrap=True)
+    table.add_column("Status", no_wrap=True)
+    table.add_column("Secs", style="magenta", justify="right")
+    table.add_column("Tokens In", style="green", justify="right")
+    table.add_column("Tokens Out", style="green", justify="right")
+    table.add_column("Cost $", style="green", justify="right")
+
+    for r in results:
+        status = "[bold green]ok[/]" if r.ok else f"[bold red]{r.error or 'failed'}[/]"
+        if r.up_to_date:
+            status = f"[green]{r.up_to_date}[/]"
+        table.add_row(os.path.basename(r.filename), status, f"{r.wall_time:.2f}",
+                      str(r.toks_in), str(r.toks_out), f"{r.cost:06.4f}")
+
+    not_run = sum(bool(r.up_to_date) for r in results)
+    table.add_section()
+    table.add_row("Total", f"{sum(r.ok for r in results)}/{len(results)} ok" + (f", {not_run} not run" if not_run else ''),
+                  f"{wall_time:.2f}",
+                  str(sum(r.toks_in for r in results)), str(sum(r.toks_out for r in results)),
+                  f"{sum(r.cost for r in results):06.4f}")
+
+    console.print(table)
+
+
+def exit_code(results: list[StepResult]) -> int:
+    return max((r.exit_code for r in results), default=0)
@@ -0,0 +1,181 @@
+import email.utils
+import random
+import re
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+
+# Responses to a POST that are safe to send again, the request was not processed: rate limits,
+# unavailable and Anthropic's "overloaded"
+RETRY_STATUS = {429, 503, 529}
+# Besides RETRY_STATUS, the statuses a provider documents as to be retried
+PROVIDER_RETRY_STATUS = {
+    'OpenAI': {500},    # "The server had an error while processing your request: retry after a brief wait"
+}
+
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF_BASE = 1.0      # seconds, doubled by every attempt
+DEFAULT_BACKOFF_MAX = 60.0
+
+
+class TokenBucket:
+    """Refills at rate_per_minute up to capacity (one minute's worth).
+
+    reserve() takes what it needs immediately, going into debt when the bucket is short, and returns how
+    long the caller must wait for the debt to be refilled.  Concurrent callers so queue up in order.
+    """
+
+    def __init__(self, rate_per_minute: float):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(rate_per_minute)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float, now: float) -> float:
+        self.refill(now)
+        self.level -= min(amount, self.capacity)    # one oversized request must not block forever
+        return 0.0 if self.level >= 0 else -self.level / self.rate
+
+    def give_back(self, amount: float) -> None:
+        self.level = min(self.capacity, self.level + amount)
+
+
+def parse_duration(value: str) -> Optional[float]:
+    """Seconds in a rate limit header: '12', '1.5', '6m0s', '20ms', an RFC 3339 or an HTTP date"""
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value)
+    if parts and ''.join(n + u for n, u in parts) == value:
+        scale = {'h': 3600.0, 'm': 60.0, 's': 1.0, 'ms': 0.001}
+        return sum(float(n) * scale[u] for n, u in parts)
+
+    try:
+        when = datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        try:
+            when = email.utils.parsedate_to_datetime(value).timestamp()
+        except (TypeError, ValueError):
+            return None
+    return max(0.0, when - time.time())
+
+
+def retry_after(headers: dict[str, str]) -> Optional[float]:
+    if headers.get('retry-after-ms'):
+        try:
+            return float(headers['retry-after-ms']) / 1000.0
+        except ValueError:
+            pass
+    if headers.get('retry-after'):
+        return parse_duration(headers['retry-after'])
+    return None
+
+
+# (remaining, reset) header pairs of the providers' rate limit reporting
+RATE_LIMIT_HEADERS = [
+    ('x-ratelimit-remaining-requests', 'x-ratelimit-reset-requests'),
+    ('x-ratelimit-remaining-tokens', 'x-ratelimit-reset-tokens'),
+    ('anthropic-ratelimit-requests-remaining', 'anthropic-ratelimit-requests-reset'),
+    ('anthropic-ratelimit-tokens-remaining', 'anthropic-ratelimit-tokens-reset'),
+    ('anthropic-ratelimit-input-tokens-remaining', 'anthropic-ratelimit-input-tokens-reset'),
+]
+
+
+class RetryPolicy:
+    """Retries of one step's requests, from its .llm: max_retries, backoff_base, backoff_max.
+
+    Passed with every request, steps sharing a ProviderScheduler keep their own settings.
+    """
+
+    def __init__(self, llm: dict[str, any]):
+        self.max_retries = int(llm.get('max_retries', DEFAULT_MAX_RETRIES))
+        self.backoff_base = float(llm.get('backoff_base', DEFAULT_BACKOFF_BASE))
+        self.backoff_max = float(llm.get('backoff_max', DEFAULT_BACKOFF_MAX))
+        self.status = RETRY_STATUS | PROVIDER_RETRY_STATUS.get(llm.get('company'), set())
+
+    def backoff(self, attempt: int) -> float:
+        """Jittered exponential backoff before retry number attempt (0 based)"""
+        ceiling = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        return random.uniform(ceiling / 2, ceiling)
+
+
+class ProviderScheduler:
+    """Paces the requests of all steps to one company: request and token buckets (when rpm/tpm are
+    configured), pauses announced by the provider (Retry-After, exhausted rate limit headers) and the
+    backoff between retries (as the RetryPolicy of the retried request says)."""
+
+    def __init__(self, company: str):
+        self.company = company
+        self.requests: Optional[TokenBucket] = None
+        self.tokens: Optional[TokenBucket] = None
+        self.paused_until = 0.0     # time.monotonic()
+        self.lock = threading.Lock()
+
+    def configure(self, llm: dict[str, any]) -> None:
+        """Limits from api_config/.llm: rpm, tpm"""
+        with self.lock:
+            if llm.get('rpm') and (self.requests is None or self.requests.capacity != llm['rpm']):
+                self.requests = TokenBucket(llm['rpm'])
+            if llm.get('tpm') and (self.tokens is None or self.tokens.capacity != llm['tpm']):
+                self.tokens = TokenBucket(llm['tpm'])
+
+    def acquire(self, tokens: int = 0) -> float:
+        """Wait for a slot to send a request of about tokens input tokens, returns the seconds waited"""
+        with self.lock:
+            now = time.monotonic()
+            wait = max(0.0, self.paused_until - now)
+            if self.requests:
+                wait = max(wait, self.requests.reserve(1, now))
+            if self.tokens and tokens:
+                wait = max(wait, self.tokens.reserve(tokens, now))
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def settle(self, estimated: int, actual: int) -> None:
+        """Correct the token bucket once the provider reported the tokens actually used"""
+        if self.tokens and estimated:
+            with self.lock:
+                self.tokens.give_back(estimated - actual)
+
+    def pause(self, seconds: float) -> None:
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def observe(self, headers: dict[str, str]) -> None:
+        """Pause the provider until the reset of any rate limit its response headers report as exhausted"""
+        for remaining, reset in RATE_LIMIT_HEADERS:
+            if headers.get(remaining) in ('0', '0.0') and headers.get(reset):
+                seconds = parse_duration(headers[reset])
+                if seconds:
+                    self.pause(seconds)
+
+    def retry_delay(self, attempt: int, policy: RetryPolicy, headers: dict[str, str] = None) -> float:
+        """Seconds before retry number attempt (0 based): the provider's Retry-After, else the policy's backoff"""
+        delay = retry_after(headers) if headers else None
+        if delay is None:
+            delay = policy.backoff(attempt)
+        self.pause(delay)   # other steps using the provider back off as well
+        return delay
+
+
+_schedulers: dict[str, ProviderScheduler] = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(llm: dict[str, any]) -> ProviderScheduler:
+    """The scheduler of llm's company, shared by all steps, its buckets (re)configured from llm"""
+    with _schedulers_lock:
+        scheduler = _schedulers.get(llm['company'])
+        if scheduler is None:
+            scheduler = _schedulers[llm['company']] = ProviderScheduler(llm['company'])
+    scheduler.configure(llm)
+    return scheduler
@@ -0,0 +1,84 @@
+import atexit
+import hashlib
+import json
+import os
+import threading
+from typing import Callable, Iterable
+
+from kestep.kestep_util import KESTEP_DIR
+
+# Bump when the statement rows produced by PromtpStep.compile_prompt change meaning
+STEP_CACHE_VERSION = 1
+
+StatementRow = tuple[str, str, int, int]  # keyword, value, msg_no, source line
+
+
+class StepCache:
+    """Compiled statements of .prompt files, kept in a single compact json index.
+
+    An entry is valid while the file's (mtime, size) are unchanged, so a warm lookup costs one
+    stat() call.  When the stat differs the content hash decides: a touched but unchanged file is
+    not parsed again.  The index is loaded on first use and written back at exit when it changed.
+    """
+
+    def __init__(self, path: str = os.path.join(KESTEP_DIR, 'steps.json')):
+        self.path = path
+        self.entries: dict[str, list] = None    # abspath -> [mtime_ns, size, sha256, rows]
+        self.syntax: str = ''
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def load(self, syntax: str) -> None:
+        if self.entries is not None and self.syntax == syntax:
+            return
+        self.entries = {}
+        self.syntax = syntax
+        try:
+            with open(self.path, 'r') as file:
+                index = json.load(file)
+            if index.get('version') == STEP_CACHE_VERSION and index.get('syntax') == syntax:
+                self.entries = index['entries']
+                for entry in self.entries.values():
+                    entry[3] = [tuple(row) for row in entry[3]]
+        except (OSError, ValueError, KeyError):
+            pass    # missing or unreadable cache: start empty
+
+    def statements(self, filename: str, compile_prompt: Callable[[str], list[StatementRow]],
+                   syntax: Iterable[str] = ()) -> list[StatementRow]:
+        """Return the statement rows of filename, running compile_prompt(text) only when it changed"""
+        key = os.path.abspath(filename)
+        st = os.stat(key)
+        with self.lock:
+            self.load(','.join(sorted(syntax)))
+            entry = self.entries.get(key)
+        if entry and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+            return entry[3]
+
+        with open(key, 'rb') as file:
+            blob = file.read()
+        sha = hashlib.sha256(blob).hexdigest()
+        if entry and entry[2] == sha:
+            rows = entry[3]
+        else:
+            rows = [tuple(row) for row in compile_prompt(blob.decode('utf-8'))]
+
+        with self.lock:
+            self.entries[key] = [st.st_mtime_ns, st.st_size, sha, rows]
+            self.dirty = True
+        return rows
+
+    def save(self) -> None:
+        with self.lock:
+            if not self.dirty:
+                return
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as file:
+                json.dump({'version': STEP_CACHE_VERSION, 'syntax': self.syntax, 'entries': self.entries},
+                          file, separators=(',', ':'))
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+
+
+step_cache = StepCache()
+atexit.register(step_cache.save)
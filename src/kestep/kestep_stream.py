@@ -0,0 +1,205 @@
+import abc
+import json
+from typing import Callable, Iterable, Iterator, Optional
+
+
+def iter_sse(lines: Iterable[str]) -> Iterator[tuple[str, str]]:
+    """Split a Server-Sent-Events line stream into (event, data) pairs.
+
+    Blank lines terminate an event, multiple data: lines are joined with newlines.
+    """
+    event = ''
+    data: list[str] = []
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.rstrip('\r')
+
+        if not line:
+            if data:
+                yield event, '\n'.join(data)
+            event = ''
+            data = []
+            continue
+
+        if line[0] == ':':      # SSE comment / keep-alive
+            continue
+
+        field, _, value = line.partition(':')
+        if value.startswith(' '):
+            value = value[1:]
+
+        if field == 'event':
+            event = value
+        elif field == 'data':
+            data.append(value)
+
+    if data:
+        yield event, '\n'.join(data)
+
+
+class _StreamAccumulator(abc.ABC):
+    """Rebuild a complete (non-streaming) response object from stream chunks.
+
+    on_first_token() is called once, when the first text or tool call delta arrives.
+    on_text(delta) is called for every text delta, to allow live rendering.
+    """
+
+    def __init__(self, on_text: Optional[Callable[[str], None]] = None,
+                 on_first_token: Optional[Callable[[], None]] = None):
+        self.on_text = on_text
+        self.on_first_token = on_first_token
+        self.got_first_token = False
+
+    def first_token(self) -> None:
+        if not self.got_first_token:
+            self.got_first_token = True
+            if self.on_first_token:
+                self.on_first_token()
+
+    def text(self, delta: str) -> None:
+        if not delta:
+            return
+        self.first_token()
+        if self.on_text:
+            self.on_text(delta)
+
+    @abc.abstractmethod
+    def feed(self, event: str, data: dict) -> None:
+        """Add one decoded SSE event"""
+
+    @abc.abstractmethod
+    def result(self) -> dict:
+        """The response object, as the non-streaming API returns it"""
+
+    def consume(self, lines: Iterable[str]) -> dict:
+        for event, data in iter_sse(lines):
+            if data == '[DONE]':
+                break
+            self.feed(event, json.loads(data))
+        return self.result()
+
+
+class OpenAIStream(_StreamAccumulator):
+    """Chat completions chunks (OpenAI, XAI, MistralAI)"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.role = 'assistant'
+        self.content: list[str] = []
+        self.tool_calls: dict[int, dict] = {}
+        self.finish_reason = None
+        self.usage = {}
+        self.header = {}
+
+    def feed(self, event: str, data: dict) -> None:
+        if 'error' in data:
+            raise Exception(f"Error in stream: {data['error']}")
+
+        for key in ['id', 'object', 'created', 'model']:
+            if key in data:
+                self.header[key] = data[key]
+
+        if data.get('usage'):
+            self.usage = data['usage']
+
+        for choice in data.get('choices', []):
+            delta = choice.get('delta') or {}
+            if delta.get('role'):
+                self.role = delta['role']
+
+            if delta.get('content'):
+                self.content.append(delta['content'])
+                self.text(delta['content'])
+
+            for tc in delta.get('tool_calls') or []:
+                self.first_token()
+                index = tc.get('index', len(self.tool_calls))
+                call = self.tool_calls.setdefault(index, {'id': '', 'type': 'function',
+                                                          'function': {'name': '', 'arguments': ''}})
+                if tc.get('id'):
+                    call['id'] = tc['id']
+                if tc.get('type'):
+                    call['type'] = tc['type']
+                function = tc.get('function') or {}
+                if function.get('name'):
+                    call['function']['name'] += function['name']
+                if function.get('arguments'):
+                    call['function']['arguments'] += function['arguments']
+
+            if choice.get('finish_reason'):
+                self.finish_reason = choice['finish_reason']
+
+    def result(self) -> dict:
+        message = {'role': self.role, 'content': ''.join(self.content) if self.content else None}
+        if self.tool_calls:
+            message['tool_calls'] = [self.tool_calls[i] for i in sorted(self.tool_calls)]
+
+        return {
+            **self.header,
+            'choices': [{'index': 0, 'message': message, 'finish_reason': self.finish_reason}],
+            'usage': self.usage,
+        }
+
+
+class AnthropicStream(_StreamAccumulator):
+    """Messages API events: message_start, content_block_*, message_delta, message_stop"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.message: dict = {}
+        self.blocks: dict[int, dict] = {}
+        self.partial_json: dict[int, list[str]] = {}
+
+    def feed(self, event: str, data: dict) -> None:
+        kind = data.get('type', event)
+
+        match kind:
+            case 'message_start':
+                self.message = data['message']
+                self.message['content'] = []
+
+            case 'content_block_start':
+                block = dict(data['content_block'])
+                self.blocks[data['index']] = block
+                if block['type'] == 'tool_use':
+                    self.first_token()
+                    self.partial_json[data['index']] = []
+                elif block['type'] == 'text' and block.get('text'):
+                    self.text(block['text'])
+
+            case 'content_block_delta':
+                block = self.blocks[data['index']]
+                delta = data['delta']
+                if delta['type'] == 'text_delta':
+                    block['text'] = block.get('text', '') + delta['text']
+                    self.text(delta['text'])
+                elif delta['type'] == 'input_json_delta':
+                    self.partial_json[data['index']].append(delta['partial_json'])
+
+            case 'content_block_stop':
+                index = data['index']
+                if index in self.partial_json:
+                    arguments = ''.join(self.partial_json.pop(index))
+                    self.blocks[index]['input'] = json.loads(arguments) if arguments else {}
+
+            case 'message_delta':
+                self.message.update(data.get('delta', {}))
+                self.message.setdefault('usage', {}).update(data.get('usage', {}))
+
+            case 'error':
+                raise Exception(f"Error in stream: {data['error']}")
+
+    def result(self) -> dict:
+        self.message['content'] = [self.blocks[i] for i in sorted(self.blocks)]
+        return self.message
+
+
+StreamTypes: dict[str, type(_StreamAccumulator)] = {
+    'openai': OpenAIStream,
+    'anthropic': AnthropicStream,
+}
+
+
+def make_stream(stream_format: str, **kwargs) -> _StreamAccumulator:
+    return StreamTypes[stream_format](**kwargs)
@@ -0,0 +1,118 @@
+import json
+import math
+
+CONTEXT_POLICIES = ['report', 'trim', 'refuse']
+
+# Average characters per token of each company's tokenizer on mixed English/code text.
+# Deliberately on the low side: overestimating is cheaper than a rejected request.
+CHARS_PER_TOKEN = {
+    'OpenAI': 3.8,
+    'XAI': 3.8,
+    'Groq': 3.8,
+    'Ollama': 3.8,
+    'MistralAI': 3.4,
+    'Anthropic': 3.4,
+}
+DEFAULT_CHARS_PER_TOKEN = 3.4
+
+MESSAGE_TOKENS = 4      # role, separators and framing of every message
+IMAGE_TOKENS = 1600     # an image costs about the same, whatever its base64 size
+
+_tools_tokens: dict[tuple[str, int], int] = {}     # (company, id(tools array)) -> tokens
+
+
+def content_size(obj: any) -> tuple[int, int]:
+    """Characters of text and number of images in a message, content array or tools array"""
+    if isinstance(obj, str):
+        return len(obj), 0
+    if isinstance(obj, list):
+        chars = images = 0
+        for item in obj:
+            c, i = content_size(item)
+            chars += c
+            images += i
+        return chars, images
+    if isinstance(obj, dict):
+        if obj.get('type') in ('image', 'image_url'):
+            return 0, 1
+        chars = images = 0
+        for key, value in obj.items():
+            c, i = content_size(value)
+            chars += c + len(key)
+            images += i
+        return chars, images
+    if obj is None:
+        return 0, 0
+    return len(str(obj)), 0
+
+
+def text_tokens(company: str, chars: int) -> int:
+    return math.ceil(chars / CHARS_PER_TOKEN.get(company, DEFAULT_CHARS_PER_TOKEN))
+
+
+def message_tokens(company: str, msg: any) -> int:
+    chars, images = content_size(msg)
+    return MESSAGE_TOKENS + text_tokens(company, chars) + images * IMAGE_TOKENS
+
+
+def tools_tokens(company: str, tools: list[dict]) -> int:
+    """The tools array is the same object for every request, so it is only measured once"""
+    key = (company, id(tools))
+    if key not in _tools_tokens:
+        _tools_tokens[key] = text_tokens(company, len(json.dumps(tools)))
+    return _tools_tokens[key]
+
+
+def estimate_tokens(company: str, data: dict[str, any]) -> int:
+    """Estimated input tokens of a request (step.data), no tokenizer or network involved"""
+    tokens = sum(message_tokens(company, msg) for msg in data.get('messages', []))
+    if data.get('system'):
+        tokens += message_tokens(company, data['system'])
+    if data.get('tools'):
+        tokens += tools_tokens(company, data['tools'])
+    return tokens
+
+
+def is_tool_result(company: str, msg: dict) -> bool:
+    if company == 'Anthropic':
+        return (msg.get('role') == 'user' and isinstance(msg.get('content'), list)
+                and any(block.get('type') == 'tool_result' for block in msg['content']))
+    return msg.get('role') == 'tool'
+
+
+def trimmed_text(tokens: int) -> str:
+    return f"[kestep: {tokens} tokens of tool output removed to fit the context window]"
+
+
+def trim_tool_results(company: str, messages: list[dict], excess: int) -> int:
+    """Replace the oldest tool results with a short note until excess tokens are saved, returns the tokens saved.
+
+    Messages are replaced, not modified, so the conversation journal notices.
+    """
+    saved = 0
+    for idx, msg in enumerate(messages):
+        if saved >= excess:
+            break
+        if not isinstance(msg, dict) or not is_tool_result(company, msg):
+            continue
+
+        if company == 'Anthropic':
+            blocks, changed = [], False
+            for block in msg['content']:
+                tokens = message_tokens(company, block.get('content')) - MESSAGE_TOKENS
+                note = trimmed_text(tokens)
+                if block.get('type') == 'tool_result' and saved < excess and tokens > text_tokens(company, len(note)):
+                    saved += tokens - text_tokens(company, len(note))
+                    block = {**block, 'content': note}
+                    changed = True
+                blocks.append(block)
+            if changed:
+                messages[idx] = {**msg, 'content': blocks}
+        else:
+            tokens = message_tokens(company, msg.get('content')) - MESSAGE_TOKENS
+            note = trimmed_text(tokens)
+            if tokens > text_tokens(company, len(note)):
+                saved += tokens - text_tokens(company, len(note))
+                messages[idx] = {**msg, 'content': note}
+
+    return saved
@@ -1,6 +1,5 @@
 import argparse
 import os
-import re
 from typing import Optional
 
 from rich.console import Console
@@ -20,39 +19,35 @@ CIRCLE = "⬤"
 CHAR_SEND_REQUEST = RIGHT_TRIANGLE
 HORIZONTAL_LINE = u"\u2500"
 
+# Working directory for kestep's caches and run state (relative to where kestep runs, like logs/)
+KESTEP_DIR = '.kestep'
+
 
 
 def backup_file(filepath: str, backup_dir: Optional[str] = None, extension: Optional[str] = None) -> str:
     """Version files with numbered backups.
 
+    The existing file (if any) becomes <name>.~NN~<ext>, where NN increases with every version,
+    and the path to (re)write is returned.  See kestep_versions.VersionStore.
+
     Args:
         filepath: Path to the file to version
         backup_dir: Directory for backups (defaults to file's directory)
         extension: Override extension for backup files (defaults to original extension)
     """
+    from kestep.kestep_versions import version_store
+
     base_dir = os.path.dirname(filepath)
     filename, file_ext = os.path.splitext(os.path.basename(filepath))
 
     backup_dir = backup_dir or base_dir
     backup_ext = extension or file_ext
 
-    os.makedirs(backup_dir, exist_ok=True)
-
-    backup_pattern = re.compile(f'{filename}\\.~(\\d+)~{backup_ext}')
-    versions = [
-        int(match.group(1))
-        for match in (backup_pattern.match(f) for f in os.listdir(backup_dir))
-        if match
-    ]
-
-    for version in sorted(versions, reverse=True):
-        old_file = f'{backup_dir}/{filename}.~{version:02d}~{backup_ext}'
-        new_file = f'{backup_dir}/{filename}.~{version + 1:02d}~{backup_ext}'
-        os.rename(old_file, new_file)
+    if backup_dir:
+        os.makedirs(backup_dir, exist_ok=True)
 
-    target_file = f'{backup_dir}/{filename}{backup_ext}'
-    if os.path.exists(target_file):
-        os.rename(target_file, f'{backup_dir}/{filename}.~01~{backup_ext}')
+    target_file = os.path.join(backup_dir, f'{filename}{backup_ext}')
+    version_store.keep_version(target_file)
 
     return target_file
 
@@ -0,0 +1,188 @@
+import json
+import os
+import re
+import threading
+import time
+from typing import Optional
+
+from kestep.kestep_util import KESTEP_DIR
+
+
+class VersionPolicy:
+    """Retention of old versions, per file.  None means unlimited."""
+
+    def __init__(self, keep: Optional[int] = None, max_age: Optional[float] = None, max_bytes: Optional[int] = None):
+        self.keep = keep            # number of versions
+        self.max_age = max_age      # seconds
+        self.max_bytes = max_bytes  # total size of the versions
+
+
+def version_path(target: str, version_id: int) -> str:
+    root, ext = os.path.splitext(target)
+    return f"{root}.~{version_id:02d}~{ext}"
+
+
+class VersionStore:
+    """Monotonically numbered file versions, tracked in an append-only journal.
+
+    Keeping a version of a file is a single os.replace() of the file to <name>.~<id>~<ext> plus one
+    appended journal line: nothing is renamed and no directory is listed.  The newest version has
+    the highest id.  The journal is replayed on first use and compacted when mostly obsolete.
+    """
+
+    def __init__(self, journal: str = os.path.join(KESTEP_DIR, 'versions.jsonl'), policy: VersionPolicy = None):
+        self.journal = journal
+        self.policy = policy or VersionPolicy()
+        self.files: dict[str, dict[int, tuple[float, int]]] = None  # target -> {id: (time, size)}
+        self.next_ids: dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def load(self) -> None:
+        if self.files is not None:
+            return
+        self.files = {}
+        records = 0
+        try:
+            with open(self.journal, 'r') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue    # torn last line of an interrupted write
+                    records += 1
+                    self.replay(record)
+        except OSError:
+            pass
+
+        live = sum(len(versions) for versions in self.files.values())
+        if records > 4 * live + 100:
+            self.compact()
+
+    def replay(self, record: dict) -> None:
+        match record['op']:
+            case 'add':
+                self.files.setdefault(record['path'], {})[record['id']] = (record['time'], record['size'])
+                self.next_ids[record['path']] = max(self.next_ids.get(record['path'], 1), record['id'] + 1)
+            case 'del':
+                self.files.get(record['path'], {}).pop(record['id'], None)
+
+    def append(self, *records: dict) -> None:
+        os.makedirs(os.path.dirname(self.journal) or '.', exist_ok=True)
+        with open(self.journal, 'a') as file:
+            file.write(''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records))
+
+    def compact(self) -> None:
+        records = [{'op': 'add', 'path': path, 'id': version_id, 'time': t, 'size': size}
+                   for path, versions in self.files.items() for version_id, (t, size) in sorted(versions.items())]
+        os.makedirs(os.path.dirname(self.journal) or '.', exist_ok=True)
+        tmp_path = f"{self.journal}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as file:
+            file.write(''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records))
+        os.replace(tmp_path, self.journal)
+
+    def seed(self, target: str) -> None:
+        """First version of a file kestep has no record of: adopt existing .~NN~ files (older kestep).
+
+        Older kestep renamed every version up at each backup, .~01~ being the newest: they are renumbered
+        oldest first, so that the newest has the highest id as retention expects.
+        """
+        directory = os.path.dirname(target) or '.'
+        root, ext = os.path.splitext(os.path.basename(target))
+        pattern = re.compile(f'{re.escape(root)}\\.~(\\d+)~{re.escape(ext)}$')
+        legacy = sorted(((int(match.group(1)), entry) for entry in os.scandir(directory)
+                         for match in [pattern.match(entry.name)] if match), key=lambda item: item[0], reverse=True)
+        moved = []
+        for version_id, (_, entry) in enumerate(legacy, start=1):    # through temporary names, ids are swapped
+            st = entry.stat()
+            tmp_path = f"{entry.path}.{os.getpid()}.seed"
+            os.replace(entry.path, tmp_path)
+            moved.append((tmp_path, version_id, st))
+        records = []
+        for tmp_path, version_id, st in moved:
+            os.replace(tmp_path, version_path(target, version_id))
+            records.append({'op': 'add', 'path': target, 'id': version_id, 'time': st.st_mtime, 'size': st.st_size})
+        for record in records:
+            self.replay(record)
+        if records:
+            self.append(*records)
+        self.files.setdefault(target, {})
+
+    def keep_version(self, target: str) -> Optional[str]:
+        """Move target aside as its next version, returns the version's path (None if target does not exist)"""
+        target = os.path.normpath(target)
+        with self.lock:
+            self.load()
+            try:
+                size = os.path.getsize(target)
+            except OSError:
+                return None
+
+            if target not in self.files:
+                self.seed(target)
+
+            version_id = self.next_ids.get(target, 1)
+            while os.path.exists(version_path(target, version_id)):  # another kestep process got there first
+                version_id += 1
+            self.next_ids[target] = version_id + 1
+
+            path = version_path(target, version_id)
+            os.replace(target, path)
+            record = {'op': 'add', 'path': target, 'id': version_id, 'time': time.time(), 'size': size}
+            self.replay(record)
+            self.append(record, *self.retire(target))
+            return path
+
+    def retire(self, target: str) -> list[dict]:
+        """Apply the retention policy to the versions of one file, returns the journal records"""
+        versions = self.files[target]
+        newest_first = sorted(versions, reverse=True)
+        doomed = set()
+
+        if self.policy.keep is not None:
+            doomed.update(newest_first[self.policy.keep:])
+        if self.policy.max_age is not None:
+            oldest_allowed = time.time() - self.policy.max_age
+            doomed.update(v for v in newest_first if versions[v][0] < oldest_allowed)
+        if self.policy.max_bytes is not None:
+            total = 0
+            for v in newest_first:
+                total += versions[v][1]
+                if total > self.policy.max_bytes:
+                    doomed.add(v)
+
+        records = []
+        for v in sorted(doomed):
+            try:
+                os.remove(version_path(target, v))
+            except OSError:
+                pass
+            del versions[v]
+            records.append({'op': 'del', 'path': target, 'id': v})
+        return records
+
+    def versions(self, target: str) -> list[str]:
+        """Paths of the versions of target, oldest first"""
+        target = os.path.normpath(target)
+        with self.lock:
+            self.load()
+            return [version_path(target, v) for v in sorted(self.files.get(target, {}))]
+
+    def remove_all(self) -> list[str]:
+        """Delete every recorded version, returns the removed paths"""
+        removed = []
+        with self.lock:
+            self.load()
+            for target, versions in self.files.items():
+                for v in versions:
+                    path = version_path(target, v)
+                    try:
+                        os.remove(path)
+                        removed.append(path)
+                    except OSError:
+                        pass
+            self.files.clear()
+            self.compact()
+        return removed
+
+
+version_store = VersionStore()
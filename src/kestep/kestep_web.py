@@ -0,0 +1,231 @@
+import email.utils
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from html.parser import HTMLParser
+from typing import Optional
+
+from kestep.kestep_util import KESTEP_DIR
+
+WEB_DIR = os.path.join(KESTEP_DIR, 'web')
+USER_AGENT = "Mozilla/5.0 (compatible; kestep)"
+FETCH_TIMEOUT = 30.0
+
+# Response headers kept with a cached page
+CACHED_HEADERS = ['content-type', 'etag', 'last-modified', 'cache-control', 'expires', 'date', 'age']
+
+
+def cache_control(headers: dict[str, str]) -> dict[str, str]:
+    """Directives of a Cache-Control header: {'max-age': '60', 'no-cache': ''}"""
+    directives = {}
+    for item in headers.get('cache-control', '').split(','):
+        name, _, value = item.strip().partition('=')
+        if name:
+            directives[name.lower()] = value.strip('"')
+    return directives
+
+
+def freshness(headers: dict[str, str]) -> float:
+    """Seconds a response stays fresh after it was received, 0 when it must be revalidated before reuse"""
+    directives = cache_control(headers)
+    if 'no-cache' in directives or 'no-store' in directives:
+        return 0.0
+    age = float(headers['age']) if headers.get('age', '').isdigit() else 0.0
+    if 'max-age' in directives:
+        try:
+            return max(0.0, float(directives['max-age']) - age)
+        except ValueError:
+            return 0.0
+    if headers.get('expires'):
+        try:
+            expires = email.utils.parsedate_to_datetime(headers['expires']).timestamp()
+            date = email.utils.parsedate_to_datetime(headers['date']).timestamp() if headers.get('date') else time.time()
+        except (TypeError, ValueError):
+            return 0.0
+        return max(0.0, expires - date - age)
+    return 0.0
+
+
+class WebCache:
+    """Private HTTP cache of fetched pages in directory/<sha256 of url>.json.
+
+    Fresh entries (Cache-Control max-age, Expires) are served without a request, stale ones are revalidated
+    with If-None-Match/If-Modified-Since, a 304 answer renews them.  no-store responses are never written.
+    """
+
+    def __init__(self, directory: str = WEB_DIR):
+        self.directory = directory
+        self.enabled = True
+
+    def path(self, url: str) -> str:
+        return os.path.join(self.directory, f"{hashlib.sha256(url.encode('utf-8')).hexdigest()}.json")
+
+    def get(self, url: str) -> Optional[dict[str, any]]:
+        if not self.enabled:
+            return None
+        try:
+            with open(self.path(url), 'r', encoding='utf-8') as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            return None
+        return entry if entry.get('url') == url else None
+
+    def put(self, url: str, headers: dict[str, str], text: str) -> None:
+        if not self.enabled or 'no-store' in cache_control(headers):
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        entry = {"url": url, "stored": time.time(), "headers": headers, "text": text}
+        tmp_path = f"{self.path(url)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(entry, file)
+        os.replace(tmp_path, self.path(url))
+
+
+# The process wide page cache
+web_cache = WebCache()
+
+
+class WebPage:
+    """A fetched page: its text (HTML converted) and where it came from"""
+
+    __slots__ = ('url', 'status', 'content_type', 'body', 'source')
+
+    def __init__(self, url: str, status: int, content_type: str, body: str, source: str):
+        self.url = url
+        self.status = status
+        self.content_type = content_type
+        self.body = body
+        self.source = source    # 'network', 'cache' (fresh) or 'revalidated' (304)
+
+    @property
+    def is_html(self) -> bool:
+        return 'html' in self.content_type or (not self.content_type and '<html' in self.body[:1000].lower())
+
+
+def fetch(url: str) -> WebPage:
+    """GET url through the pooled client of its host and the page cache.  HTTP errors raise."""
+    import httpx
+    from kestep.kestep_http import get_client
+
+    entry = web_cache.get(url)
+    if entry and time.time() - entry['stored'] < freshness(entry['headers']):
+        return WebPage(url, 200, entry['headers'].get('content-type', ''), entry['text'], 'cache')
+
+    headers = {"User-Agent": USER_AGENT, "Accept": "text/html,application/xhtml+xml,text/plain;q=0.9,*/*;q=0.8"}
+    if entry:
+        if entry['headers'].get('etag'):
+            headers['If-None-Match'] = entry['headers']['etag']
+        if entry['headers'].get('last-modified'):
+            headers['If-Modified-Since'] = entry['headers']['last-modified']
+
+    response = get_client(url).get(url, headers=headers, follow_redirects=True, timeout=httpx.Timeout(FETCH_TIMEOUT))
+    if response.status_code == 304 and entry:
+        kept = {**entry['headers'], **{k: v for k, v in response.headers.items() if k in CACHED_HEADERS}}
+        web_cache.put(url, kept, entry['text'])
+        return WebPage(url, 200, kept.get('content-type', ''), entry['text'], 'revalidated')
+    response.raise_for_status()
+
+    kept = {k: v for k, v in response.headers.items() if k in CACHED_HEADERS}
+    web_cache.put(url, kept, response.text)
+    return WebPage(url, response.status_code, kept.get('content-type', ''), response.text, 'network')
+
+
+class _TextExtractor(HTMLParser):
+    """HTML to plain text: block elements on lines of their own, list items as '- ', table cells joined by ' | '.
+
+    For the main content of a page the text inside <main>/<article>, and the text outside navigation, headers,
+    footers, asides and forms, are also collected on their own.
+    """
+
+    SKIP = {'script', 'style', 'noscript', 'template', 'svg', 'head', 'iframe', 'canvas'}
+    CHROME = {'nav', 'header', 'footer', 'aside', 'form'}     # left out of the main content
+    BLOCK = {'p', 'div', 'section', 'article', 'main', 'br', 'hr', 'tr', 'table', 'ul', 'ol', 'dl', 'dt', 'dd',
+             'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'pre', 'blockquote', 'figure', 'figcaption', 'li', 'header',
+             'footer', 'nav', 'aside', 'form', 'title', 'body'}
+    VOID = {'br', 'hr', 'img', 'input', 'meta', 'link', 'area', 'base', 'col', 'embed', 'source', 'track', 'wbr'}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.all: list[str] = []
+        self.content: list[str] = []    # without the page chrome
+        self.main: list[str] = []       # of <main>/<article>, without the page chrome
+        self.skip = 0
+        self.chrome = 0
+        self.in_main = 0
+        self.pre = 0
+
+    def emit(self, text: str) -> None:
+        self.all.append(text)
+        if not self.chrome:
+            self.content.append(text)
+            if self.in_main:
+                self.main.append(text)
+
+    def handle_starttag(self, tag: str, attrs) -> None:
+        if tag in self.SKIP:
+            self.skip += 1
+            return
+        if tag in self.VOID:
+            if tag in self.BLOCK:
+                self.emit('\n')
+            return
+        if tag in ('main', 'article'):
+            self.in_main += 1
+        if tag in self.CHROME:
+            self.chrome += 1
+        if tag == 'pre':
+            self.pre += 1
+        if tag in self.BLOCK:
+            self.emit('\n')
+        if tag == 'li':
+            self.emit('- ')
+        elif tag in ('h1', 'h2', 'h3', 'h4', 'h5', 'h6'):
+            self.emit('#' * int(tag[1]) + ' ')
+        elif tag in ('td', 'th'):
+            self.emit(' | ')
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag in self.SKIP:
+            self.skip = max(0, self.skip - 1)
+            return
+        if tag in self.BLOCK:
+            self.emit('\n')
+        if tag in ('main', 'article'):
+            self.in_main = max(0, self.in_main - 1)
+        if tag in self.CHROME:
+            self.chrome = max(0, self.chrome - 1)
+        if tag == 'pre':
+            self.pre = max(0, self.pre - 1)
+
+    def handle_data(self, data: str) -> None:
+        if self.skip:
+            return
+        self.emit(data if self.pre else re.sub(r'\s+', ' ', data))
+
+
+def tidy(text: str) -> str:
+    lines = (line.strip() for line in text.split('\n'))
+    lines = (line[2:].strip() if line.startswith('| ') else line for line in lines)     # leading cell separator
+    return re.sub(r'\n{2,}', '\n', '\n'.join(lines)).strip() + '\n'
+
+
+def html_to_text(html: str, main_content: bool = False) -> str:
+    """Readable text of an HTML page.
+
+    main_content: only its <main>/<article>, or when it has none, everything but navigation, headers, footers...
+    """
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    if main_content:
+        main = ''.join(parser.main)
+        return tidy(main if main.strip() else ''.join(parser.content))
+    return tidy(''.join(parser.all))
+
+
+def get_page_text(url: str, main_content: bool = False) -> str:
+    page = fetch(url)
+    return html_to_text(page.body, main_content) if page.is_html else page.body
@@ -1,35 +1,47 @@
 import argparse
 import glob
+import logging
 import os
-import re
 import sys
+import time
 
-import keyring
-import toml  # Ensure toml package is installed: `pip install toml`
 from rich.console import Console
-from rich.prompt import Prompt
-from rich.table import Table
-
-from kestep.kestep import PromtpStep, print_step_code, models_config
-from kestep.kestep_api_config import api_config
-from kestep.kestep_functions import DefinedToolsArray
 
-console = Console()
+from kestep.kestep_api_config import api_config, get_models_config
+from kestep.kestep_cache import CACHE_MODES
 
+# Subsystems (rich tables, keyring, httpx, the step engine) are imported by the commands needing them,
+# so `kestep -v` or `kestep -s` do not pay for loading them.
 
-import logging
-from rich.logging import RichHandler
-logging.getLogger().setLevel(logging.WARNING)
+console = Console()
 
 FORMAT = "%(message)s"
-logging.basicConfig(level="NOTSET", format=FORMAT, datefmt="[%X]", handlers=[RichHandler()])
 
 log = logging.getLogger(__file__)
 
 
+class LazyRichHandler(logging.Handler):
+    """RichHandler, but rich.logging (with rich.traceback and pygments) is only imported once something is logged."""
+
+    def __init__(self, level=logging.NOTSET):
+        super().__init__(level)
+        self.handler = None
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if self.handler is None:
+            from rich.logging import RichHandler
+            self.handler = RichHandler()
+            self.handler.setFormatter(self.formatter)
+        self.handler.emit(record)
+
+
 
 
 def print_functions():
+    from rich.table import Table
+    from kestep.kestep_functions import DefinedToolsArray
+
+    models_config = get_models_config()
     table = Table(title="Available Functions")
     table.add_column("Name", style="cyan", no_wrap=True)
     table.add_column("Description/Parameters", style="green")
@@ -73,6 +85,9 @@ def print_functions():
 
 
 def print_models():
+    from rich.table import Table
+
+    models_config = get_models_config()
     table = Table(title="Available Models")
     table.add_column("Company", style="cyan", no_wrap=True)
     table.add_column("Model", style="green")
@@ -105,6 +120,8 @@ def print_models():
 
 
 def print_step_names(step_files: list[str]) -> None:
+    from rich.table import Table
+
     table = Table(title="Step Files")
 
     table.add_column("Step", style="cyan", no_wrap=True)
@@ -125,6 +142,8 @@ def print_step_names(step_files: list[str]) -> None:
 
 
 def create_dropdown(options, prompt_text="Select an option"):
+    from rich.prompt import Prompt
+
     # Display numbered options
     for i, option in enumerate(options, 1):
         console.print(f"{i}. {option}", style="cyan")
@@ -141,6 +160,8 @@ def create_dropdown(options, prompt_text="Select an option"):
 
 
 def get_new_api_key() -> None:
+    import keyring
+
     companies = list(api_config.keys())
     companies.sort()
     company = create_dropdown(companies, "AI Company?")
@@ -152,6 +173,8 @@ def get_new_api_key() -> None:
 
 
 def print_step_lines(step_files: list[str]) -> None:
+    from rich.table import Table
+
     table = Table(title="Prompt Code")
     table.add_column("Step", style="cyan bold", no_wrap=True)
     table.add_column("Lno", style="blue bold", no_wrap=True)
@@ -178,12 +201,28 @@ def print_step_lines(step_files: list[str]) -> None:
 
 
 
+def export_metrics(args: argparse.Namespace) -> None:
+    from kestep.kestep_metrics import metrics, METRICS_DIR
+
+    if args.metrics:
+        metrics.write_jsonl(os.path.join(METRICS_DIR, 'spans.jsonl'))
+        metrics.write_prometheus(os.path.join(METRICS_DIR, 'kestep.prom'))
+        console.print(f"Wrote {len(metrics.spans)} spans to {METRICS_DIR}")
+    if args.otlp:
+        try:
+            metrics.send_otlp(args.otlp)
+        except Exception as e:
+            console.print(f"[bold red]Error sending spans to {args.otlp}: {str(e)}[/bold red]")
+
+
 def get_version():
-    """Retrieve version information from the pyproject.toml."""
-    pyproject_path = os.path.join(os.path.dirname(__file__), '../../pyproject.toml')
-    with open(pyproject_path, "r") as file:
-        pyproject_data = toml.load(file)
-    return pyproject_data["project"]["version"]
+    """Retrieve version information from the installed package metadata."""
+    from importlib.metadata import version, PackageNotFoundError
+
+    try:
+        return version("kestep")
+    except PackageNotFoundError:
+        return "unknown (not installed)"
 
 def get_cmd_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Kestep command line tool.")
@@ -194,9 +233,32 @@ def get_cmd_args() -> argparse.Namespace:
     parser.add_argument('-c', '--code', nargs='?', const='*', help='List code in Steps')
     parser.add_argument('-l', '--list', nargs='?', const='*', help='List Step file')
     parser.add_argument('-e', '--execute', nargs='?', const='*', help='Execute one or more Steps')
+    parser.add_argument('--estimate', nargs='?', const='*',
+                        help='Estimate input tokens and cost of Steps, without calling any LLM')
+    parser.add_argument('--plan', nargs='?', const='*',
+                        help='Print the dependency graph of Steps (.input/.output, .include...) and its critical path')
     parser.add_argument('-k', '--key', action='store_true', help='Ask for (new) Company Key')
     parser.add_argument('-d', '--debug', action='store_true', help='Print message to LLM, for debugging purposes.')
-    parser.add_argument('-r', '--remove', action='store_true', help='remove all .~nn~. files from sub directories')
+    parser.add_argument('-r', '--remove', action='store_true', help='remove all .~nn~. files kestep has versioned')
+    parser.add_argument('--keep-versions', type=int, help='Keep at most this many old versions per file')
+    parser.add_argument('--max-version-age', type=float, help='Remove old versions older than this many days')
+    parser.add_argument('--max-version-mb', type=float, help='Keep at most this many MB of old versions per file')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of Steps to execute at the same time')
+    parser.add_argument('--force', action='store_true',
+                        help='Execute Steps even when nothing they depend on changed since their last successful run')
+    parser.add_argument('--restore', action='store_true',
+                        help='For unchanged Steps whose output files were changed or removed, restore them instead '
+                             'of executing the Step again')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue Steps that failed from their last checkpoint, without repeating earlier requests')
+    parser.add_argument('--batch', action='store_true',
+                        help='Send the first request of each Step through the provider batch API (cheaper, slower)')
+    parser.add_argument('--metrics', action='store_true',
+                        help='Record timing spans to .kestep/metrics/spans.jsonl and kestep.prom (Prometheus textfile)')
+    parser.add_argument('--otlp', nargs='?', const='http://localhost:4318',
+                        help='Send the timing spans to an OpenTelemetry collector (OTLP/HTTP)')
+    parser.add_argument('--cache', choices=CACHE_MODES, default='off',
+                        help='LLM response cache: read (use and record), write (record only) or off')
 
     return parser.parse_args()
 
@@ -216,25 +278,29 @@ def main():
     args = get_cmd_args()
     debug = args.debug
 
+    # -d: kestep's diagnostics (log.info); not NOTSET, httpcore would log every phase of every request
+    logging.basicConfig(level=logging.INFO if debug else logging.WARNING, format=FORMAT, datefmt="[%X]",
+                        handlers=[LazyRichHandler()])
+
     if args.version:
         # Print the version and exit
         version = get_version()
         console.print(f"[bold cyan]kestep[/] [bold green]version[/] [bold magenta]{version}[/]")
         return
 
+    from kestep.kestep_versions import version_store
+    if args.keep_versions is not None:
+        version_store.policy.keep = args.keep_versions
+    if args.max_version_age is not None:
+        version_store.policy.max_age = args.max_version_age * 24 * 3600
+    if args.max_version_mb is not None:
+        version_store.policy.max_bytes = int(args.max_version_mb * 1024 * 1024)
+
     # Add in main() after args parsing:
     if args.remove:
-        pattern = r'.*\.~\d{2}~\.[^.]+$'
-        for root, _, files in os.walk('.'):
-            for file in files:
-                if re.match(pattern, file):
-                    file_path = os.path.join(root, file)
-                    try:
-                        os.remove(file_path)
-                        if debug:
-                            log.info(f"Removed {file_path}")
-                    except OSError as e:
-                        log.error(f"Error removing {file_path}: {e}")
+        for file_path in version_store.remove_all():
+            if debug:
+                log.info(f"Removed {file_path}")
         return
 
     if args.models:
@@ -276,20 +342,79 @@ def main():
         if debug: log.info(f"--code '{args.code}' returned {len(step_files)} files: {step_files}")
 
         if step_files:
+            from kestep.kestep import print_step_code
             print_step_code(step_files)
         else:
             log.error(f"[bold red]No step files found ({args.step})[/bold red]", extra={"markup": True})
         return
 
+    if args.estimate:
+        step_files = glob_step(args.estimate)
+        if debug: log.info(f"--estimate '{args.estimate}' returned {len(step_files)} files: {step_files}")
+
+        if step_files:
+            from kestep.kestep_runner import estimate_steps, print_estimate_summary
+            print_estimate_summary(estimate_steps(step_files, args.jobs if args.jobs > 1 else None))
+        else:
+            log.error(f"[bold red]No step files found ({args.estimate})[/bold red]", extra={"markup": True})
+        return
+
+    if args.plan:
+        step_files = glob_step(args.plan)
+        if debug: log.info(f"--plan '{args.plan}' returned {len(step_files)} files: {step_files}")
+
+        if step_files:
+            from kestep.kestep_graph import DependencyCycle
+            from kestep.kestep_runner import print_plan
+            try:
+                print_plan(step_files)
+            except DependencyCycle as e:
+                console.print(f"[bold red]{str(e)}[/bold red]")
+                sys.exit(9)
+        else:
+            log.error(f"[bold red]No step files found ({args.plan})[/bold red]", extra={"markup": True})
+        return
+
     if args.execute:
         step_files = glob_step(args.execute)
         if debug: log.info(f"--execute '{args.list}' returned {len(step_files)} files: {step_files}")
 
         if step_files:
-            for step_file in step_files:
-                step = PromtpStep(step_file, args.debug)
-                step.parse_prompt()
-                step.execute()
+            from kestep.kestep_cache import configure_cache
+            from kestep.kestep_fingerprint import fingerprints
+            from kestep.kestep_graph import build_graph, DependencyCycle
+            from kestep.kestep_runner import run_steps, print_run_summary, exit_code
+
+            cache = configure_cache(args.cache)
+            if args.metrics or args.otlp:
+                from kestep.kestep_metrics import metrics
+                metrics.enabled = True
+            start_time = time.time()
+            if args.batch:
+                from kestep.kestep_batch import run_batches
+                from kestep.kestep_checkpoint import checkpoints
+                # A step waiting for another step's output cannot prepare its first request yet,
+                # an unchanged step will not send it, a resumed one has sent it already
+                roots = [f for f, node in build_graph(step_files).items() if not node.deps and
+                         (args.force or not fingerprints.check(node, fingerprints.fingerprint(node), args.restore,
+                                                           dry_run=True))
+                         and not (args.resume and checkpoints.load(f))]
+                run_batches(roots, args.jobs if args.jobs > 1 else None)
+            try:
+                results = run_steps(step_files, args.debug, args.jobs, force=args.force, restore=args.restore,
+                                    resume=args.resume)
+            except DependencyCycle as e:
+                console.print(f"[bold red]{str(e)}[/bold red]")
+                sys.exit(9)
+            if len(results) > 1:
+                print_run_summary(results, time.time() - start_time)
+            if cache.enabled:
+                console.print(cache.summary())
+            if args.metrics or args.otlp:
+                export_metrics(args)
+            rc = exit_code(results)
+            if rc:
+                sys.exit(rc)
         else:
             log.error(f"[bold red]No execute files found for ({args.execute})[/bold red]", extra={"markup": True})
         return
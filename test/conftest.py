@@ -0,0 +1,14 @@
+import pytest
+
+import kestep.kestep as kestep
+import kestep.kestep_stepcache as kestep_stepcache
+from kestep.kestep_stepcache import StepCache
+
+
+@pytest.fixture(autouse=True)
+def step_cache(tmp_path, monkeypatch):
+    """Every test compiles prompts into a step cache of its own, none is saved to the working tree at exit"""
+    cache = StepCache(str(tmp_path / '.kestep' / 'steps.json'))
+    monkeypatch.setattr(kestep_stepcache, 'step_cache', cache)
+    monkeypatch.setattr(kestep, 'step_cache', cache)
+    return cache
@@ -0,0 +1,133 @@
+import json
+import re
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import keyring
+import pytest
+
+from kestep.kestep_batch import batch_results, submit_batches, wait_for_batches, load_jobs, prepare_step
+from kestep.kestep_runner import run_step
+
+
+class _BatchServer(BaseHTTPRequestHandler):
+    """Stand-in for the OpenAI and Anthropic batch APIs, a batch ends on its second status poll"""
+    protocol_version = 'HTTP/1.1'
+    batches: dict[str, dict] = {}
+    interactive = 0
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, obj=None, text: str = None):
+        body = text.encode() if text is not None else json.dumps(obj).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    @staticmethod
+    def answer(body: dict) -> dict:
+        text = f"batched answer to {len(body['messages'])} messages"
+        if 'max_tokens' in body:    # Anthropic
+            return {"role": "assistant", "content": [{"type": "text", "text": text}], "stop_reason": "end_turn",
+                    "usage": {"input_tokens": 10, "output_tokens": 4}}
+        return {"choices": [{"message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 4}}
+
+    def do_POST(self):
+        raw = self.rfile.read(int(self.headers['Content-Length']))
+        if self.path == '/v1/files':
+            lines = re.findall(rb'^\{"custom_id".*$', raw, re.MULTILINE)
+            _BatchServer.batches['file'] = [json.loads(line) for line in lines]
+            self.reply({"id": "file-1"})
+        elif self.path == '/v1/batches':
+            requests = _BatchServer.batches.pop('file')
+            _BatchServer.batches['batch_oa'] = {"polls": 0, "requests": requests}
+            self.reply({"id": "batch_oa", "status": "validating"})
+        elif self.path == '/v1/messages/batches':
+            requests = json.loads(raw)['requests']
+            _BatchServer.batches['msgbatch_an'] = {"polls": 0, "requests": requests}
+            self.reply({"id": "msgbatch_an", "processing_status": "in_progress"})
+        else:
+            _BatchServer.interactive += 1
+            self.reply(self.answer(json.loads(raw)))
+
+    def do_GET(self):
+        port = self.server.server_address[1]
+        if self.path == '/v1/batches/batch_oa':
+            batch = _BatchServer.batches['batch_oa']
+            batch['polls'] += 1
+            done = batch['polls'] > 1
+            self.reply({"id": "batch_oa", "status": "completed" if done else "in_progress",
+                        "output_file_id": "file-out" if done else None})
+        elif self.path == '/v1/files/file-out/content':
+            lines = [json.dumps({"custom_id": r['custom_id'], "error": None,
+                                 "response": {"status_code": 200, "body": self.answer(r['body'])}})
+                     for r in _BatchServer.batches['batch_oa']['requests']]
+            self.reply(text='\n'.join(lines))
+        elif self.path == '/v1/messages/batches/msgbatch_an':
+            batch = _BatchServer.batches['msgbatch_an']
+            batch['polls'] += 1
+            done = batch['polls'] > 1
+            self.reply({"id": "msgbatch_an", "processing_status": "ended" if done else "in_progress",
+                        "results_url": f"http://127.0.0.1:{port}/results/msgbatch_an"})
+        elif self.path == '/results/msgbatch_an':
+            lines = [json.dumps({"custom_id": r['custom_id'],
+                                 "result": {"type": "succeeded", "message": self.answer(r['params'])}})
+                     for r in _BatchServer.batches['msgbatch_an']['requests']]
+            self.reply(text='\n'.join(lines))
+
+
+@pytest.fixture
+def batch_server(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(keyring, 'get_password', lambda *args, **kwargs: 'key')
+    (tmp_path / 'logs').mkdir()
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _BatchServer)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    _BatchServer.batches, _BatchServer.interactive = {}, 0
+    batch_results.enabled = True
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    batch_results.enabled = False
+    httpd.shutdown()
+
+
+@pytest.mark.parametrize('model, path', [('gpt-4o', '/v1/chat/completions'),
+                                         ('claude-3-haiku-20240307', '/v1/messages')])
+def test_batch_submit_resume_and_finish(batch_server, tmp_path, model, path):
+    steps = []
+    for name in ['a', 'b']:
+        step_file = tmp_path / f'{name}.prompt'
+        step_file.write_text(f'.llm "model": "{model}", "url": "{batch_server}{path}", "stream": true\n'
+                             f'.system\nbe brief\n.user\nquestion {name}\n.exec\n')
+        steps.append(str(step_file))
+
+    pending = submit_batches(steps)
+    assert len(pending) == 1 and len(pending[0].state['requests']) == 2
+
+    # An interrupted run: a new one finds the batch on disk and does not submit it again
+    assert [job.state['id'] for job in submit_batches(steps)] == [pending[0].state['id']]
+    assert wait_for_batches(load_jobs(), poll_interval=0.01) == 2
+    assert load_jobs() == []
+
+    results = [run_step(step_file, quiet=True) for step_file in steps]
+
+    assert all(r.ok for r in results), [r.error for r in results]
+    assert _BatchServer.interactive == 0
+    assert results[0].toks_in == 10
+    assert 'batched answer' in (tmp_path / 'logs' / 'a_messages.jsonl').read_text()
+
+
+def test_preparing_runs_no_statement_effects(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(keyring, 'get_password', lambda *args, **kwargs: pytest.fail('keyring read while planning'))
+    (tmp_path / 'plain.prompt').write_text('.llm "model": "gpt-4o"\n.user\nhi\n.exec\n')
+    (tmp_path / 'writes.prompt').write_text('.llm "model": "gpt-4o"\n.cmd writefile(filename=out.txt,content=x)\n'
+                                            '.user\nhi\n.exec\n')
+
+    prepared = prepare_step(str(tmp_path / 'plain.prompt'))
+    assert prepared.body['messages'][-1]['content'][0]['text'] == 'hi'
+    assert prepare_step(str(tmp_path / 'writes.prompt')) is None     # refused, the .cmd runs with the step
+    assert not (tmp_path / 'out.txt').exists()
@@ -0,0 +1,56 @@
+from kestep.kestep_budget import ToolBudget, STEP_FLOOR_TOKENS
+
+
+def test_results_over_their_cap_keep_head_and_tail():
+    budget = ToolBudget({'tool_result_tokens': {'readfile': 100, '*': None}})
+    text = 'A' * 2000 + 'B' * 2000
+    kept = budget.admit('OpenAI', 'readfile', text)
+
+    assert kept.startswith('A' * 150) and kept.endswith('B' * 150) and 'tokens of tool output elided' in kept
+    assert len(kept) < 600 and budget.truncated == 1 and budget.removed > 800
+    assert budget.admit('OpenAI', 'execcmd', text) is text      # no cap for the other tools
+    assert budget.admit('OpenAI', 'wwwget', {'error': 1}) == {'error': 1}
+    assert ToolBudget({}).admit('OpenAI', 'readfile', text * 100) == text * 100     # off by default
+
+
+def test_step_budget_shrinks_later_results():
+    budget = ToolBudget({'tool_step_tokens': 1000})
+    assert budget.admit('OpenAI', 'readfile', 'x' * 3000) == 'x' * 3000
+    second = budget.admit('OpenAI', 'readfile', 'y' * 30000)
+    assert 'elided' in second and len(second) < 1000 * 4
+    third = budget.admit('OpenAI', 'readfile', 'z' * 30000)
+    assert 'elided' in third and len(third) < (STEP_FLOOR_TOKENS + 50) * 4
+
+
+def openai_turn(n: int, size: int) -> list[dict]:
+    return [{"role": "assistant", "content": None, "tool_calls": [{"id": f"{n}"}]},
+            {"role": "tool", "tool_call_id": f"{n}", "name": "readfile", "content": f"{n}" * size}]
+
+
+def test_window_stubs_answered_results():
+    messages = [{"role": "user", "content": "go"}]
+    for n in range(1, 4):
+        messages += openai_turn(n, 4000)
+    budget = ToolBudget({'tool_result_window': 1})
+
+    saved = budget.stub_old_results('OpenAI', messages)
+    assert saved > 1500 and budget.removed == saved and budget.stubbed == 2
+    assert messages[2]['content'].startswith('[kestep:') and messages[2]['tool_call_id'] == '1'
+    assert messages[4]['content'].startswith('[kestep:') and messages[6]['content'] == '3' * 4000
+    assert budget.stub_old_results('OpenAI', messages) == 0     # stubs are not stubbed again
+
+    # window 0: only what the model has answered
+    budget = ToolBudget({'tool_result_window': 0})
+    budget.stub_old_results('OpenAI', messages)
+    assert messages[6]['content'] == '3' * 4000
+    assert ToolBudget({}).stub_old_results('OpenAI', messages) == 0     # off by default
+
+
+def test_window_anthropic_blocks():
+    original = {"role": "user", "content": [{"type": "tool_result", "tool_use_id": "1", "content": "y" * 4000}]}
+    messages = [{"role": "user", "content": "go"}, {"role": "assistant", "content": []}, original,
+                {"role": "assistant", "content": [{"type": "text", "text": "done"}]}]
+
+    assert ToolBudget({'tool_result_window': 0}).stub_old_results('Anthropic', messages) > 0
+    assert messages[2] is not original and messages[2]['content'][0]['tool_use_id'] == '1'
+    assert messages[2]['content'][0]['content'].startswith('[kestep:')
@@ -0,0 +1,47 @@
+import os
+import time
+
+from kestep.kestep_cache import ResponseCache, request_key
+
+URL = 'https://api.openai.com/v1/chat/completions'
+DATA = {'model': 'gpt-4o', 'messages': [{'role': 'user', 'content': [{'type': 'text', 'text': 'hi'}]}]}
+RESPONSE = {'choices': [{'message': {'role': 'assistant', 'content': 'hello'}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': 1, 'completion_tokens': 1}}
+
+
+def test_key_is_canonical_and_ignores_transport():
+    reordered = {'messages': DATA['messages'], 'model': 'gpt-4o', 'stream': True}
+    assert request_key(URL, DATA) == request_key(URL, reordered)
+    assert request_key(URL, DATA) != request_key(URL, {**DATA, 'model': 'gpt-4o-mini'})
+
+
+def test_read_mode_records_misses_and_serves_hits(tmp_path):
+    cache = ResponseCache(str(tmp_path), mode='read')
+    assert cache.get(URL, DATA) is None
+    cache.put(URL, DATA, RESPONSE)
+    assert cache.get(URL, DATA) == RESPONSE
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_write_and_off_modes(tmp_path):
+    writer = ResponseCache(str(tmp_path), mode='write')
+    writer.put(URL, DATA, RESPONSE)
+    assert writer.get(URL, DATA) is None        # write mode never serves from the cache
+
+    off = ResponseCache(str(tmp_path / 'off'), mode='off')
+    off.put(URL, DATA, RESPONSE)
+    assert not (tmp_path / 'off').exists()
+
+
+def test_eviction_by_size_and_age(tmp_path):
+    cache = ResponseCache(str(tmp_path), mode='read', max_bytes=400)
+    for i in range(5):
+        cache.put(URL, {**DATA, 'model': f"m{i}"}, RESPONSE)
+        time.sleep(0.01)
+    assert sum(size for _, size in cache.index.values()) <= 400
+    assert cache.get(URL, {**DATA, 'model': 'm4'}) == RESPONSE     # most recent survives
+    assert cache.get(URL, {**DATA, 'model': 'm0'}) is None
+
+    path = cache.path(request_key(URL, {**DATA, 'model': 'm4'}))
+    os.utime(path, (0, 0))
+    assert cache.get(URL, {**DATA, 'model': 'm4'}) is None       # older than max_age
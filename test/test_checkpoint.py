@@ -0,0 +1,76 @@
+import pytest
+
+import kestep.kestep as kestep
+from kestep.kestep import PromtpStep
+from kestep.kestep_budget import ToolBudget
+from kestep.kestep_checkpoint import Checkpoints
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = Checkpoints(str(tmp_path / 'checkpoints'))
+    monkeypatch.setattr(kestep, 'checkpoints', store)
+    return store
+
+
+def running_step(tmp_path) -> PromtpStep:
+    (tmp_path / 'loop.prompt').write_text('.llm "model": "gpt-4o"\n.user\nread\n.exec\n')
+    step = PromtpStep(str(tmp_path / 'loop.prompt'), quiet=True)
+    step.model_name, step.company = 'gpt-4o', 'OpenAI'
+    step.llm = {'url': 'http://127.0.0.1:1/v1/chat/completions', 'api_key': 'OPENAI_API_KEY', 'API_KEY': 'sk-secret'}
+    step.tool_budget = ToolBudget(step.llm)
+    step.tool_budget.removed = 700
+    step.messages = [{"role": "user", "content": [{"type": "text", "text": "read"}]}]
+    step.mark_cache(step.messages[0]['content'][0])
+    step.toks_in, step.toks_out, step.total = 1200, 80, 0.05
+    return step
+
+
+def test_checkpoint_round_trip_without_the_key(tmp_path, store):
+    step = running_step(tmp_path)
+    step.turn_response = {"choices": [{"finish_reason": "tool_calls"}]}
+    step.turn_messages = len(step.messages)
+    step.tool_results = {"call_1": "file content"}
+    store.save(step, 2)
+
+    state = store.load(step.filename)
+    assert 'sk-secret' not in open(store.path(step.filename)).read()
+    assert state['ip'] == 2 and state['messages'] == step.messages and state['toks_in'] == 1200
+    assert state['response'] == step.turn_response and state['tool_results'] == {"call_1": "file content"}
+    assert state['budget']['removed'] == 700 and state['cache_blocks'] == [[0, 0]]
+
+    (tmp_path / 'loop.prompt').write_text('.llm "model": "gpt-4o"\n.user\nsomething else\n.exec\n')
+    assert store.load(step.filename) is None    # the statements moved on, cannot resume
+
+
+def test_resume_restores_the_step(tmp_path, store, monkeypatch):
+    step = running_step(tmp_path)
+    store.save(step, 2)
+    monkeypatch.setattr(kestep, 'load_api_key', lambda step: step.llm.update(API_KEY='sk-again'))
+    monkeypatch.setattr('kestep.kestep_http.prewarm', lambda url: None)
+
+    resumed = PromtpStep(step.filename, quiet=True)
+    assert resumed.resume(store.load(step.filename)) == 2
+    assert resumed.messages == step.messages and resumed.toks_in == 1200 and resumed.total == 0.05
+    assert resumed.llm['API_KEY'] == 'sk-again' and resumed.tool_budget.removed == 700
+    assert list(resumed.cache_blocks.values()) == [resumed.messages[0]['content'][0]]
+
+
+def test_finished_tool_calls_are_not_run_again(tmp_path, store, monkeypatch):
+    calls = []
+    monkeypatch.setitem(kestep.DefinedFunctions, 'count', lambda name: calls.append(name) or name.upper())
+    step = running_step(tmp_path)
+    step.tool_results = {"call_1": "A (before the crash)"}
+
+    results = step.call_functions([('count', {'name': 'a'}), ('count', {'name': 'b'})], ['call_1', 'call_2'])
+    assert results == ["A (before the crash)", "B"] and calls == ['b']
+    assert store.load(step.filename)['tool_results'] == {"call_1": "A (before the crash)", "call_2": "B"}
+
+
+def test_checkpoints_within_a_turn_leave_out_its_response(tmp_path, store):
+    step = running_step(tmp_path)
+    step.turn_response = {"choices": [{"finish_reason": "tool_calls"}]}
+    step.turn_messages = len(step.messages)
+    step.messages.append({"role": "assistant", "tool_calls": [{"id": "call_1"}]})   # added on handling the response
+    store.save(step, 2)
+    assert store.load(step.filename)['messages'] == step.messages[:1]    # resuming handles the response again
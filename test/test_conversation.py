@@ -0,0 +1,58 @@
+import json
+
+from kestep.kestep_conversation import Conversation
+from kestep.kestep_functions import DefinedToolsArray
+from kestep.kestep_promptcache import add_breakpoints
+from kestep.kestep_tokens import estimate_tokens, trim_tool_results
+
+
+def text(value: str) -> list[dict]:
+    return [{"type": "text", "text": value}]
+
+
+def test_correct_merges_only_new_messages():
+    conversation = Conversation()
+    messages = [{"role": "system", "content": text("be brief")}, "hello"]
+    conversation.correct(messages)
+    assert messages == [{"role": "system", "content": text("be brief")}, {"role": "user", "content": text("hello")}]
+
+    messages += [{"role": "user", "content": text("more")}, {"role": "tool", "content": "result"},
+                 {"role": "tool", "content": "result 2"}]
+    conversation.correct(messages)
+    assert messages[1]["content"] == text("hello") + text("more")
+    assert [msg["role"] for msg in messages] == ["system", "user", "tool", "tool"]   # string contents stay apart
+
+
+def test_body_matches_full_serialization_across_turns():
+    conversation = Conversation()
+    messages = [{"role": "user", "content": text("Read the file, ünïcode too")}]
+    for turn in range(5):
+        conversation.correct(messages)
+        data = {"model": "gpt-4o", "messages": messages, "tools": DefinedToolsArray, "stream": True}
+        body = conversation.body(data)
+        assert body == json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        assert conversation.tokens('OpenAI', data) == estimate_tokens('OpenAI', data)
+        messages.append({"role": "assistant", "content": None, "tool_calls": [{"id": f"c{turn}"}]})
+        messages.append({"role": "tool", "tool_call_id": f"c{turn}", "content": "x" * 5000})
+
+    # Unchanged messages are serialized once, changed ones again
+    first = conversation.fragment(messages[0]).json
+    conversation.body(data)
+    assert conversation.fragment(messages[0]).json is first
+    messages[0]["content"].append({"type": "text", "text": "appended"})
+    trim_tool_results('OpenAI', messages, 1000)
+    assert json.loads(conversation.body(data)) == json.loads(json.dumps(data))
+
+
+def test_breakpoint_copies_are_reused():
+    conversation = Conversation()
+    include = {"type": "text", "text": "large include " * 1000}
+    messages = [{"role": "user", "content": [include]}, {"role": "assistant", "content": text("ok")}]
+    marked = {id(include): include}
+
+    sent, _ = add_breakpoints(messages, "system", marked, conversation.breakpoints)
+    messages.append({"role": "user", "content": text("next")})
+    again, _ = add_breakpoints(messages, "system", marked, conversation.breakpoints)
+    assert again[0] is sent[0] and again[0] is not messages[0]
+    assert again[0]["content"][0]["cache_control"] == {"type": "ephemeral"}
+    assert "cache_control" not in again[1]["content"][0]      # no longer the tail
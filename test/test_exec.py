@@ -0,0 +1,40 @@
+import json
+
+from kestep.kestep_exec import OutputBudget, run_command
+from kestep.kestep_functions import execcmd, execcmd_json
+
+
+def test_budget_keeps_head_and_tail():
+    budget = OutputBudget(limit=10)
+    for chunk in [b'abc', b'defghij', b'klmnopqrst', b'uvwxyz']:
+        budget.add(chunk)
+    assert budget.total == 26 and budget.elided == 16
+    assert budget.text() == "abcde\n[... 16 bytes elided ...]\nvwxyz"
+
+    small = OutputBudget(limit=10)
+    small.add(b'0123456789')
+    assert small.elided == 0 and small.text() == "0123456789"
+
+
+def test_exit_status_and_streams():
+    result = run_command("echo out; echo err >&2; exit 3")
+    assert result['exit_status'] == 3 and not result['timed_out']
+    assert result['stdout'] == "out\n" and result['stderr'] == "err\n"
+
+
+def test_chatty_command_is_bounded():
+    result = run_command("yes line | head -n 200000", limit=1000)
+    assert result['stdout_bytes'] == 1000000 and result['stdout_elided_bytes'] == 999000
+    assert result['stdout'].startswith("line\n") and result['stdout'].endswith("line\n")
+
+
+def test_timeout_kills_the_command_and_its_children():
+    result = run_command("sleep 30 & sleep 30; echo never", timeout=0.3)
+    assert result['timed_out'] and result['exit_status'] < 0
+    assert result['duration'] < 5 and 'never' not in result['stdout']
+
+
+def test_execcmd_json_for_tool_calls_plain_output_for_cmd():
+    assert json.loads(execcmd_json('"echo hi"'))['stdout'] == "hi\n"
+    assert execcmd('"echo hi"') == "hi\n"
+    assert execcmd('"echo oops >&2; exit 3"') == "stderr: oops\n"
@@ -0,0 +1,60 @@
+import json
+
+from kestep.kestep_files import readrange, filestat, searchfile, count_lines, line_offset
+import kestep.kestep_files as kestep_files
+from kestep.kestep_functions import DefinedFunctions, AnthropicToolsArray
+
+
+def log_file(tmp_path, lines: int = 5000) -> str:
+    path = tmp_path / 'app.log'
+    path.write_text(''.join(f"{i} {'ERROR disk full' if i % 1000 == 0 else 'ok'}\n" for i in range(1, lines + 1)))
+    return str(path)
+
+
+def test_line_offsets_across_blocks(tmp_path, monkeypatch):
+    monkeypatch.setattr(kestep_files, 'BLOCK', 64)
+    data = b''.join(f"line {i}\n".encode() for i in range(1, 101))
+    assert count_lines(data) == 100 and count_lines(data + b'tail') == 101 and count_lines(b'') == 0
+    assert data[line_offset(data, 50):].startswith(b'line 50\n')
+    assert line_offset(data, 1) == 0 and line_offset(data, 500) == len(data)
+
+
+def test_readrange(tmp_path):
+    path = log_file(tmp_path)
+    text = readrange(path, 1000, 3)
+    assert text.splitlines() == [f"[{path}: lines 1000-1002 of 5000]",
+                                 "  1000\t1000 ERROR disk full", "  1001\t1001 ok", "  1002\t1002 ok"]
+    assert readrange(path, -2).splitlines()[1:] == ["  4999\t4999 ok", "  5000\t5000 ERROR disk full"]
+    assert readrange(path, 0, 4, unit='bytes').endswith("\n1 ok")
+    assert readrange(path, 0, 2).splitlines() == [f"[{path}: lines 1-2 of 5000]", "     1\t1 ok", "     2\t2 ok"]
+    assert readrange(str(tmp_path / 'missing.txt')).startswith("Error:")
+
+    (tmp_path / 'empty.txt').write_text('')
+    assert readrange(str(tmp_path / 'empty.txt')) == f"[{tmp_path / 'empty.txt'}: lines 1-0 of 0]\n"
+
+
+def test_filestat(tmp_path):
+    info = json.loads(filestat(log_file(tmp_path)))
+    assert info['lines'] == 5000 and info['type'] == 'text' and info['bytes'] > 20000
+
+
+def test_searchfile(tmp_path):
+    path = log_file(tmp_path)
+    text = searchfile(path, r'ERROR', context=1)
+    lines = text.splitlines()
+    assert lines[0] == f"[{path}: 5 matching lines]"
+    assert lines[1:5] == ["999-999 ok", "1000:1000 ERROR disk full", "1001-1001 ok", "--"]
+    assert lines[-2:] == ["4999-4999 ok", "5000:5000 ERROR disk full"]
+
+    # overlapping context is shown once, matches keep their ':'
+    assert searchfile(path, r'^(2|3) ok', context=2).splitlines()[1:] == \
+        ["1-1 ok", "2:2 ok", "3:3 ok", "4-4 ok", "5-5 ok"]
+    assert "stopped at 2" in searchfile(path, 'ok', context=0, max_matches=2)
+    assert "no match" in searchfile(path, 'WARNING')
+    assert searchfile(path, '(').startswith("Error:")
+
+
+def test_tools_are_registered():
+    names = {tool['name'] for tool in AnthropicToolsArray}
+    for name in ('readrange', 'filestat', 'searchfile'):
+        assert name in names and name in DefinedFunctions
@@ -0,0 +1,69 @@
+import kestep.kestep_runner as kestep_runner
+from kestep.kestep_fingerprint import FingerprintStore
+from kestep.kestep_graph import StepNode
+from kestep.kestep_runner import StepResult, run_steps
+
+
+def make_node(tmp_path) -> StepNode:
+    (tmp_path / 'a.prompt').write_text('.llm "model": "gpt-4o"\n.include notes.txt\n')
+    (tmp_path / 'notes.txt').write_text('v1')
+    node = StepNode(str(tmp_path / 'a.prompt'))
+    node.inputs = [str(tmp_path / 'notes.txt')]
+    node.settings = '{"model": "gpt-4o"}'
+    return node
+
+
+def test_fingerprint_covers_prompt_inputs_and_settings(tmp_path):
+    store = FingerprintStore(str(tmp_path / '.kestep'))
+    node = make_node(tmp_path)
+    first = store.fingerprint(node)
+    assert store.fingerprint(node) == first
+
+    (tmp_path / 'notes.txt').write_text('v2')
+    second = store.fingerprint(node)
+    assert second != first
+    node.settings = '{"model": "gpt-4o-mini"}'
+    assert store.fingerprint(node) != second
+    node.settings = None
+    assert store.fingerprint(node) is None      # invalid .llm: always run
+
+
+def test_unchanged_steps_are_up_to_date_and_outputs_restored(tmp_path):
+    store = FingerprintStore(str(tmp_path / '.kestep'))
+    node = make_node(tmp_path)
+    output = tmp_path / 'out.json'
+    output.write_text('{"orders": 5}')
+    fingerprint = store.fingerprint(node)
+    assert store.check(node, fingerprint) == ''
+    store.store(node, fingerprint, [str(output)])
+
+    reloaded = FingerprintStore(str(tmp_path / '.kestep'))
+    assert reloaded.check(node, reloaded.fingerprint(node)) == 'up to date'
+
+    output.unlink()
+    assert reloaded.check(node, fingerprint) == ''      # must run, unless restoring
+    assert reloaded.check(node, fingerprint, restore=True, dry_run=True) == 'restored'
+    assert not output.exists()      # planning restores nothing
+    assert reloaded.check(node, fingerprint, restore=True) == 'restored'
+    assert output.read_text() == '{"orders": 5}'
+
+
+def test_run_steps_skips_unchanged_steps(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'steps').mkdir()
+    (tmp_path / 'steps' / 'a.prompt').write_text('.llm "model": "gpt-4o"\n.user\nhi\n.include notes.txt\n.exec\n')
+    (tmp_path / 'notes.txt').write_text('v1')
+    monkeypatch.setattr(kestep_runner, 'fingerprints', FingerprintStore(str(tmp_path / '.kestep')))
+    ran = []
+
+    def fake_run_step(step_file: str, debug: bool = False, quiet: bool = False, resume: bool = False) -> StepResult:
+        ran.append(step_file)
+        return StepResult(step_file)
+
+    monkeypatch.setattr(kestep_runner, 'run_step', fake_run_step)
+    files = ['steps/a.prompt']
+    run_steps(files)
+    assert run_steps(files)[0].up_to_date == 'up to date' and len(ran) == 1
+    run_steps(files, force=True)
+    (tmp_path / 'notes.txt').write_text('v2')
+    assert not run_steps(files)[0].up_to_date and len(ran) == 3
@@ -0,0 +1,77 @@
+import threading
+import time
+
+import pytest
+
+import kestep.kestep_runner as kestep_runner
+from kestep.kestep_graph import build_graph, topological_order, DependencyCycle, Plan, step_timings
+from kestep.kestep_runner import StepResult, run_steps
+
+
+def write_steps(tmp_path, monkeypatch, **steps: str) -> list[str]:
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'steps').mkdir()
+    for name, text in steps.items():
+        (tmp_path / 'steps' / f'{name}.prompt').write_text(f'.llm "model": "gpt-4o"\n{text}\n.exec\n')
+    return [f"steps/{name}.prompt" for name in sorted(steps)]
+
+
+def test_dependencies_are_declared_or_inferred(tmp_path, monkeypatch):
+    files = write_steps(tmp_path, monkeypatch,
+                        a_orders='.user\nwrite the orders\n.output out/orders.json',
+                        b_report='.user\nsummarize\n.include out/orders.json\n.cmd writefile(filename=out/report.md,content=x)',
+                        c_pictures='.image out/*.png\n.user\ndescribe',
+                        d_plot='.input out/orders.json\n.output out/plot.png',
+                        e_alone='.user\nhi')
+    nodes = build_graph(files)
+
+    assert nodes['steps/b_report.prompt'].deps == ['steps/a_orders.prompt']
+    assert nodes['steps/b_report.prompt'].outputs == ['out/report.md']
+    assert nodes['steps/c_pictures.prompt'].deps == ['steps/d_plot.prompt']     # glob input
+    assert nodes['steps/e_alone.prompt'].deps == []
+    order = topological_order(nodes)
+    assert order.index('steps/d_plot.prompt') < order.index('steps/c_pictures.prompt')
+    assert order[0] == 'steps/a_orders.prompt'
+
+
+def test_cycles_are_refused(tmp_path, monkeypatch):
+    files = write_steps(tmp_path, monkeypatch, a='.input b.txt\n.output a.txt', b='.input a.txt\n.output b.txt')
+    with pytest.raises(DependencyCycle):
+        topological_order(build_graph(files))
+
+
+def test_plan_critical_path(tmp_path, monkeypatch):
+    files = write_steps(tmp_path, monkeypatch, a='.output a.txt', b='.input a.txt\n.output b.txt',
+                        c='.input a.txt', d='.user\nhi')
+    step_timings.record({files[0]: 5.0, files[1]: 20.0, files[2]: 1.0, files[3]: 8.0})
+    plan = Plan(build_graph(files))
+
+    assert plan.critical_path == files[:2] and plan.makespan == 25.0
+    assert plan.start[files[2]] == 5.0 and plan.start[files[3]] == 0.0
+
+
+def test_dependents_wait_for_their_inputs_and_skip_on_failure(tmp_path, monkeypatch):
+    files = write_steps(tmp_path, monkeypatch, a='.output a.txt', b='.input a.txt', c='.user\nhi',
+                        d='.output d.txt\n.user\nfail', e='.input d.txt')
+    events = []
+    lock = threading.Lock()
+
+    def fake_run_step(step_file: str, debug: bool = False, quiet: bool = False, resume: bool = False) -> StepResult:
+        with lock:
+            events.append(('start', step_file))
+        time.sleep(0.05)
+        result = StepResult(step_file)
+        if 'd.prompt' in step_file:
+            result.exit_code = 9
+        with lock:
+            events.append(('end', step_file))
+        return result
+
+    monkeypatch.setattr(kestep_runner, 'run_step', fake_run_step)
+    results = run_steps(files, jobs=4)
+
+    assert [r.filename for r in results] == files
+    assert events.index(('end', 'steps/a.prompt')) < events.index(('start', 'steps/b.prompt'))
+    assert events.index(('start', 'steps/c.prompt')) < events.index(('end', 'steps/a.prompt'))     # concurrent
+    assert ('start', 'steps/e.prompt') not in events and 'skipped' in results[4].error
+    assert [r.ok for r in results] == [True, True, True, False, False]
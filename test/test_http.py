@@ -0,0 +1,55 @@
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from kestep.kestep_http import get_client, prewarm, base_url, PhaseTimer
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    connections = set()
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, body: bytes = b'{}'):
+        _Handler.connections.add(self.client_address)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self._reply()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self._reply()
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    _Handler.connections = set()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/v1/chat/completions"
+    httpd.shutdown()
+
+
+def test_client_is_shared_per_provider(server):
+    assert get_client(server) is get_client(base_url(server) + '/v1/messages')
+
+
+def test_prewarmed_connection_is_reused(server):
+    prewarm(server).join()
+
+    timer = PhaseTimer()
+    response = get_client(server).post(server, json={'model': 'x'}, extensions={'trace': timer})
+
+    assert response.status_code == 200
+    assert len(_Handler.connections) == 1       # HEAD and POST went over the same connection
+    assert 'connect' not in timer.phases        # no new TCP connection for the request
+    assert timer.ttfb is not None
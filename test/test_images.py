@@ -0,0 +1,76 @@
+import base64
+import io
+
+import pytest
+
+from kestep.kestep_images import ImageCache, encode_images, target_size, preprocess
+import kestep.kestep_images as kestep_images
+
+
+def test_target_size_keeps_aspect_and_never_enlarges():
+    assert target_size(800, 600, {'image_max_side': 2048}) == (800, 600)
+    assert target_size(4000, 3000, {'image_max_side': 2048, 'image_max_short_side': 768}) == (1024, 768)
+    width, height = target_size(4000, 3000, {'image_max_side': 1568, 'image_max_pixels': 1150000})
+    assert width * height <= 1150000 and abs(width / height - 4 / 3) < 0.01
+
+
+def png(width: int, height: int) -> bytes:
+    Image = pytest.importorskip('PIL.Image')
+    out = io.BytesIO()
+    Image.new('RGB', (width, height), (200, 30, 30)).save(out, 'PNG')
+    return out.getvalue()
+
+
+def test_preprocess_downscales_and_recompresses():
+    Image = pytest.importorskip('PIL.Image')
+    raw = png(3000, 1500)
+    sent, media_type = preprocess(raw, 'image/png', {'image_max_side': 1000})
+    assert media_type == 'image/png'
+    assert Image.open(io.BytesIO(sent)).size == (1000, 500)
+
+    small = png(10, 10)
+    assert preprocess(small, 'image/png', {'image_max_side': 1000})[0] is small    # nothing gained, sent as is
+    assert preprocess(b'not an image', 'image/png', {'image_max_side': 1000}) == (b'not an image', 'image/png')
+
+
+def test_encoded_images_are_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(kestep_images, 'image_cache', ImageCache(str(tmp_path / 'images')))
+    paths = []
+    for i in range(3):
+        paths.append(str(tmp_path / f'diagram{i}.png'))
+        with open(paths[-1], 'wb') as file:
+            file.write(png(64 + i, 64))
+
+    first = encode_images(paths, {'image_max_side': 32})
+    assert [image.path for image in first] == paths and not any(image.cached for image in first)
+    assert all(image.sent_bytes == len(base64.b64decode(image.data)) for image in first)
+
+    again = encode_images(paths, {'image_max_side': 32})
+    assert all(image.cached for image in again)
+    assert [image.data for image in again] == [image.data for image in first]
+    assert all(image.sent_bytes == len(base64.b64decode(image.data)) for image in again)
+    assert not any(image.cached for image in encode_images(paths[:1], {'image_max_side': 16}))     # other limits
+
+
+def test_metadata_is_dropped_even_when_nothing_is_gained():
+    Image = pytest.importorskip('PIL.Image')
+    exif = Image.Exif()
+    exif[0x010F] = 'Camera maker'
+    exif[0x8825] = {2: (48.0, 51.0, 24.0)}      # GPS latitude
+    raw = io.BytesIO()
+    Image.new('RGB', (16, 16), (10, 120, 200)).save(raw, 'JPEG', quality=30, exif=exif.tobytes())
+    raw = raw.getvalue()
+    assert Image.open(io.BytesIO(raw)).getexif()
+
+    sent, media_type = preprocess(raw, 'image/jpeg', {'image_max_side': 1000})
+    assert media_type == 'image/jpeg' and sent != raw
+    with Image.open(io.BytesIO(sent)) as image:
+        assert not image.getexif() and 'exif' not in image.info
+
+    text = io.BytesIO()
+    from PIL.PngImagePlugin import PngInfo
+    info = PngInfo()
+    info.add_text('Author', 'someone')
+    Image.new('RGB', (16, 16)).save(text, 'PNG', pnginfo=info)
+    sent, _ = preprocess(text.getvalue(), 'image/png', {'image_max_side': 1000})
+    assert not Image.open(io.BytesIO(sent)).text
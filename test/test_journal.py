@@ -0,0 +1,70 @@
+import os
+
+from kestep.kestep_journal import ConversationJournal, read_journal
+
+
+def test_journal_appends_only_new_messages(tmp_path):
+    path = str(tmp_path / 'step_messages.jsonl')
+    journal = ConversationJournal(path)
+    messages = [{"role": "system", "content": "be brief"}, {"role": "user", "content": "hi"}]
+
+    journal.sync(messages)
+    journal.flush()
+    size = os.path.getsize(path)
+    journal.sync(messages)      # nothing changed, nothing written
+    journal.flush()
+    assert os.path.getsize(path) == size
+
+    messages.append({"role": "assistant", "content": "hello"})
+    journal.sync(messages)
+    journal.close()
+    with open(path) as file:
+        assert len(file.readlines()) == 3
+    assert read_journal(path) == messages
+
+
+def test_journal_follows_merges_and_replacements(tmp_path):
+    path = str(tmp_path / 'step_messages.jsonl')
+    journal = ConversationJournal(path)
+    messages = [{"role": "user", "content": [{"type": "text", "text": "a"}]}]
+    journal.sync(messages)
+
+    # correct_messages merges a new same-role message into the previous one
+    messages[0]["content"].append({"type": "text", "text": "b"})
+    journal.sync(messages)
+
+    messages.append({"role": "assistant", "content": "x"})
+    messages.append({"role": "user", "content": "y"})
+    journal.sync(messages)
+    messages[1:] = [{"role": "assistant", "content": "z"}]
+    journal.sync(messages)
+    journal.close()
+
+    assert read_journal(path) == messages
+
+
+def test_torn_last_line_is_ignored(tmp_path):
+    path = str(tmp_path / 'step_messages.jsonl')
+    journal = ConversationJournal(path)
+    messages = [{"role": "user", "content": "hi"}]
+    journal.sync(messages)
+    journal.close()
+    with open(path, 'a') as file:
+        file.write('{"op": "set", "i": 1, "msg": {"ro')
+
+    assert read_journal(path) == messages
+
+
+def test_replaced_messages_are_journaled_after_garbage_collection(tmp_path):
+    path = str(tmp_path / 'step_messages.jsonl')
+    journal = ConversationJournal(path)
+    messages = [{"role": "user", "content": ["a"]}]
+    journal.sync(messages)
+
+    for n in range(20):     # freed first, CPython hands its ids to the replacement
+        messages.clear()
+        messages.append({"role": "user", "content": [f"b{n}"]})
+        journal.sync(messages)
+    journal.close()
+
+    assert read_journal(path) == messages
@@ -0,0 +1,68 @@
+import json
+import threading
+import time
+
+import pytest
+
+import kestep.kestep as kestep
+from kestep.kestep import PromtpStep
+
+
+@pytest.fixture
+def tools(monkeypatch):
+    log = []
+    lock = threading.Lock()
+
+    def slow(name: str) -> str:
+        with lock:
+            log.append(f"start {name}")
+        time.sleep(0.2)
+        with lock:
+            log.append(f"end {name}")
+        return name.upper()
+
+    def serial(name: str) -> str:
+        log.append(f"serial {name}")
+        return name
+
+    monkeypatch.setitem(kestep.DefinedFunctions, 'slow', slow)
+    monkeypatch.setitem(kestep.DefinedFunctions, 'serial', serial)
+    monkeypatch.setattr(kestep, 'SerialFunctions', {'serial'})
+    return log
+
+
+def test_tool_calls_run_concurrently_in_call_order(tools):
+    step = PromtpStep('x.prompt', quiet=True)
+    start = time.time()
+    results = step.call_functions([('slow', {'name': 'a'}), ('slow', {'name': 'b'}), ('slow', {'name': 'c'})])
+
+    assert results == ['A', 'B', 'C']
+    assert time.time() - start < 0.5
+
+
+def test_serial_tool_waits_for_earlier_calls(tools):
+    step = PromtpStep('x.prompt', quiet=True)
+    results = step.call_functions([('slow', {'name': 'a'}), ('slow', {'name': 'b'}),
+                                   ('serial', {'name': 'q'}), ('slow', {'name': 'c'})])
+
+    assert results == ['A', 'B', 'q', 'C']
+    assert tools.index('serial q') > max(tools.index('end a'), tools.index('end b'))
+    assert tools.index('serial q') < tools.index('start c')
+
+
+def test_write_then_read_of_a_file_in_one_turn(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'notes.txt').write_text('old')
+    step = PromtpStep('x.prompt', quiet=True)
+    results = step.call_functions([('readfile', {'filename': 'notes.txt'}),
+                                   ('writefile', {'filename': 'notes.txt', 'content': 'new'}),
+                                   ('readfile', {'filename': 'notes.txt'}), ('readfile', {'filename': 'notes.txt'})])
+
+    assert 'old' in results[0] and 'new' not in results[0]
+    assert all('new' in result and 'old' not in result for result in results[2:])
+
+
+def test_tool_calls_get_the_exit_status_of_commands():
+    step = PromtpStep('x.prompt', quiet=True)
+    result = step.call_functions([('execcmd', {'cmd': 'echo hi; exit 2'})])[0]
+    assert json.loads(result)['exit_status'] == 2 and json.loads(result)['stdout'] == "hi\n"
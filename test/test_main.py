@@ -1,5 +1,8 @@
 
 # tests/test_main.py
+import logging
+import sys
+
 import pytest
 from kestep.main import main
 
@@ -7,4 +10,13 @@ def test_main(capsys):
     """Test the main function."""
     main()
     captured = capsys.readouterr()
-    assert "Knowledge Engineer" in captured.out
\ No newline at end of file
+    assert "Knowledge Engineer" in captured.out
+
+@pytest.mark.parametrize('argv, level', [(['kestep', '-l'], logging.WARNING), (['kestep', '-d', '-l'], logging.INFO)])
+def test_debug_shows_diagnostics(tmp_path, monkeypatch, argv, level):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'argv', argv)
+    configured = []
+    monkeypatch.setattr(logging, 'basicConfig', lambda **kwargs: configured.append(kwargs))
+    main()
+    assert configured[0]['level'] == level
@@ -0,0 +1,122 @@
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import keyring
+import pytest
+
+from kestep.kestep_mapreduce import chunk_bounds, response_text
+from kestep.kestep_runner import run_step
+
+
+def test_chunks_cover_the_file_and_end_on_lines():
+    data = ''.join(f"line {i} ünïcödé\n" for i in range(500)).encode('utf-8')
+    bounds = list(chunk_bounds(data, 300))
+    assert bounds[0][0] == 0 and bounds[-1][1] == len(data)
+    assert all(a[1] == b[0] for a, b in zip(bounds, bounds[1:]))
+    assert all(end - start <= 300 for start, end in bounds)
+    assert all(data[end - 1:end] == b'\n' for _, end in bounds)
+
+
+def test_long_lines_are_cut_between_characters():
+    data = ('é' * 1000).encode('utf-8')
+    bounds = list(chunk_bounds(data, 101))
+    assert ''.join(data[start:end].decode('utf-8') for start, end in bounds) == 'é' * 1000
+
+
+def test_response_text():
+    assert response_text([{"role": "assistant", "content": "plain"}, {"role": "tool", "content": "x"}]) == "plain"
+    assert response_text([{"role": "assistant", "content": [{"type": "text", "text": "a"},
+                                                            {"type": "tool_use", "id": "t"},
+                                                            {"type": "text", "text": "b"}]}]) == "ab"
+
+
+class _PartServer(BaseHTTPRequestHandler):
+    """Answers with the first line of the part it was sent (after its header line), records the concurrency"""
+    protocol_version = 'HTTP/1.1'
+    lock = threading.Lock()
+    active = peak = 0
+    bodies: list[dict] = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with _PartServer.lock:
+            _PartServer.active += 1
+            _PartServer.peak = max(_PartServer.peak, _PartServer.active)
+            _PartServer.bodies.append(body)
+        time.sleep(0.05)
+        lines = body['messages'][-1]['content'][-1]['text'].splitlines()
+        reply = json.dumps({"choices": [{"message": {"role": "assistant", "content": lines[min(1, len(lines) - 1)]},
+                                         "finish_reason": "stop"}],
+                            "usage": {"prompt_tokens": 10, "completion_tokens": 2}}).encode()
+        with _PartServer.lock:
+            _PartServer.active -= 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+
+@pytest.fixture
+def part_server(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(keyring, 'get_password', lambda *args, **kwargs: 'key')
+    (tmp_path / 'logs').mkdir()
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _PartServer)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    _PartServer.active = _PartServer.peak = 0
+    _PartServer.bodies = []
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/v1/chat/completions"
+    httpd.shutdown()
+
+
+def test_map_then_reduce(part_server, tmp_path):
+    (tmp_path / 'big.log').write_text(''.join(f"record {i}\n" for i in range(1000)))
+    step_file = tmp_path / 'm.prompt'
+    step_file.write_text(f'.llm "model": "gpt-4o", "url": "{part_server}"\n'
+                         '.system\nbe brief\n.user\nfirst record?\n'
+                         '.map {"file": "big.log", "chunk_tokens": 500, "jobs": 2, "reduce": "Merge:"}\n'
+                         '.user\nwhich is first?\n.exec\n')
+
+    result = run_step(str(step_file), quiet=True)
+
+    assert result.ok, result.error
+    parts = _PartServer.bodies[:-1]
+    assert len(parts) == 6 and _PartServer.peak == 2
+    assert all('first record?' in body['messages'][-1]['content'][0]['text'] for body in parts)
+    reduce = _PartServer.bodies[-1]['messages'][-1]['content']
+    assert [block['text'] for block in reduce][0] == "Merge:" and reduce[-1]['text'] == "which is first?"
+    assert "record 0" in reduce[1]['text'] and 'first record?' not in json.dumps(reduce)
+    assert result.toks_in == 70
+
+
+def test_map_submits_at_most_jobs_parts_and_keeps_no_part(part_server, tmp_path, monkeypatch):
+    import kestep.kestep as kestep
+    pending = []
+
+    class CountingPool(kestep.ThreadPoolExecutor):
+        futures = []
+
+        def submit(self, fn, *args, **kwargs):
+            pending.append(sum(not future.done() for future in CountingPool.futures))
+            future = super().submit(fn, *args, **kwargs)
+            CountingPool.futures.append(future)
+            return future
+
+    monkeypatch.setattr(kestep, 'ThreadPoolExecutor', CountingPool)
+    (tmp_path / 'big.log').write_text(''.join(f"record {i}\n" for i in range(1000)))
+    step_file = tmp_path / 'm.prompt'
+    step_file.write_text(f'.llm "model": "gpt-4o", "url": "{part_server}"\n.user\nfirst record?\n'
+                         '.map {"file": "big.log", "chunk_tokens": 500, "jobs": 2}\n')
+
+    result = run_step(str(step_file), quiet=True)
+
+    assert result.ok, result.error
+    assert len(pending) == 6 and max(pending) < 2      # a part is submitted once another one finished
+    assert all(isinstance(future.result(), dict) and 'messages' not in future.result()
+               for future in CountingPool.futures)
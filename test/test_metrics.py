@@ -0,0 +1,48 @@
+import json
+
+from kestep.kestep_metrics import Metrics
+
+
+class _Step:
+    filename = 'steps/demo.prompt'
+    company = 'OpenAI'
+    model_name = 'gpt-4o'
+    trace_id = '0' * 32
+
+
+def test_disabled_metrics_record_nothing():
+    metrics = Metrics()
+    with metrics.span('parse', _Step()) as span:
+        assert span is None
+    assert metrics.begin('request', _Step()) is None
+    assert metrics.spans == []
+
+
+def test_spans_nest_and_export(tmp_path):
+    metrics = Metrics()
+    metrics.enabled = True
+    step = _Step()
+
+    turn = metrics.begin('request', step, turn=1)
+    with metrics.span('tool', parent=turn, tool='readfile'):
+        pass
+    metrics.record('wait', turn.start, 0.25, parent=turn, http_version='http11')
+    metrics.end(turn, toks_in=100, toks_out=20)
+
+    tool, wait, request = metrics.spans
+    assert tool.parent_id == request.span_id and tool.trace_id == step.trace_id
+    assert tool.attrs == {'step': 'demo.prompt', 'company': 'OpenAI', 'model': 'gpt-4o', 'turn': 1, 'tool': 'readfile'}
+    assert wait.duration == 0.25 and request.attrs['toks_in'] == 100
+
+    metrics.write_jsonl(str(tmp_path / 'spans.jsonl'))
+    lines = (tmp_path / 'spans.jsonl').read_text().splitlines()
+    assert [json.loads(line)['name'] for line in lines] == ['tool', 'wait', 'request']
+
+    metrics.write_prometheus(str(tmp_path / 'kestep.prom'))
+    prom = (tmp_path / 'kestep.prom').read_text()
+    assert 'kestep_span_seconds_sum{span="wait",company="OpenAI",model="gpt-4o"} 0.250000' in prom
+    assert 'kestep_tokens_total{direction="in",company="OpenAI",model="gpt-4o"} 100' in prom
+
+    spans = metrics.otlp_payload()['resourceSpans'][0]['scopeSpans'][0]['spans']
+    assert spans[0]['parentSpanId'] == request.span_id
+    assert {'key': 'toks_in', 'value': {'intValue': '100'}} in spans[2]['attributes']
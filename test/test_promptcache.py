@@ -0,0 +1,44 @@
+from kestep.kestep_api_config import api_config
+from kestep.kestep_promptcache import add_breakpoints, input_usage, input_cost, MAX_BREAKPOINTS
+
+
+def breakpoints(messages, system):
+    count = sum('cache_control' in block for block in system or [])
+    for msg in messages:
+        if isinstance(msg['content'], list):
+            count += sum('cache_control' in block for block in msg['content'])
+    return count
+
+
+def test_breakpoints_on_system_marks_and_tail_without_touching_messages():
+    marked_blocks = [{"type": "text", "text": f"file {i}"} for i in range(5)]
+    messages = [{"role": "user", "content": list(marked_blocks)},
+                {"role": "assistant", "content": [{"type": "text", "text": "ok"}]},
+                {"role": "user", "content": [{"type": "tool_result", "tool_use_id": "1", "content": "data"}]}]
+    marked = {id(block): block for block in marked_blocks}
+
+    sent, system = add_breakpoints(messages, "be brief", marked)
+
+    assert system[0]['cache_control'] == {"type": "ephemeral"}
+    assert breakpoints(sent, system) == MAX_BREAKPOINTS
+    assert 'cache_control' in sent[-1]['content'][-1]                             # the conversation tail
+    assert [('cache_control' in b) for b in sent[0]['content']] == [False, False, False, True, True]
+    assert breakpoints(messages, None) == 0 and sent[1] is messages[1]           # only marked messages copied
+
+
+def test_string_content_tail():
+    sent, system = add_breakpoints([{"role": "user", "content": "hi"}], None, {})
+    assert system is None
+    assert sent[0]['content'] == [{"type": "text", "text": "hi", "cache_control": {"type": "ephemeral"}}]
+
+
+def test_cached_input_is_accounted_separately():
+    anthropic = api_config['Anthropic']
+    usage = {"input_tokens": 10, "output_tokens": 5, "cache_read_input_tokens": 1000, "cache_creation_input_tokens": 200}
+    assert input_usage(anthropic, usage) == (10, 1000, 200)
+    assert input_cost(anthropic, {"input": 1.0}, 10, 1000, 200) == 10 + 100 + 250
+
+    openai = api_config['OpenAI']
+    usage = {"prompt_tokens": 1500, "completion_tokens": 5, "prompt_tokens_details": {"cached_tokens": 1024}}
+    assert input_usage(openai, usage) == (476, 1024, 0)
+    assert input_usage(openai, {"prompt_tokens": 10, "completion_tokens": 5}) == (10, 0, 0)
@@ -0,0 +1,18 @@
+from kestep.kestep_runner import run_steps, exit_code
+
+
+def test_failed_step_does_not_stop_the_batch(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'logs').mkdir()
+    steps = tmp_path / 'steps'
+    steps.mkdir()
+    (steps / 'a.prompt').write_text('.llm "model": "no-such-model"\n.user\nhi\n.exec\n')
+    (steps / 'c.prompt').write_text('.llm "model": "no-such-model"\n.user\nhi\n.exec\n')
+
+    files = [str(steps / name) for name in ['a.prompt', 'c.prompt']]
+    results = run_steps(files, jobs=2)
+
+    assert [r.filename for r in results] == files
+    assert [r.ok for r in results] == [False, False]
+    assert exit_code(results) == 9
+    assert (tmp_path / 'logs' / 'a.log').exists() and (tmp_path / 'logs' / 'c.log').exists()
@@ -0,0 +1,124 @@
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import keyring
+import pytest
+
+from kestep.kestep_runner import run_step
+from kestep.kestep_scheduler import TokenBucket, ProviderScheduler, RetryPolicy, get_scheduler, parse_duration, \
+    retry_after
+
+
+class _RateLimited(BaseHTTPRequestHandler):
+    """OpenAI style stub answering the first `failures` requests with 429 Retry-After"""
+    protocol_version = 'HTTP/1.1'
+    failures = 2
+    calls = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        _RateLimited.calls += 1
+        if _RateLimited.calls <= _RateLimited.failures:
+            body, status = b'{"error": {"message": "rate limited"}}', 429
+        else:
+            body, status = json.dumps({
+                "choices": [{"message": {"role": "assistant", "content": "hello"}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 2}}).encode(), 200
+        self.send_response(status)
+        if status == 429:
+            self.send_header('Retry-After', '0.05')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def rate_limited_server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _RateLimited)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    _RateLimited.calls = 0
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/v1/chat/completions"
+    httpd.shutdown()
+
+
+def test_token_bucket_queues_callers():
+    bucket = TokenBucket(60)    # one per second
+    now = time.monotonic()
+    assert bucket.reserve(60, now) == 0.0
+    assert bucket.reserve(1, now) == pytest.approx(1.0)
+    assert bucket.reserve(1, now) == pytest.approx(2.0)
+
+
+def test_rate_limit_headers():
+    assert parse_duration('6m0s') == 360.0
+    assert parse_duration('20ms') == pytest.approx(0.02)
+    assert parse_duration('1.5') == 1.5
+    assert retry_after({'retry-after-ms': '250'}) == 0.25
+    assert retry_after({}) is None
+
+    scheduler = ProviderScheduler('OpenAI')
+    scheduler.observe({'x-ratelimit-remaining-requests': '0', 'x-ratelimit-reset-requests': '0.1s'})
+    assert 0.05 < scheduler.acquire() <= 0.1
+
+
+def test_backoff_is_jittered_and_capped():
+    scheduler = ProviderScheduler('OpenAI')
+    policy = RetryPolicy({'company': 'OpenAI', 'backoff_base': 1.0, 'backoff_max': 4.0})
+    assert 0.5 <= scheduler.retry_delay(0, policy) <= 1.0
+    assert 2.0 <= scheduler.retry_delay(5, policy) <= 4.0
+    assert scheduler.retry_delay(0, policy, {'retry-after': '3'}) == 3.0
+
+
+def test_retry_settings_are_per_step_and_only_for_safe_statuses():
+    patient = {'company': 'Anthropic', 'rpm': 60, 'max_retries': 8}
+    hasty = {'company': 'Anthropic', 'rpm': 60, 'max_retries': 0}
+    assert get_scheduler(patient) is get_scheduler(hasty)      # the buckets are shared
+    assert RetryPolicy(patient).max_retries == 8 and RetryPolicy(hasty).max_retries == 0
+
+    assert RetryPolicy(patient).status == {429, 503, 529}
+    assert 500 in RetryPolicy({'company': 'OpenAI'}).status     # documented by OpenAI
+    assert not {408, 409, 502, 504} & RetryPolicy({'company': 'OpenAI'}).status
+
+
+def test_step_survives_429(rate_limited_server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(keyring, 'get_password', lambda *args, **kwargs: 'key')
+    (tmp_path / 'logs').mkdir()
+    step_file = tmp_path / 'limited.prompt'
+    step_file.write_text(f'.llm "model": "gpt-4o", "url": "{rate_limited_server}", "max_retries": 3\n.user\nhi\n.exec\n')
+
+    result = run_step(str(step_file), quiet=True)
+
+    assert result.ok, result.error
+    assert _RateLimited.calls == 3
+    assert result.toks_in == 10
+
+
+def test_step_fails_when_retries_run_out(rate_limited_server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(keyring, 'get_password', lambda *args, **kwargs: 'key')
+    (tmp_path / 'logs').mkdir()
+    step_file = tmp_path / 'limited.prompt'
+    step_file.write_text(f'.llm "model": "gpt-4o", "url": "{rate_limited_server}", "max_retries": 1\n.user\nhi\n.exec\n')
+
+    result = run_step(str(step_file), quiet=True)
+
+    assert not result.ok and _RateLimited.calls == 2
+
+
+def test_retries_give_their_tokens_back(rate_limited_server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(keyring, 'get_password', lambda *args, **kwargs: 'key')
+    (tmp_path / 'logs').mkdir()
+    step_file = tmp_path / 'limited.prompt'
+    step_file.write_text(f'.llm "model": "gpt-4o", "url": "{rate_limited_server}", "tpm": 654321\n.user\nhi\n.exec\n')
+
+    assert run_step(str(step_file), quiet=True).ok and _RateLimited.calls == 3
+    bucket = get_scheduler({'company': 'OpenAI', 'tpm': 654321}).tokens
+    assert bucket.level >= bucket.capacity - 12 - 1      # the usage of the answered attempt only
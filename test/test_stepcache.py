@@ -0,0 +1,32 @@
+import os
+
+from kestep.kestep import PromtpStep
+from kestep.kestep_stepcache import StepCache
+
+
+def test_compiled_statements_are_reused_until_the_file_changes(tmp_path):
+    prompt = tmp_path / 'a.prompt'
+    prompt.write_text('.llm "model": "gpt-4o"\n.user\nhello\nworld\n')
+    cache = StepCache(str(tmp_path / 'steps.json'))
+    compiled = []
+
+    def compile_prompt(text):
+        compiled.append(text)
+        return PromtpStep(str(prompt)).compile_prompt(text)
+
+    rows = cache.statements(str(prompt), compile_prompt)
+    assert rows == [('.llm', '"model": "gpt-4o"', 0, 0), ('.user', 'hello\nworld', 1, 1), ('.exec', '', 2, 4)]
+
+    os.utime(prompt, ns=(1, 1))     # touched, same content
+    assert cache.statements(str(prompt), compile_prompt) == rows
+    assert len(compiled) == 1
+
+    prompt.write_text('.user\nbye\n')
+    assert cache.statements(str(prompt), compile_prompt)[0] == ('.user', 'bye', 0, 0)
+    assert len(compiled) == 2
+
+    cache.save()
+    reloaded = StepCache(str(tmp_path / 'steps.json'))
+    assert reloaded.statements(str(prompt), compile_prompt) == [('.user', 'bye', 0, 0), ('.exec', '', 1, 2)]
+    assert len(compiled) == 2
+    assert reloaded.statements(str(prompt), compile_prompt, syntax=['.new']) and len(compiled) == 3
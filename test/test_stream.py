@@ -0,0 +1,84 @@
+import json
+
+import pytest
+
+from kestep.kestep_stream import iter_sse, make_stream, _StreamAccumulator
+
+
+def sse(*events: tuple[str, dict]) -> list[str]:
+    lines = []
+    for event, data in events:
+        if event:
+            lines.append(f"event: {event}")
+        lines.append(f"data: {json.dumps(data)}")
+        lines.append("")
+    return lines
+
+
+def test_iter_sse_joins_data_lines():
+    lines = [": keep-alive", "event: ping", "data: a", "data: b", "", "data: [DONE]", ""]
+    assert list(iter_sse(lines)) == [("ping", "a\nb"), ("", "[DONE]")]
+
+
+def test_openai_stream_rebuilds_text_and_tool_calls():
+    texts = []
+    first = []
+    lines = sse(
+        ("", {"id": "c1", "model": "gpt-4o", "choices": [{"index": 0, "delta": {"role": "assistant", "content": "Hel"}}]}),
+        ("", {"choices": [{"index": 0, "delta": {"content": "lo"}}]}),
+        ("", {"choices": [{"index": 0, "delta": {"tool_calls": [
+            {"index": 0, "id": "call_1", "type": "function", "function": {"name": "readfile", "arguments": "{\"file"}}]}}]}),
+        ("", {"choices": [{"index": 0, "delta": {"tool_calls": [
+            {"index": 0, "function": {"arguments": "name\": \"a.txt\"}"}}]}}]}),
+        ("", {"choices": [{"index": 0, "delta": {}, "finish_reason": "tool_calls"}]}),
+        ("", {"choices": [], "usage": {"prompt_tokens": 10, "completion_tokens": 5}}),
+    ) + ["data: [DONE]", ""]
+
+    stream = make_stream("openai", on_text=texts.append, on_first_token=lambda: first.append(True))
+    obj = stream.consume(lines)
+
+    assert texts == ["Hel", "lo"]
+    assert first == [True]
+    assert obj["choices"][0]["finish_reason"] == "tool_calls"
+    message = obj["choices"][0]["message"]
+    assert message["content"] == "Hello"
+    assert message["tool_calls"] == [{"id": "call_1", "type": "function",
+                                      "function": {"name": "readfile", "arguments": "{\"filename\": \"a.txt\"}"}}]
+    assert obj["usage"] == {"prompt_tokens": 10, "completion_tokens": 5}
+
+
+def test_anthropic_stream_rebuilds_message():
+    texts = []
+    lines = sse(
+        ("message_start", {"type": "message_start", "message": {"id": "m1", "role": "assistant", "content": [],
+                                                               "usage": {"input_tokens": 12, "output_tokens": 1}}}),
+        ("content_block_start", {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}),
+        ("content_block_delta", {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": "Hi"}}),
+        ("content_block_stop", {"type": "content_block_stop", "index": 0}),
+        ("content_block_start", {"type": "content_block_start", "index": 1,
+                                 "content_block": {"type": "tool_use", "id": "tu_1", "name": "wwwget", "input": {}}}),
+        ("content_block_delta", {"type": "content_block_delta", "index": 1,
+                                 "delta": {"type": "input_json_delta", "partial_json": "{\"url\": "}}),
+        ("content_block_delta", {"type": "content_block_delta", "index": 1,
+                                 "delta": {"type": "input_json_delta", "partial_json": "\"http://x\"}"}}),
+        ("content_block_stop", {"type": "content_block_stop", "index": 1}),
+        ("message_delta", {"type": "message_delta", "delta": {"stop_reason": "tool_use"}, "usage": {"output_tokens": 30}}),
+        ("message_stop", {"type": "message_stop"}),
+    )
+
+    obj = make_stream("anthropic", on_text=texts.append).consume(lines)
+
+    assert texts == ["Hi"]
+    assert obj["stop_reason"] == "tool_use"
+    assert obj["usage"] == {"input_tokens": 12, "output_tokens": 30}
+    assert obj["content"] == [{"type": "text", "text": "Hi"},
+                              {"type": "tool_use", "id": "tu_1", "name": "wwwget", "input": {"url": "http://x"}}]
+
+
+def test_stream_formats_must_implement_feed_and_result():
+    class Incomplete(_StreamAccumulator):
+        def feed(self, event: str, data: dict) -> None:
+            pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
@@ -0,0 +1,71 @@
+import pytest
+
+from kestep.kestep import PromtpStep, ContextOverflow
+from kestep.kestep_functions import DefinedToolsArray
+from kestep.kestep_runner import estimate_steps
+from kestep.kestep_tokens import estimate_tokens, trim_tool_results, IMAGE_TOKENS
+
+
+def test_estimate_grows_with_text_and_ignores_image_encoding():
+    small = {"messages": [{"role": "user", "content": [{"type": "text", "text": "hi"}]}]}
+    large = {"messages": [{"role": "user", "content": [{"type": "text", "text": "word " * 4000}]}]}
+    image = {"messages": [{"role": "user", "content": [
+        {"type": "image_url", "image_url": {"url": "data:image/png;base64," + "A" * 100000}}]}]}
+
+    assert estimate_tokens('OpenAI', small) < 20
+    assert 4000 < estimate_tokens('OpenAI', large) < 8000
+    assert IMAGE_TOKENS <= estimate_tokens('OpenAI', image) < IMAGE_TOKENS + 20
+    assert estimate_tokens('OpenAI', {**small, "tools": DefinedToolsArray}) > estimate_tokens('OpenAI', small)
+
+
+def test_trim_replaces_oldest_tool_results_first():
+    big = "x" * 40000
+    messages = [
+        {"role": "user", "content": "read the files"},
+        {"role": "tool", "tool_call_id": "1", "name": "readfile", "content": big},
+        {"role": "tool", "tool_call_id": "2", "name": "readfile", "content": big},
+    ]
+    saved = trim_tool_results('OpenAI', messages, 5000)
+
+    assert saved >= 5000
+    assert messages[1]['content'].startswith('[kestep:') and messages[1]['tool_call_id'] == '1'
+    assert messages[2]['content'] == big
+
+
+def test_trim_anthropic_tool_result_blocks():
+    original = {"role": "user", "content": [{"type": "tool_result", "tool_use_id": "1", "content": "y" * 40000}]}
+    messages = [{"role": "user", "content": "go"}, original]
+
+    assert trim_tool_results('Anthropic', messages, 100) > 100
+    assert messages[1] is not original      # replaced, so the journal logs it again
+    assert messages[1]['content'][0]['content'].startswith('[kestep:')
+
+
+def test_estimate_steps_without_network(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    steps = tmp_path / 'steps'
+    steps.mkdir()
+    (steps / 'a.prompt').write_text('.llm "model": "gpt-4o"\n.system\nbe brief\n.user\nhi\n.exec\n.user\nmore\n.exec\n')
+    (steps / 'b.prompt').write_text('.llm "model": "no-such-model"\n.user\nhi\n.exec\n')
+
+    a, b = estimate_steps([str(steps / 'a.prompt'), str(steps / 'b.prompt')])
+
+    assert a.model_name == 'gpt-4o' and len(a.requests) == 2 and a.requests[1] > a.requests[0]
+    assert a.cost > 0 and not a.over and not a.error
+    assert 'no-such-model' in b.error
+
+
+def test_context_check_keeps_room_for_the_output(tmp_path):
+    (tmp_path / 'a.prompt').write_text('.llm "model": "claude-3-haiku-20240307", "context_policy": "refuse"\n'
+                                       '.user\nhi\n.exec\n')
+    step = PromtpStep(str(tmp_path / 'a.prompt'), quiet=True)
+    step.parse_prompt()
+    step.estimate()
+    assert step.data['max_tokens'] == 4096      # the model's output limit, not its context
+
+    step.model = {**step.model, 'context': step.check_context()[0] + 4000}
+    with pytest.raises(ContextOverflow):        # the input fits, not with the answer
+        step.check_context()
+    step.llm['max_tokens'] = 1000
+    step.make_data()
+    assert step.data['max_tokens'] == 1000 and step.check_context()[1] == ''
@@ -0,0 +1,67 @@
+import os
+
+from kestep.kestep_versions import VersionStore, VersionPolicy
+
+
+def write(path, text):
+    with open(path, 'w') as file:
+        file.write(text)
+
+
+def test_versions_are_numbered_upwards_without_renames(tmp_path):
+    store = VersionStore(str(tmp_path / 'versions.jsonl'))
+    target = str(tmp_path / 'out.log')
+
+    assert store.keep_version(target) is None       # nothing to keep yet
+    for i in range(120):
+        write(target, f"run {i}")
+        store.keep_version(target)
+
+    versions = store.versions(target)
+    assert len(versions) == 120
+    assert versions[0].endswith('out.~01~.log') and versions[-1].endswith('out.~120~.log')
+    assert open(versions[-1]).read() == 'run 119'
+
+    # A new process replays the journal and continues the numbering
+    write(target, 'run 120')
+    assert VersionStore(str(tmp_path / 'versions.jsonl')).keep_version(target).endswith('out.~121~.log')
+
+
+def test_legacy_versions_are_adopted(tmp_path):
+    write(tmp_path / 'old.~01~.log', 'a')
+    write(tmp_path / 'old.~02~.log', 'b')
+    write(tmp_path / 'old.log', 'c')
+    store = VersionStore(str(tmp_path / 'versions.jsonl'))
+
+    assert store.keep_version(str(tmp_path / 'old.log')).endswith('old.~03~.log')
+    assert len(store.versions(str(tmp_path / 'old.log'))) == 3
+
+
+def test_legacy_versions_are_renumbered_newest_last(tmp_path):
+    for number, run in [(1, 'run 3'), (2, 'run 2'), (3, 'run 1'), (4, 'run 0')]:    # .~01~ was the newest
+        write(tmp_path / f'old.~{number:02d}~.log', run)
+    write(tmp_path / 'old.log', 'run 4')
+    store = VersionStore(str(tmp_path / 'versions.jsonl'), VersionPolicy(keep=3))
+
+    store.keep_version(str(tmp_path / 'old.log'))
+    assert [open(path).read() for path in store.versions(str(tmp_path / 'old.log'))] == ['run 2', 'run 3', 'run 4']
+    assert sorted(os.listdir(tmp_path)) == ['old.~03~.log', 'old.~04~.log', 'old.~05~.log', 'versions.jsonl']
+
+
+def test_retention_and_remove_all(tmp_path):
+    store = VersionStore(str(tmp_path / 'versions.jsonl'), VersionPolicy(keep=3))
+    target = str(tmp_path / 'out.json')
+    for i in range(10):
+        write(target, 'x' * 10)
+        store.keep_version(target)
+    assert [os.path.basename(p) for p in store.versions(target)] == ['out.~08~.json', 'out.~09~.json', 'out.~10~.json']
+    assert sorted(os.listdir(tmp_path)) == ['out.~08~.json', 'out.~09~.json', 'out.~10~.json', 'versions.jsonl']
+
+    store.policy = VersionPolicy(max_bytes=15)
+    write(target, 'y' * 10)
+    store.keep_version(target)
+    assert [os.path.basename(p) for p in store.versions(target)] == ['out.~11~.json']
+
+    assert len(store.remove_all()) == 1
+    assert os.listdir(tmp_path) == ['versions.jsonl']
+    assert VersionStore(str(tmp_path / 'versions.jsonl')).versions(target) == []
@@ -0,0 +1,85 @@
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+import kestep.kestep_web as kestep_web
+from kestep.kestep_web import WebCache, fetch, freshness, html_to_text, get_page_text
+
+PAGE = """<html><head><title>Pricing</title><style>body {color: red}</style></head><body>
+<nav><a href="/">Home</a> <a href="/docs">Docs</a></nav>
+<main><h1>API pricing</h1>
+<p>Prices per   million
+tokens.</p>
+<table><tr><th>Model</th><th>Input</th></tr><tr><td>small</td><td>$0.15</td></tr></table>
+<ul><li>Batch: 50% off</li></ul>
+<script>track()</script></main>
+<footer>&copy; 2024 Example</footer></body></html>"""
+
+
+class _PageServer(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    gets = 0
+    conditional = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        _PageServer.gets += 1
+        if self.headers.get('If-None-Match') == '"v1"':
+            _PageServer.conditional += 1
+            self.send_response(304)
+            self.send_header('ETag', '"v1"')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = PAGE.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('ETag', '"v1"')
+        self.send_header('Cache-Control', 'max-age=3600' if self.path == '/fresh' else 'no-cache')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def page_server(tmp_path, monkeypatch):
+    monkeypatch.setattr(kestep_web, 'web_cache', WebCache(str(tmp_path / 'web')))
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _PageServer)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    _PageServer.gets = _PageServer.conditional = 0
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+
+
+def test_html_to_text():
+    text = html_to_text(PAGE)
+    assert "# API pricing" in text and "Prices per million tokens." in text
+    assert "Model | Input" in text and "small | $0.15" in text and "- Batch: 50% off" in text
+    assert "track()" not in text and "color" not in text and "© 2024" in text
+
+    main = html_to_text(PAGE, main_content=True)
+    assert "API pricing" in main and "Home" not in main and "2024" not in main
+
+
+def test_freshness():
+    assert freshness({'cache-control': 'public, max-age=600'}) == 600
+    assert freshness({'cache-control': 'max-age=600', 'age': '100'}) == 500
+    assert freshness({'cache-control': 'no-cache, max-age=600'}) == 0
+    assert freshness({'expires': 'Thu, 01 Jan 2099 00:00:00 GMT', 'date': 'Wed, 31 Dec 2098 23:00:00 GMT'}) == 3600
+    assert freshness({}) == 0
+
+
+def test_fresh_pages_come_from_the_cache(page_server):
+    assert fetch(f"{page_server}/fresh").source == 'network'
+    assert fetch(f"{page_server}/fresh").source == 'cache'
+    assert _PageServer.gets == 1
+
+
+def test_stale_pages_are_revalidated(page_server):
+    first = get_page_text(f"{page_server}/page")
+    page = fetch(f"{page_server}/page")
+    assert page.source == 'revalidated' and _PageServer.conditional == 1
+    assert html_to_text(page.body) == first